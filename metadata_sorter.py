@@ -20,49 +20,138 @@
 
 # my_sorter.py (Corrected to handle multiple time formats)
 
+import os
 import re
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
 # 正则表达式保持不变，因为它能正确提取出时间字符串
 METADATA_REGEX = re.compile(r"Created Time:\s*`(.+?)`")
+# 字节版本：直接在未解码的文件内容上匹配，只解码匹配到的那一小段
+METADATA_REGEX_BYTES = re.compile(rb"Created Time:\s*`(.+?)`")
 
 DEFAULT_TIME = datetime.min
 
-def get_sort_key(md_path: Path) -> datetime:
+# 元数据只出现在文件开头，读取这么多字节 (字符) 就足够了
+HEADER_READ_SIZE = 4096
+
+
+# 两种已知格式 '%m/%d/%Y %I:%M:%S %p' 和 '%m/%d/%Y %H:%M:%S' 合并成一个正则，
+# 匹配后直接用各分组的整数构造 datetime
+_DT_RE = re.compile(
+    r"^(\d{1,2})/(\d{1,2})/(\d{4}) (\d{1,2}):(\d{2}):(\d{2})(?:\s+(AM|PM))?$",
+    re.IGNORECASE
+)
+
+
+def _fast_parse(time_str: str) -> datetime | None:
+    """
+    只处理两种已知格式的快速解析器。
+    不匹配或字段非法时返回 None，由调用方回退到 strptime。
+    """
+    m = _DT_RE.match(time_str)
+    if not m:
+        return None
+
+    month, day, year, hour, minute, second, ampm = m.groups()
+    hour = int(hour)
+    if ampm:
+        if not 1 <= hour <= 12:
+            return None
+        ampm = ampm.upper()
+        if ampm == 'PM' and hour < 12:
+            hour += 12
+        elif ampm == 'AM' and hour == 12:
+            hour = 0
+
+    try:
+        return datetime(int(year), int(month), int(day), hour, int(minute), int(second))
+    except ValueError:
+        return None
+
+# 已解析过的时间字符串缓存：同一个 vault 里大量笔记共享相同的时间戳，
+# 命中时直接查表，避免重复解析。lru_cache 是线程安全的，
+# 排序键可以在线程池中并发计算。
+@lru_cache(maxsize=None)
+def _parse_time_str(time_str: str) -> datetime | None:
+    """解析 'Created Time' 字符串，所有已知格式都失败时返回 None。"""
+    # 快速路径：正则匹配后直接构造 datetime，不经过 strptime
+    parsed = _fast_parse(time_str)
+    if parsed is not None:
+        return parsed
+
+    # =====================================================================
+    #  核心修正：定义一个格式列表，并逐一尝试
+    # =====================================================================
+    # 格式1: 带 AM/PM 的 12 小时制
+    format_1 = "%m/%d/%Y %I:%M:%S %p"
+    # 格式2: 不带 AM/PM 的 24 小时制 (注意这里用 %H 而不是 %I)
+    format_2 = "%m/%d/%Y %H:%M:%S"
+
+    # 根据是否以 AM/PM 结尾直接挑选格式，正常的时间戳只需调用一次 strptime，
+    # 不再依赖 ValueError 做流程控制；只有这一次失败时才尝试另一种格式
+    if time_str[-2:].upper() in ('AM', 'PM'):
+        formats = (format_1, format_2)
+    else:
+        formats = (format_2, format_1)
+
+    for fmt in formats:
+        try:
+            # 尝试用当前格式解析
+            return datetime.strptime(time_str, fmt)
+        except ValueError:
+            # 如果此格式不匹配，什么也不做，继续尝试下一个
+            continue
+
+    return None
+
+def _time_from_match(time_str: str | None, name: str, fallback_mtime: float | None) -> datetime:
+    """
+    解析从文件开头提取出的 'Created Time' 字符串。
+    元数据缺失或无法解析时，回退到文件的修改时间 (如果有)，否则返回默认时间。
+    """
+    if time_str is not None:
+        parsed = _parse_time_str(time_str)
+        if parsed is not None:
+            return parsed
+
+        # 如果所有格式都尝试失败，打印警告并继续
+        print(f"⚠️  Warning: Could not parse date '{time_str}' for {name} with any known format.")
+
+    if fallback_mtime is not None:
+        return datetime.fromtimestamp(fallback_mtime)
+    return DEFAULT_TIME
+
+def get_sort_key(md_path_or_content: Path | str, fallback_mtime: float | None = None) -> datetime:
     """
     从 Markdown 文件中读取元数据，解析 'Created Time' 并返回一个 datetime 对象。
     这个版本能够处理多种时间格式。
+
+    如果调用方已经读入了文件内容，可以直接传入字符串 (至少包含文件开头部分)，
+    这样就不必再打开一次文件。
+
+    没有 'Created Time' 元数据时按文件修改时间排序：可以通过 fallback_mtime
+    传入 (例如来自 os.scandir 的 stat 结果)；传入路径而未给出时，
+    直接对已打开的文件做 fstat，不需要额外的路径查找。
     """
-    try:
-        with md_path.open('r', encoding='utf-8', errors='ignore') as f:
-            content_head = "".join(f.readline() for _ in range(20))
-
-            match = METADATA_REGEX.search(content_head)
-            if match:
-                time_str = match.group(1).strip()
-
-                # =====================================================================
-                #  核心修正：定义一个格式列表，并逐一尝试
-                # =====================================================================
-                # 格式1: 带 AM/PM 的 12 小时制
-                format_1 = "%m/%d/%Y %I:%M:%S %p"
-                # 格式2: 不带 AM/PM 的 24 小时制 (注意这里用 %H 而不是 %I)
-                format_2 = "%m/%d/%Y %H:%M:%S"
-
-                for fmt in [format_1, format_2]:
-                    try:
-                        # 尝试用当前格式解析
-                        return datetime.strptime(time_str, fmt)
-                    except ValueError:
-                        # 如果此格式不匹配，什么也不做，继续尝试下一个
-                        continue
-
-                # 如果所有格式都尝试失败，打印警告并继续
-                print(f"⚠️  Warning: Could not parse date '{time_str}' for {md_path.name} with any known format.")
+    if isinstance(md_path_or_content, str):
+        match = METADATA_REGEX.search(md_path_or_content, 0, HEADER_READ_SIZE)
+        time_str = match.group(1).strip() if match else None
+        return _time_from_match(time_str, "<content>", fallback_mtime)
 
+    md_path = md_path_or_content
+    try:
+        # 以二进制模式读取，跳过整个窗口的 UTF-8 解码
+        with md_path.open('rb') as f:
+            content_head = f.read(HEADER_READ_SIZE)
+            if fallback_mtime is None:
+                fallback_mtime = os.fstat(f.fileno()).st_mtime
     except IOError as e:
         print(f"⚠️  Warning: Could not read file {md_path.name}: {e}")
+        # 如果发生任何错误，返回默认时间
+        return DEFAULT_TIME
 
-    # 如果发生任何错误或所有格式都失败，返回默认时间
-    return DEFAULT_TIME
+    match = METADATA_REGEX_BYTES.search(content_head)
+    time_str = match.group(1).decode('utf-8', errors='ignore').strip() if match else None
+    return _time_from_match(time_str, md_path.name, fallback_mtime)
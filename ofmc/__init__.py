@@ -38,6 +38,6 @@ __all__ = [
     'run_batch_compilation',
     'run_xelatex',
     'get_temp_dir',
-    'OFMCompiler'
-    '__version__'
+    'OFMCompiler',
+    '__version__',
 ]
\ No newline at end of file
@@ -19,82 +19,118 @@
 """
 
 # ofmc/batch_compiler.py
+import collections
+import glob
+import hashlib
 import importlib
+import itertools
+import json
 import os
 import sys
 import shutil
 import uuid
 import subprocess
 import time
-from pathlib import Path
+from pathlib import Path, PurePath
 from typing import Callable
 
 import multiprocessing
 import threading
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-from pypdf import PdfWriter
-from tqdm import tqdm
+# pypdf、tqdm、colorama、编译器和 book_builder 较重，
+# 在真正用到它们的函数中再导入，避免拖慢 CLI 启动 (例如只查看 --help 时)
 
-from .parser import OFMCompiler  # 导入您的核心编译器
-
-import colorama
-from colorama import Fore, Style
-
-from .book_builder import build_book
+from .build_cache import (BUILD_CACHE_DIRNAME, compute_build_fingerprint, compute_cache_key,
+                          compute_note_key, prune_build_cache, store_cached_output)
 from .utils import extract_relevant_latex_error
 
 import re
 
 
+# 扫描阶段使用的正则，在模块导入时编译一次。
+# 使用 MULTILINE 直接对整个文件做 finditer，不再逐行 splitlines。
+# 行内空白用 [^\S\r\n] 而不是 \s，保证匹配不会跨行 (也兼容 CRLF 换行)。
+HEADING_RE = re.compile(r"^[^\S\r\n]*#+[^\S\r\n]+([^\r\n]+?)[^\S\r\n]*\r?$", re.MULTILINE)
+# 匹配行尾的 ^xxxxxx，但也会匹配独立一行的
+BLOCK_ID_RE = re.compile(r'\^([a-fA-F0-9]{6})[^\S\n]*$', re.MULTILINE)
+_NON_ALNUM_RE = re.compile(r'[^a-zA-Z0-9]')
+
+
+def create_latex_label(target_key: str) -> str:
+    """为给定的目标字符串创建一个唯一的、对 LaTeX 安全的标签。"""
+    safe_str = _NON_ALNUM_RE.sub('', target_key)
+    # 使用 uuid 的一小部分确保唯一性，防止不同文件的相同标题冲突
+    unique_hash = str(uuid.uuid5(uuid.NAMESPACE_DNS, target_key))[:8]
+    return f"wikilink:{safe_str[:40]}:{unique_hash}"
+
+
+# 扫描阶段读入的文件内容 {md_path: 文本}。
+# fork 出来的工作进程通过写时复制直接继承它，编译时不必再读一次磁盘；
+# spawn 启动的进程中它是空的，编译器会自己读取文件。
+_MD_CACHE: dict[Path, str] = {}
+
+
+def _scan_one(md_path: Path) -> tuple[list[tuple[str, str]], Exception | None, str | None]:
+    """
+    扫描单个文件，返回 (目标键, 标签) 列表、读取/解析时发生的异常 (如果有)
+    以及读入的文件内容 (读取失败时为 None)。
+    """
+    note_name = md_path.stem
+
+    # 1. 注册文件名本身
+    entries = [(note_name, create_latex_label(note_name))]
+    content = None
+
+    try:
+        content = md_path.read_text(encoding='utf-8')
+
+        # 2. 注册标题
+        for h_match in HEADING_RE.finditer(content):
+            heading_text = h_match.group(1).strip()
+            target_key = f"{note_name}#{heading_text}"
+            entries.append((target_key, create_latex_label(target_key)))
+
+        # 3. 注册块ID
+        for b_match in BLOCK_ID_RE.finditer(content):
+            block_id = b_match.group(1)
+            target_key = f"{note_name}^{block_id}"
+            entries.append((target_key, create_latex_label(target_key)))
+    except Exception as e:
+        return entries, e, content
+
+    return entries, None, content
+
+
 # +++ 新增：全局扫描与注册函数 +++
 def scan_and_build_registry(files_to_compile: list[Path], vault_root: Path) -> dict:
     """
     [阶段一] 扫描所有文件，构建链接目标注册表。
+    读取文件是 I/O 密集的，因此在线程池中并行扫描，再在主线程中合并结果。
     """
+    from colorama import Fore, Style
+    from tqdm import tqdm
+
     print(f"{Fore.CYAN}🔎 Pass 1/3: Scanning {len(files_to_compile)} files for link targets...{Style.RESET_ALL}")
 
     registry = {}
-    heading_re = re.compile(r"^\s*#+\s+(.+?)\s*$")
-    # 匹配行尾的 ^xxxxxx，但也会匹配独立一行的
-    block_id_re = re.compile(r'\^([a-fA-F0-9]{6})\s*$')
-
-    def create_latex_label(target_key: str) -> str:
-        """为给定的目标字符串创建一个唯一的、对 LaTeX 安全的标签。"""
-        safe_str = re.sub(r'[^a-zA-Z0-9]', '', target_key)
-        # 使用 uuid 的一小部分确保唯一性，防止不同文件的相同标题冲突
-        unique_hash = str(uuid.uuid5(uuid.NAMESPACE_DNS, target_key))[:8]
-        return f"wikilink:{safe_str[:40]}:{unique_hash}"
-
-    for md_path in tqdm(files_to_compile, desc="Scanning", unit="file"):
-        note_name = md_path.stem
-
-        # 1. 注册文件名本身
-        registry[note_name] = create_latex_label(note_name)
 
-        try:
-            content = md_path.read_text(encoding='utf-8')
-            for line in content.splitlines():
-                # 2. 注册标题
-                h_match = heading_re.match(line)
-                if h_match:
-                    heading_text = h_match.group(1).strip()
-                    target_key = f"{note_name}#{heading_text}"
-                    registry[target_key] = create_latex_label(target_key)
-
-                # 3. 注册块ID
-                b_match = block_id_re.search(line)
-                if b_match:
-                    block_id = b_match.group(1)
-                    target_key = f"{note_name}^{block_id}"
-                    registry[target_key] = create_latex_label(target_key)
-        except Exception as e:
-            print(f"{Fore.YELLOW}Warning: Could not read or parse {md_path.name} during scan: {e}{Style.RESET_ALL}")
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # executor.map 按输入顺序返回结果，注册表的内容与顺序都保持确定
+        results = executor.map(_scan_one, files_to_compile)
+        # tqdm 包住整个 zip：zip 在 files_to_compile 用完时就停止，只包住 results 的话进度条会停在 (N-1)/N
+        for md_path, (entries, error, content) in tqdm(zip(files_to_compile, results),
+                                                        total=len(files_to_compile), desc="Scanning", unit="file"):
+            registry.update(entries)
+            if content is not None:
+                _MD_CACHE[md_path] = content
+            if error is not None:
+                print(f"{Fore.YELLOW}Warning: Could not read or parse {md_path.name} during scan: {error}{Style.RESET_ALL}")
 
     print(f"{Fore.GREEN}✅ Found and registered {len(registry)} unique link targets.{Style.RESET_ALL}")
     return registry
 
-def logger_thread_worker(log_queue: multiprocessing.Queue, pbar: tqdm):
+def logger_thread_worker(log_queue: multiprocessing.Queue, pbar: "tqdm"):
     """
     这个函数在一个独立的线程中运行。
     它的唯一工作就是从共享队列中获取日志消息，
@@ -104,7 +140,38 @@ def logger_thread_worker(log_queue: multiprocessing.Queue, pbar: tqdm):
         message = log_queue.get()
         if message is None:  # "None" 是我们约定的停止信号
             break
-        pbar.write(str(message))
+        # 工作进程会把一批日志行作为一个列表一次性发送
+        if isinstance(message, list):
+            for line in message:
+                pbar.write(str(line))
+        else:
+            pbar.write(str(message))
+
+def compile_excluded_patterns(excluded_patterns: list[str]) -> re.Pattern | None:
+    """
+    把所有排除模式预编译成一个正则 (各模式之间用 | 连接)，
+    之后每个路径只需一次 re.match，不必对每个模式重新解析 glob。
+
+    语义与 PurePath.match 保持一致：相对模式从路径的右侧开始逐段匹配，
+    例如 "Templates/*" 匹配任意深度下 Templates 目录中的直接子项；
+    通配符不跨越 '/'，并且可以匹配以 '.' 开头的名字。
+    没有有效模式时返回 None。
+    """
+    alternatives = []
+    for pattern in excluded_patterns:
+        pure_pattern = PurePath(pattern)
+        # 空模式和绝对模式永远不会匹配 vault 内的相对路径
+        if not pure_pattern.parts or pure_pattern.is_absolute():
+            continue
+        translated = glob.translate(pure_pattern.as_posix(), include_hidden=True, seps='/')
+        # 允许前面有任意多个完整的路径段，实现从右侧匹配
+        alternatives.append(f"(?s:.*/)?{translated}")
+
+    if not alternatives:
+        return None
+    # 与 PurePath.match 一样，Windows 上不区分大小写
+    flags = re.IGNORECASE if os.name == 'nt' else 0
+    return re.compile("|".join(alternatives), flags)
 
 def find_markdown_files(root_dir: Path, excluded_patterns: list[str]) -> list[Path]:
     """
@@ -138,34 +205,40 @@ def find_markdown_files(root_dir: Path, excluded_patterns: list[str]) -> list[Pa
             )
     # =================================================================
 
-    # 1. 使用 rglob 高效地递归查找所有 .md 文件。
-    #    使用 sorted() 保证结果的顺序稳定性。
-    all_md_files = sorted(root_dir.rglob("*.md"))
-
-    # 如果没有排除规则，直接返回所有文件
-    if not excluded_patterns:
-        return all_md_files
-
-    filtered_files = []
-    for file_path in all_md_files:
-        # 2. 获取文件相对于 vault 根目录的路径，用于匹配。
-        relative_path = file_path.relative_to(root_dir)
-
-        # 3. 检查文件路径是否与任何排除模式匹配。
-        #    我们不仅检查文件本身，还检查它的所有父目录。
-        #    这允许像 "Templates" 这样的模式排除整个目录。
-        parts_to_check = [relative_path] + list(relative_path.parents)
-
-        is_excluded = any(
-            part.match(pattern)
-            for pattern in excluded_patterns
-            for part in parts_to_check
-        )
-
-        if not is_excluded:
-            filtered_files.append(file_path)
-
-    return filtered_files
+    # 1. 用 os.walk 遍历 vault，遍历时直接剪掉被排除的目录，
+    #    不再进入那些可能很大的被忽略的子树。
+    #    一个文件被排除，当且仅当它自己或它的某个父目录与某个排除模式匹配；
+    #    父目录在遍历时已经检查过，所以每个文件只需检查自己的路径。
+    excluded_re = compile_excluded_patterns(excluded_patterns)
+
+    def is_excluded(relative_path: str) -> bool:
+        return excluded_re.match(relative_path) is not None
+
+    # os.walk 返回的 dirpath 都以根目录的字符串开头，直接切掉这个前缀即可得到相对路径，
+    # 不必为每个目录构造 Path 再调用 relative_to
+    root_prefix_len = len(str(root_dir).rstrip(os.sep)) + 1
+
+    md_files = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        # 统一使用 '/' 作为分隔符，与排除模式的正则一致
+        relative_dir = dirpath[root_prefix_len:].replace(os.sep, '/')
+        dir_prefix = relative_dir + '/' if relative_dir else ''
+
+        if excluded_re is not None:
+            # 原地修改 dirnames，os.walk 就不会再进入被排除的目录
+            dirnames[:] = [d for d in dirnames if not is_excluded(dir_prefix + d)]
+
+        for filename in filenames:
+            # 与原来的 rglob("*.md") 一样，在 Windows 上不区分大小写 (Note.MD 也算)
+            if not os.path.normcase(filename).endswith('.md'):
+                continue
+            # 2. 文件相对于 vault 根目录的路径，用于匹配。
+            if excluded_re is not None and is_excluded(dir_prefix + filename):
+                continue
+            md_files.append(Path(dirpath, filename))
+
+    # 使用 sorted() 保证结果的顺序稳定性。
+    return sorted(md_files)
 
 def get_temp_dir() -> Path:
     """
@@ -182,111 +255,247 @@ def get_temp_dir() -> Path:
     return ofmc_temp_dir
 
 
+# 工作进程的共享状态，由 _worker_init 在进程启动时设置。
+# 对所有文件都相同的参数 (链接注册表、资源目录、编译模式等) 只随 initargs 传递一次，
+# 不再被序列化进每一个任务。
+_COMPILER = None
+_COMPILER_INIT_ERROR = None
+_LINK_REGISTRY = None
+_BUILD_ASSETS_DIR = None
+_IS_BOOK_MODE = False
+_MAX_NAME_LENGTH = 18
+_LOG_QUEUE = None
+_VAULT_ROOT = None
+# 独立模式下每个笔记上次成功编译时的 XeLaTeX 辅助文件，见 _restore_note_aux
+_AUX_CACHE_DIR = None
+# 工作进程内的日志缓冲区：日志行先在这里累积，由 flush_logs 一次性发送
+_log_buf = []
+
+
+def flush_logs():
+    """把缓冲区中的所有日志行作为一条消息放入日志队列，并清空缓冲区。"""
+    if _log_buf and _LOG_QUEUE is not None:
+        _LOG_QUEUE.put(list(_log_buf))
+    _log_buf.clear()
+
+
+def _worker_init(config, link_registry: dict | None, build_assets_dir: Path,
+                 is_book_mode: bool, max_name_length: int,
+                 log_queue: multiprocessing.Queue,
+                 pre_processors: list = None, post_processors: list = None):
+    """
+    进程池的 initializer：在每个工作进程中保存共享参数并构建一个 OFMCompiler，
+    之后该进程处理的所有文件都复用它，不再为每个文件重新加载处理器链。
+    """
+    global _COMPILER, _COMPILER_INIT_ERROR, _LINK_REGISTRY, _BUILD_ASSETS_DIR
+    global _IS_BOOK_MODE, _MAX_NAME_LENGTH, _LOG_QUEUE, _VAULT_ROOT, _AUX_CACHE_DIR
+    from .parser import OFMCompiler  # 导入您的核心编译器
+    from .content_extractor import set_token_cache_dir
+
+    # fork 启动的子进程已经通过写时复制继承了父进程中的 _LINK_REGISTRY，
+    # 此时 link_registry 为 None；只有 spawn 时才需要重新传入
+    if link_registry is not None:
+        _LINK_REGISTRY = link_registry
+    _BUILD_ASSETS_DIR = build_assets_dir
+    _IS_BOOK_MODE = is_book_mode
+    _MAX_NAME_LENGTH = max_name_length
+    # 普通的 multiprocessing.Queue 只能通过继承共享，不能作为任务参数传递
+    _LOG_QUEUE = log_queue
+    _VAULT_ROOT = config.vault_root
+    try:
+        if not is_book_mode:
+            _AUX_CACHE_DIR = Path(config.output_dir) / BUILD_CACHE_DIRNAME / XELATEX_AUX_CACHE_DIRNAME
+            _AUX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # 被嵌入笔记的解析结果缓存在构建缓存目录中，跨运行复用
+        set_token_cache_dir(Path(config.output_dir) / BUILD_CACHE_DIRNAME / TOKEN_CACHE_DIRNAME)
+        _COMPILER = OFMCompiler(
+            vault_root=str(config.vault_root),
+            author=config.author,
+            link_registry=_LINK_REGISTRY,
+            build_assets_dir=_BUILD_ASSETS_DIR,
+            post_processors=post_processors if post_processors else None,
+            pre_processors=pre_processors if pre_processors else None,
+        )
+    except Exception as e:
+        # 不能让 initializer 抛出异常，否则进程池会不断重启工作进程。
+        # 记录下来，由每个任务各自报告。
+        _COMPILER_INIT_ERROR = e
+
+
+def _write_utf8(path: Path, text: str):
+    """直接通过文件描述符写入 UTF-8 文本，绕过 write_text 的文本包装层。"""
+    _write_bytes(path, text.encode('utf-8'))
+
+
+def _write_bytes(path: Path, data: bytes):
+    """通过文件描述符写入字节；os.write 可能只写入一部分，因此循环直到全部写完。"""
+    data = memoryview(data)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+    finally:
+        os.close(fd)
+
+
+# 章节 .tex 文件名取内容 SHA-256 摘要的前几位
+CHAPTER_NAME_HASH_LENGTH = 16
+# 记录 {笔记相对 vault 的路径: 章节摘要} 的清单文件，位于 tex_chapters 目录中
+CHAPTER_MANIFEST_NAME = "manifest.json"
+
+
+def _store_chapter_tex(tex_chapters_dir: Path, data: bytes) -> Path:
+    """
+    以内容摘要命名并写入章节 .tex，返回其路径。
+    内容不变的章节在多次构建间保持同一个文件名，不同目录下的同名笔记也不会互相覆盖。
+    """
+    digest = hashlib.sha256(data).hexdigest()[:CHAPTER_NAME_HASH_LENGTH]
+    tex_path = tex_chapters_dir / f"{digest}.tex"
+    _write_bytes(tex_path, data)
+    return tex_path
+
+
+def _write_chapter_manifest(tex_chapters_dir: Path, compiled_tex_files: dict, vault_root: Path):
+    """
+    写出章节清单，并删除清单之外的旧章节文件
+    (内容改变后，上一次构建留下的章节文件名已经不再被引用)。
+    """
+    manifest = {
+        md_path.relative_to(vault_root).as_posix(): tex_path.stem
+        for md_path, tex_path in sorted(compiled_tex_files.items())
+    }
+    with open(tex_chapters_dir / CHAPTER_MANIFEST_NAME, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    live = set(manifest.values())
+    for stale in tex_chapters_dir.glob("*.tex"):
+        if stale.stem not in live:
+            stale.unlink(missing_ok=True)
+
+
+# 没有显式指定日志级别时，根据消息开头的 emoji 决定颜色
+_EMOJI_LEVELS = {'✅': 'ok', '❌': 'err', '💥': 'err'}
+
+
 def compile_single_file_worker(md_path: Path,
-                               config,
                                temp_dir: Path,
-                               log_queue: multiprocessing.Queue,
-                               # --- 新增参数 ---
-                               is_book_mode: bool,
-                               output_target_dir: Path,
-                               link_registry: dict,
-                               build_assets_dir: Path,
-                               max_name_length: int = 18,
-                               post_processors: list = None,
-                               pre_processors: list = None):
+                               output_target_dir: Path):
     """
     在并行进程中运行的单个文件编译工作函数。
     - 在图书模式下，它生成 .tex 章节文件并返回其路径。
     - 在独立模式下，它生成 .pdf 文件并返回其路径。
+    编译器实例和编译模式等共享参数由 _worker_init 在进程启动时设置。
     """
+    from colorama import Fore
+
+    is_book_mode = _IS_BOOK_MODE
+    max_name_length = _MAX_NAME_LENGTH
 
-    def worker_logger(message: any):  # 接受任何类型的消息
-        """使用 colorama 库实现带颜色高亮的日志记录器。"""
-        prefix = f"[{md_path.stem:<{max_name_length}}]"
+    # 每个文件的前缀和颜色只计算一次，不必在每条日志中重新格式化
+    prefix = f"[{md_path.stem:<{max_name_length}}] "
+    level_colors = {'ok': Fore.GREEN, 'err': Fore.RED}
 
+    def worker_logger(message: any, level: str | None = None):  # 接受任何类型的消息
+        """
+        使用 colorama 库实现带颜色高亮的日志记录器。
+        level 为 'ok' (绿色)、'err' (红色) 或 'info' (不着色)。
+        未指定时 (例如 run_xelatex 传来的消息)，只根据消息的第一个字符判断。
+        """
         # =========================================================================
         #  FIX: Explicitly convert 'message' to a string before concatenation.
         #  This handles Path objects, exceptions, and other non-string types gracefully.
         # =========================================================================
-        log_line = prefix + " " + str(message)
+        text = str(message)
+        if level is None:
+            level = _EMOJI_LEVELS.get(text[:1], 'info')
 
-        if '✅' in log_line:
-            formatted_log = f"{Fore.GREEN}{log_line}{Fore.RESET}"
-        elif '❌' in log_line or '💥' in log_line:
-            formatted_log = f"{Fore.RED}{log_line}{Fore.RESET}"
+        color = level_colors.get(level)
+        if color:
+            formatted_log = f"{color}{prefix}{text}{Fore.RESET}"
         else:
-            formatted_log = log_line
-        log_queue.put(formatted_log)
+            formatted_log = prefix + text
+        # 先缓冲，每个文件处理结束时 (或调用 XeLaTeX 前) 统一发送，减少 IPC 次数
+        _log_buf.append(formatted_log)
 
     try:
-        # 在每个进程中创建独立的编译器实例，保证进程安全
-        compiler = OFMCompiler(
-            vault_root=str(config.vault_root),
-            author=config.author,
-            link_registry=link_registry if is_book_mode else None,
-            build_assets_dir=build_assets_dir,
-            post_processors=post_processors if post_processors else None,
-            pre_processors=pre_processors if pre_processors else None,
-        )
+        # 每个进程持有独立的编译器实例，保证进程安全
+        if _COMPILER is None:
+            raise RuntimeError(f"Compiler initialization failed: {_COMPILER_INIT_ERROR}")
+        compiler = _COMPILER
 
         # =========================================================================
         #  核心修改：根据模式选择不同的工作流
         # =========================================================================
         if is_book_mode:
             # --- 图书模式：生成 .tex 章节文件 ---
-            worker_logger("📖 Generating TeX chapter...")
+            worker_logger("📖 Generating TeX chapter...", level='info')
 
             # 告诉编译器生成 "chapter" 片段，而不是完整文档
             # **注意**: 这需要你的 OFMCompiler.compile 方法支持 mode 参数
-            latex_content = compiler.compile(str(md_path), mode='chapter')
+            # 扫描阶段已经读入的内容 (fork 时从父进程继承) 直接交给编译器
+            latex_content = compiler.compile(str(md_path), mode='chapter',
+                                             markdown_text=_MD_CACHE.get(md_path))
 
-            # 输出路径是共享的、非临时的 TeX 目录
-            final_tex_path = output_target_dir / md_path.with_suffix('.tex').name
-
-            final_tex_path.write_text(latex_content, encoding='utf-8')
-            worker_logger(f"✅ TeX chapter saved: {final_tex_path.name}")
+            # 输出路径是共享的、非临时的 TeX 目录，文件名由内容决定
+            final_tex_path = _store_chapter_tex(output_target_dir, latex_content.encode('utf-8'))
+            worker_logger(f"✅ TeX chapter saved: {final_tex_path.name}", level='ok')
 
             # 返回最终的 .tex 文件路径
             return md_path, final_tex_path
 
         else:
             # --- 独立文件模式：生成 .pdf 文件 (旧逻辑) ---
-            worker_logger("📄 Compiling to standalone PDF...")
+            worker_logger("📄 Compiling to standalone PDF...", level='info')
 
             # 告诉编译器生成完整的 "standalone" 文档
-            latex_content = compiler.compile(str(md_path), mode='standalone')
+            latex_content = compiler.compile(str(md_path), mode='standalone',
+                                             markdown_text=_MD_CACHE.get(md_path))
 
             # 使用临时目录来处理中间文件
             # 文件名可以简单一些，因为目录本身是唯一的
             temp_tex_path = temp_dir / "document.tex"
             temp_pdf_path = temp_dir / "document.pdf"
 
-            temp_tex_path.write_text(latex_content, encoding='utf-8')
+            _write_utf8(temp_tex_path, latex_content)
 
+            # XeLaTeX 耗时较长，先把已有的日志发出去
+            flush_logs()
+            aux_key = compute_note_key(md_path, _VAULT_ROOT)
+            _restore_note_aux(temp_tex_path, aux_key)
             success = run_xelatex(temp_tex_path, temp_dir, logger=worker_logger)
+            if success:
+                _store_note_aux(temp_tex_path, aux_key)
 
             if success and temp_pdf_path.exists():
                 # 返回在临时目录中的 pdf 路径
                 return md_path, temp_pdf_path
             else:
-                worker_logger(f"❌ PDF compilation failed for {md_path.name}")
+                worker_logger(f"❌ PDF compilation failed for {md_path.name}", level='err')
                 return md_path, None
         # =========================================================================
 
     except Exception as e:
         # 统一的错误处理，对两种模式都有效
-        worker_logger(f"💥 CRITICAL ERROR Compiling {md_path.name}: {e}")
+        worker_logger(f"💥 CRITICAL ERROR Compiling {md_path.name}: {e}", level='err')
         import traceback
-        worker_logger(traceback.format_exc())  # 打印详细的堆栈跟踪以帮助调试
+        worker_logger(traceback.format_exc(), level='info')  # 打印详细的堆栈跟踪以帮助调试
         return md_path, None
+    finally:
+        flush_logs()
 
 def merge_pdfs(pdf_paths: list[Path], output_filename: Path):
     """将一系列PDF文件合并成一个大文件。"""
+    from pypdf import PdfWriter
+    from tqdm import tqdm
+
     merger = PdfWriter()
     print(f"\nMerging {len(pdf_paths)} PDFs into {output_filename}...")
     for pdf_path in tqdm(pdf_paths, desc="Merging", unit="file"):
         try:
-            merger.append(str(pdf_path))
+            # 不导入每个源文件的完整书签树 (那需要解析并复制大量的大纲对象)，
+            # 每个笔记在合并后的文件中只保留一个指向其首页的书签
+            merger.append(str(pdf_path), outline_item=pdf_path.stem, import_outline=False)
         except Exception as e:
             print(f"Warning: Could not append {pdf_path.name}. Reason: {e}")
 
@@ -295,9 +504,31 @@ def merge_pdfs(pdf_paths: list[Path], output_filename: Path):
     print("Merge complete.")
 
 
+def _output_pdf_path(md_path: Path, vault_prefix: str, individual_pdf_dir: Path) -> Path:
+    """
+    源文件在输出目录中对应的 PDF 路径。
+    md_path 一定位于 vault 中，直接去掉预先算好的 vault_prefix 字符串前缀，
+    不必调用 relative_to 逐段比较路径。
+    """
+    return (individual_pdf_dir / str(md_path).removeprefix(vault_prefix)).with_suffix(".pdf")
+
+
+def _copy_pdf_to_output(md_path: Path, src_pdf_path: Path, vault_prefix: str, individual_pdf_dir: Path):
+    """把一个编译好的 PDF 复制到输出目录中与源文件对应的位置。"""
+    output_pdf_path = _output_pdf_path(md_path, vault_prefix, individual_pdf_dir)
+    output_pdf_path.parent.mkdir(parents=True, exist_ok=True)
+    # 在独立模式下，src_pdf_path 是在临时目录 (或构建缓存) 里，需要复制。
+    # 只复制内容，不复制权限位；copyfile 在 Linux 上直接走内核内的
+    # sendfile/copy_file_range 快速路径
+    shutil.copyfile(src_pdf_path, output_pdf_path)
+
+
 # --- 这是本模块的主入口函数 ---
 def run_batch_compilation(config):
     """批量编译的主调度函数，现在支持图书模式和独立文件模式。"""
+    from tqdm import tqdm
+    from .book_builder import build_book
+
     vault_root = config.vault_root
     output_dir = config.output_dir
     excluded = config.excluded
@@ -324,7 +555,6 @@ def run_batch_compilation(config):
         link_registry = scan_and_build_registry(files_to_compile, vault_root)
 
         # --- 临时调试代码 ---
-        import json
         debug_registry_path = output_dir / "debug_link_registry.json"
         with open(debug_registry_path, 'w', encoding='utf-8') as f:
             json.dump(link_registry, f, indent=2, ensure_ascii=False)
@@ -351,77 +581,163 @@ def run_batch_compilation(config):
     # 这个 map 现在可以存储 PDF 路径（独立模式）或 TeX 路径（图书模式）
     compiled_output_map = {}
 
-    manager = multiprocessing.Manager()
-    log_queue = manager.Queue()
+    # Linux 上使用 fork：子进程通过写时复制直接共享父进程的内存页，
+    # 链接注册表放进模块全局变量后无需序列化；其他平台仍使用 spawn 并重新传入。
+    # fork 只在进程中还没有其他线程时进行，见下面进程池的启动
+    use_fork = sys.platform.startswith('linux')
+    ctx = multiprocessing.get_context("fork" if use_fork else "spawn")
+    global _LINK_REGISTRY
+    _LINK_REGISTRY = link_registry if is_book_mode else None
+
+    # 直接使用基于管道的队列，不再经过 Manager 服务进程的代理
+    log_queue = ctx.Queue()
     temp_dir_root = get_temp_dir()
-    max_workers = max(1, os.cpu_count() - 2)
+    # 默认保留两个核心给系统和 XeLaTeX 之外的工作，可以在配置中用 jobs 覆盖
+    max_workers = config.jobs or max(1, (os.cpu_count() or 1) - 2)
     max_name_length = max(len(p.stem) for p in files_to_compile) if files_to_compile else 0
 
+    # 本次构建开始的时间；构建之后，从这以后没有用到的 token 缓存会被删除
+    build_started = time.time()
+
+    # 增量编译缓存：源文件和构建环境都没变的文件直接复用上次的结果，不再交给进程池
+    cache_dir = output_dir / BUILD_CACHE_DIRNAME
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_suffix = '.tex' if is_book_mode else '.pdf'
+    fingerprint = compute_build_fingerprint(config, is_book_mode, _LINK_REGISTRY, files_to_compile)
+    cache_keys = {}  # {md_path: 缓存键}，只记录需要编译、编译成功后写入缓存的文件
+    live_cache_keys = set()  # 本次构建中所有笔记的缓存键，其余的缓存文件在构建后删除
+
+    # 独立模式下，每个 PDF 一编译完就在后台线程中复制到输出目录，
+    # 与仍在进行的编译重叠，而不是等所有文件都编译完再统一复制
+    copy_executor = None if is_book_mode else ThreadPoolExecutor(max_workers=2)
+    copy_futures = []
+    vault_prefix = str(vault_root).rstrip(os.sep) + os.sep
+
+    def schedule_copy(md_path: Path, src_pdf_path: Path):
+        if copy_executor is not None:
+            copy_futures.append(copy_executor.submit(
+                _copy_pdf_to_output, md_path, src_pdf_path, vault_prefix, individual_pdf_dir
+            ))
+
     try:
-        with tqdm(total=len(files_to_compile), desc="Processing", unit="file") as pbar:
-            log_thread = threading.Thread(target=logger_thread_worker, args=(log_queue, pbar))
-            log_thread.start()
-
-            with ProcessPoolExecutor(max_workers=max_workers) as executor:
-                futures = {}
-                for md_path in files_to_compile:
-                    worker_temp_dir = temp_dir_root / str(uuid.uuid4())
-                    worker_temp_dir.mkdir()
-
-                    ### BOOK MODE CHANGE ###
-                    # 决定 worker 的目标输出目录
-                    # 图书模式下，worker 直接输出到共享的 tex_chapters_dir
-                    # 独立模式下，worker 输出到它自己的临时目录
-                    output_target_dir = tex_chapters_dir if is_book_mode else worker_temp_dir
-
-                    # def compile_single_file_worker(md_path: Path,
-                    #                                config,
-                    #                                temp_dir: Path,
-                    #                                log_queue: multiprocessing.Queue,
-                    #                                # --- 新增参数 ---
-                    #                                is_book_mode: bool,
-                    #                                output_target_dir: Path,
-                    #                                max_name_length: int = 18):
-
-                    # 提交任务，传递新的参数来控制行为
-                    future = executor.submit(
-                        compile_single_file_worker,
-                        md_path,
-                        config,
-                        worker_temp_dir,
-                        log_queue,
-                        is_book_mode,
-                        output_target_dir,
-                        link_registry,
-                        build_assets_dir,
-                        max_name_length,
-                        post_processors,
-                        pre_processors
-                    )
-                    ### END BOOK MODE CHANGE ###
-                    futures[future] = md_path
+        # 准备所有任务参数；任务元组里只有每个文件各自不同的部分。
+        # 共享的对象 (config、链接注册表、资源目录、处理器列表等)
+        # 通过 initializer 在每个工作进程中只传递一次
+        tasks = []
+        cached_hits = []  # [(md_path, 缓存中的结果路径)]，复制任务在进程池启动后才提交
+        # temp_dir_root 本身已经以 uuid 命名，子目录只需在本次运行内唯一，用计数器即可
+        temp_dir_counter = itertools.count()
+        for md_path in files_to_compile:
+            cache_key = compute_cache_key(md_path, fingerprint, vault_root, is_book_mode)
+            if cache_key is not None:
+                live_cache_keys.add(cache_key)
+                cached_path = cache_dir / f"{cache_key}{cache_suffix}"
+                if cached_path.is_file():
+                    if is_book_mode:
+                        result_path = _store_chapter_tex(tex_chapters_dir, cached_path.read_bytes())
+                    else:
+                        # 独立模式下，直接从缓存中复制 PDF
+                        result_path = cached_path
+                    compiled_output_map[md_path] = result_path
+                    cached_hits.append((md_path, result_path))
+                    successful_compilations.append(md_path)
+                    continue
+                cache_keys[md_path] = cache_key
+
+            worker_temp_dir = temp_dir_root / f"{next(temp_dir_counter):06d}"
+            worker_temp_dir.mkdir()
+
+            ### BOOK MODE CHANGE ###
+            # 决定 worker 的目标输出目录
+            # 图书模式下，worker 直接输出到共享的 tex_chapters_dir
+            # 独立模式下，worker 输出到它自己的临时目录
+            output_target_dir = tex_chapters_dir if is_book_mode else worker_temp_dir
+            ### END BOOK MODE CHANGE ###
+
+            tasks.append((
+                md_path,
+                worker_temp_dir,
+                output_target_dir,
+            ))
+
+        # 常驻进程池：每个工作进程启动时构建一次编译器，之后复用。
+        # 使用 ProcessPoolExecutor 而不是 multiprocessing.Pool：工作进程意外退出时
+        # (os._exit、OOM、C 扩展崩溃)，前者让未完成的任务抛出 BrokenProcessPool，
+        # 后者会悄悄替换进程并丢掉它的任务，使整个批次永远等待下去
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=ctx,
+            initializer=_worker_init,
+            initargs=(
+                config,
+                None if use_fork else _LINK_REGISTRY,
+                build_assets_dir,
+                is_book_mode,
+                max_name_length,
+                log_queue,
+                pre_processors,
+                post_processors,
+            ),
+        ) as executor:
+            # fork 上下文下，第一次 submit 就会启动全部工作进程。所有任务都在启动
+            # 日志线程、进度条 (tqdm 的监视线程) 和复制线程之前提交，fork 时进程中只有主线程
+            futures = {
+                executor.submit(compile_single_file_worker, *task): task[0]
+                for task in tasks
+            }
+
+            with tqdm(total=len(files_to_compile), desc="Processing", unit="file") as pbar:
+                log_thread = threading.Thread(target=logger_thread_worker, args=(log_queue, pbar))
+                log_thread.start()
+
+                for md_path, result_path in cached_hits:
+                    schedule_copy(md_path, result_path)
+                if cached_hits:
+                    pbar.update(len(cached_hits))
+                    pbar.write(f"♻️  Reused {len(cached_hits)} unchanged file(s) from the build cache.")
 
                 for future in as_completed(futures):
                     original_md_path = futures[future]
                     try:
-                        # worker 现在返回 (源md路径, 最终输出路径)
+                        # worker 返回 (源md路径, 最终输出路径)
                         # 输出路径是 .pdf (独立模式) 或 .tex (图书模式)
+                        # compile_single_file_worker 内部捕获所有异常，失败时返回 None
                         md_path, result_path = future.result()
-
-                        if result_path:
-                            compiled_output_map[md_path] = result_path
-                            successful_compilations.append(md_path)
-                        else:
-                            failed_compilations.append(md_path)
                     except Exception as e:
-                        failed_compilations.append(original_md_path)
+                        # 工作进程本身崩溃 (BrokenProcessPool 等)，记为失败
+                        md_path, result_path = original_md_path, None
                         log_queue.put(f"[run_batch_compilation] FATAL ERROR for {original_md_path.name}: {e}")
 
-                    pbar.set_postfix_str(f"{original_md_path.stem}", refresh=True)
+                    if result_path:
+                        compiled_output_map[md_path] = result_path
+                        schedule_copy(md_path, result_path)
+                        successful_compilations.append(md_path)
+                        if md_path in cache_keys:
+                            try:
+                                store_cached_output(cache_dir, cache_keys[md_path], cache_suffix, result_path)
+                            except OSError as e:
+                                pbar.write(f"Warning: Could not cache the output of {md_path.name}: {e}")
+                    else:
+                        failed_compilations.append(md_path)
+
+                    pbar.set_postfix_str(f"{md_path.stem}", refresh=True)
                     pbar.update(1)
 
-            log_queue.put(None)
-            log_thread.join()
+                log_queue.put(None)
+                log_thread.join()
+
+        prune_build_cache(cache_dir, cache_suffix, live_cache_keys)
+        aux_cache_dir = cache_dir / XELATEX_AUX_CACHE_DIRNAME
+        if aux_cache_dir.is_dir():
+            live_note_keys = {compute_note_key(md_path, vault_root) for md_path in files_to_compile}
+            for suffix in XELATEX_AUX_SUFFIXES:
+                prune_build_cache(aux_cache_dir, suffix, live_note_keys)
+        token_cache_dir = cache_dir / TOKEN_CACHE_DIRNAME
+        if token_cache_dir.is_dir():
+            # 嵌入了其他笔记的文件从不命中编译缓存，每次都会重新编译，
+            # 因此本次没有用到的 token 缓存不再被任何笔记引用
+            from .content_extractor import prune_token_cache
+            prune_token_cache(token_cache_dir, build_started - TOKEN_CACHE_MTIME_SLACK)
 
         # --- 后处理步骤 ---
         print("\nAll files processed. Starting post-compilation tasks...")
@@ -431,6 +747,7 @@ def run_batch_compilation(config):
             # 图书模式的后处理：调用 book_builder
             if successful_compilations:
                 # compiled_output_map 包含 {md_path: tex_path} 的映射
+                _write_chapter_manifest(tex_chapters_dir, compiled_output_map, vault_root)
                 sorter_func = load_sorter_from_file(config.sorting_script)
                 #print(sorter_func)
                 build_book(config, compiled_output_map, sorter_func)
@@ -438,18 +755,16 @@ def run_batch_compilation(config):
                 print("No chapters were successfully compiled. Skipping book generation.")
         else:
             # 独立文件模式的后处理：复制和合并 PDF
-            print("\nCopying compiled PDFs to output directory...")
-            for md_path, src_pdf_path in tqdm(compiled_output_map.items(), desc="Copying", unit="file"):
-                relative_path = md_path.relative_to(vault_root)
-                output_pdf_path = (individual_pdf_dir / relative_path).with_suffix(".pdf")
-                output_pdf_path.parent.mkdir(parents=True, exist_ok=True)
-                # 在独立模式下，src_pdf_path 是在临时目录里，需要 shutil.move 或 copy
-                shutil.copy(src_pdf_path, output_pdf_path)
+            # 大部分 PDF 在编译过程中就已经复制完了，这里只需等待剩下的
+            print("\nFinishing copying compiled PDFs to output directory...")
+            copy_executor.shutdown(wait=True)
+            for future in copy_futures:
+                future.result()  # 如果复制失败，在这里抛出异常
 
             if config.enable_simple_merge and compiled_output_map:
                 # 注意：这里的 compiled_output_map 的值是临时文件路径，我们需要使用复制后的路径
                 pdfs_to_merge = [
-                    (individual_pdf_dir / p.relative_to(vault_root)).with_suffix(".pdf")
+                    _output_pdf_path(p, vault_prefix, individual_pdf_dir)
                     for p in successful_compilations
                 ]
                 vault_name = vault_root.name
@@ -472,6 +787,9 @@ def run_batch_compilation(config):
     finally:
         # --- 7. 最终清理 ---
         print("Cleaning up temporary files...")
+        # 删除临时目录之前，确保没有复制任务还在读取其中的 PDF
+        if copy_executor is not None:
+            copy_executor.shutdown(wait=True, cancel_futures=True)
         shutil.rmtree(temp_dir_root, ignore_errors=True)
 
         # =================================================================
@@ -505,6 +823,79 @@ def run_batch_compilation(config):
         # =================================================================
 
 
+# 失败时只需要 XeLaTeX 输出的末尾部分来定位错误 (-halt-on-error 会在出错处停止)
+XELATEX_TAIL_LINES = 2000
+
+
+# 第二遍编译读取第一遍写出的这些辅助文件 (交叉引用、目录、hyperref 书签)
+XELATEX_AUX_SUFFIXES = ('.aux', '.toc', '.out')
+# 构建缓存中保存每个笔记辅助文件的子目录
+XELATEX_AUX_CACHE_DIRNAME = "aux"
+# 构建缓存中保存被嵌入笔记解析结果的子目录
+TOKEN_CACHE_DIRNAME = "tokens"
+# 文件系统的时间戳精度可能只有几秒，比较修改时间时留出余量
+TOKEN_CACHE_MTIME_SLACK = 2.0
+
+
+def _hash_aux_files(tex_path: Path, working_dir: Path) -> bytes:
+    """计算所有辅助文件内容的摘要；文件不存在时也参与摘要，保证与存在时不同。"""
+    digest = hashlib.blake2b()
+    for suffix in XELATEX_AUX_SUFFIXES:
+        aux_path = working_dir / tex_path.with_suffix(suffix).name
+        try:
+            digest.update(aux_path.read_bytes())
+            digest.update(b'\x00present')
+        except FileNotFoundError:
+            digest.update(b'\x00missing')
+    return digest.digest()
+
+
+def _restore_note_aux(tex_path: Path, aux_key: str):
+    """
+    把该笔记上次成功编译时的辅助文件复制到 (新建的) 工作目录中。
+    第一遍就能读到上次的目录和引用，如果它写出的辅助文件与读入的完全相同，
+    run_xelatex 会跳过第二遍。
+    """
+    if _AUX_CACHE_DIR is None:
+        return
+    for suffix in XELATEX_AUX_SUFFIXES:
+        try:
+            shutil.copyfile(_AUX_CACHE_DIR / f"{aux_key}{suffix}", tex_path.with_suffix(suffix))
+        except OSError:
+            pass
+
+
+def _store_note_aux(tex_path: Path, aux_key: str):
+    """编译成功后，用本次的辅助文件替换该笔记的缓存。"""
+    if _AUX_CACHE_DIR is None:
+        return
+    for suffix in XELATEX_AUX_SUFFIXES:
+        aux_path = tex_path.with_suffix(suffix)
+        try:
+            if aux_path.is_file():
+                store_cached_output(_AUX_CACHE_DIR, aux_key, suffix, aux_path)
+            else:
+                (_AUX_CACHE_DIR / f"{aux_key}{suffix}").unlink(missing_ok=True)
+        except OSError:
+            # 缓存只影响速度，写入失败时下次多编译一遍即可
+            pass
+
+
+def _run_xelatex_pass(command: list[str], working_dir: Path) -> tuple[int, str]:
+    """
+    运行一遍 XeLaTeX，边读边丢弃它的输出，只在环形缓冲区中保留最后几行。
+    成功的编译不再在内存中缓存完整的输出。返回 (返回码, 输出末尾)。
+    """
+    with subprocess.Popen(
+        command, cwd=working_dir,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        text=True, encoding='utf-8', errors='replace'
+    ) as process:
+        tail = collections.deque(process.stdout, maxlen=XELATEX_TAIL_LINES)
+        returncode = process.wait()
+    return returncode, "".join(tail)
+
+
 def run_xelatex(
         tex_path: Path,
         working_dir: Path,
@@ -542,32 +933,35 @@ def run_xelatex(
 
         # --- Pass 1 ---
         logger(f"  - Running XeLaTeX pass 1/2...")
-        result1 = subprocess.run(
-            command, cwd=working_dir, capture_output=True, text=True, encoding='utf-8'
-        )
+        aux_hash_before = _hash_aux_files(tex_path, working_dir)
+        returncode1, output1 = _run_xelatex_pass(command, working_dir)
 
-        if result1.returncode != 0:
+        if returncode1 != 0:
             logger(f"  - Pass 1 failed on attempt {attempt}.")
-            last_error_output = result1.stdout
+            last_error_output = output1
             continue  # Move to the next retry attempt
 
-        # --- Proactive Delay to prevent race condition ---
-        # Give the filesystem a moment to sync the .aux file before pass 2 reads it.
-        time.sleep(0.1)
+        # 第一遍读入的辅助文件 (由调用者从上次的编译结果中恢复) 与它写出的完全相同，
+        # 说明引用已经稳定，第二遍不会改变结果
+        if _hash_aux_files(tex_path, working_dir) == aux_hash_before:
+            logger(f"  - Auxiliary files are stable, skipping pass 2/2.")
+            logger(f"✅ XeLaTeX compilation for {tex_path.name} completed successfully on attempt {attempt}.")
+            return True
+
+        # No delay is needed before pass 2: Popen.wait() has already returned, so
+        # XeLaTeX has exited and closed the .aux file.
 
         # --- Pass 2 ---
         logger(f"  - Running XeLaTeX pass 2/2...")
-        result2 = subprocess.run(
-            command, cwd=working_dir, capture_output=True, text=True, encoding='utf-8'
-        )
+        returncode2, output2 = _run_xelatex_pass(command, working_dir)
 
-        if result2.returncode == 0:
+        if returncode2 == 0:
             logger(f"✅ XeLaTeX compilation for {tex_path.name} completed successfully on attempt {attempt}.")
             return True  # Success!
 
         # If we are here, pass 2 failed
         logger(f"  - Pass 2 failed on attempt {attempt}.")
-        last_error_output = result2.stdout
+        last_error_output = output2
         # The loop will naturally continue to the next attempt
 
     # If the loop completes without returning True, all attempts have failed
@@ -18,16 +18,21 @@
     along with OFMC. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import hashlib
+import os
+import shutil
 import subprocess
+import time
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Callable
+from typing import Callable, TextIO
 
 from .utils import get_shared_latex_preamble, extract_relevant_latex_error
 from .config import Config
+from .build_cache import BUILD_CACHE_DIRNAME
 
 import re
-from alive_progress import alive_bar
-from tqdm import tqdm
 
 def build_book(cfg: Config, compiled_tex_files: dict, sorter_func: Callable):
     """
@@ -39,53 +44,235 @@ def build_book(cfg: Config, compiled_tex_files: dict, sorter_func: Callable):
     """
     print("📖 Starting book compilation...")
 
-    master_tex_content = generate_master_tex(cfg, compiled_tex_files, sorter_func)
-
     master_tex_path = cfg.output_dir / "_master_book.tex"
     final_pdf_name = Path(cfg.book_title.replace(" ", "_")).with_suffix('.pdf').name
     final_pdf_path = cfg.output_dir / final_pdf_name
 
+    # 主 TeX 文件边生成边写入磁盘，不在内存中拼出完整内容
     with open(master_tex_path, "w", encoding="utf-8") as f:
-        f.write(master_tex_content)
+        generate_master_tex(cfg, compiled_tex_files, sorter_func, f)
 
     print(f"Master TeX file created at: {master_tex_path}")
     print("Running XeLaTeX to build the book (this may take a while)...")
 
+    # 辅助文件缓存：主文件 (包含共享导言区) 和所有章节都与上次成功构建相同时，
+    # 恢复上次最终的 .aux/.toc 等文件，交叉引用在第一遍就已经解析好了
+    chapter_tex_paths = sorted(compiled_tex_files.values())
+    inputs_hash = _hash_book_inputs(master_tex_path.read_bytes(), chapter_tex_paths)
+    aux_cache_dir = cfg.output_dir / BUILD_CACHE_DIRNAME / "book_aux"
+    aux_files = _book_aux_files(master_tex_path)
+
+    # 整本书的 PDF 缓存：所有输入 (以及引用的图片、当天日期) 都与某次成功构建相同时，
+    # 直接复制那次的 PDF，完全不运行 XeLaTeX
+    pdf_cache_dir = cfg.output_dir / BUILD_CACHE_DIRNAME / "books"
+    cached_pdf_path = pdf_cache_dir / f"{_hash_book_pdf_inputs(inputs_hash, master_tex_path, chapter_tex_paths)}.pdf"
+    if _restore_cached_book_pdf(cached_pdf_path, final_pdf_path):
+        print(f"♻️  Book inputs unchanged, reused the cached PDF: {final_pdf_path}")
+        return
+
+    restored = _restore_aux_cache(aux_cache_dir, inputs_hash, cfg.output_dir)
+
     # LaTeX 需要多次编译以生成目录和交叉引用
     # =========================================================================
     #  核心改动：使用新的带进度条的编译函数
     # =========================================================================
-    total_passes = 3
-    for i in range(total_passes):
+    # 最多编译 max_passes 遍，但只要某一遍前后辅助文件完全相同 (达到不动点)，
+    # 交叉引用和目录就已经稳定，后面的编译不会再改变结果，可以提前结束
+    max_passes = 3
+    if restored:
+        print("♻️  Book inputs unchanged, restored cached auxiliary files: a single pass should be enough.")
+
+    pass_num = 0
+    aux_hash = _hash_files(aux_files)
+    while pass_num < max_passes:
+        pass_num += 1
         # 调用我们的新函数
         success, log_output = _run_latex_pass_with_progress(
             tex_file=master_tex_path,
             output_dir=cfg.output_dir,
-            pass_num=i + 1,
-            total_passes=total_passes
+            pass_num=pass_num,
+            total_passes=max_passes
         )
 
         if not success:
-            print(f"\n❌ XeLaTeX compilation failed on pass {i + 1}.")
+            print(f"\n❌ XeLaTeX compilation failed on pass {pass_num}.")
             print("--- Relevant XeLaTeX Log ---")
             # 假设您有一个 extract_relevant_latex_error 函数
             print(extract_relevant_latex_error(log_output))
             print(f"Full log can be found in: {master_tex_path.with_suffix('.log')}")
             return  # 编译失败，提前退出
 
+        new_aux_hash = _hash_files(aux_files)
+        if new_aux_hash == aux_hash:
+            if pass_num < max_passes:
+                print(f"  Auxiliary files are stable after pass {pass_num}, skipping the remaining passes.")
+            break
+        aux_hash = new_aux_hash
+
     # =========================================================================
 
+    _store_aux_cache(aux_cache_dir, inputs_hash, cfg.output_dir, aux_files)
 
-    # 重命名最终的 PDF
+    # XeLaTeX 使用固定的 ASCII jobname (_master_book)，不受书名中非 ASCII 或特殊字符的影响，
+    # 辅助文件缓存也依赖这个固定的文件名；编译完成后再把 PDF 重命名为书名
     source_pdf = master_tex_path.with_suffix('.pdf')
     if source_pdf.exists():
-        source_pdf.rename(final_pdf_path)
+        os.replace(source_pdf, final_pdf_path)
+        _store_cached_book_pdf(final_pdf_path, cached_pdf_path)
         print(f"✅ Book successfully compiled: {final_pdf_path}")
     else:
         print("❌ Final PDF not found after compilation.")
 
-def generate_master_tex(cfg: Config, compiled_tex_files: dict, sorter_func: Callable) -> str:
-    """Generates the content for the master TeX file."""
+# 多遍编译之间传递信息的辅助文件 (交叉引用、目录、书签、图表目录、参考文献)
+BOOK_AUX_SUFFIXES = ('.aux', '.toc', '.out', '.lof', '.lot', '.bbl', '.bcf')
+# 记录缓存对应的输入摘要的文件名
+_AUX_CACHE_KEY_FILE = "inputs.hash"
+
+
+def _hash_book_inputs(master_tex_bytes: bytes, chapter_tex_paths: list[Path]) -> str:
+    """主 TeX 文件 (已包含共享导言区) 和所有章节 .tex 内容的摘要。"""
+    digest = hashlib.sha256(master_tex_bytes)
+    for tex_path in chapter_tex_paths:
+        digest.update(tex_path.name.encode('utf-8') + b'\x00')
+        try:
+            digest.update(tex_path.read_bytes())
+        except OSError:
+            digest.update(b'\x00missing')
+    return digest.hexdigest()
+
+
+# 整本书的 PDF 缓存最多保留的份数 (按最近使用时间淘汰)
+BOOK_PDF_CACHE_SIZE = 5
+# 主文件和章节中引用的图片 (封面、banner、build_assets 中的图片都是绝对路径)
+_INCLUDEGRAPHICS_RE = re.compile(rb"\\includegraphics(?:\[[^\]]*\])?\{([^}]*)\}")
+
+
+def _hash_book_pdf_inputs(inputs_hash: str, master_tex_path: Path, chapter_tex_paths: list[Path]) -> str:
+    """
+    PDF 缓存的键：在 TeX 输入的摘要之上，再加入被引用图片的大小和修改时间，
+    以及当天的日期 (标题页使用 \\today)。
+    """
+    digest = hashlib.sha256(inputs_hash.encode('ascii'))
+    digest.update(date.today().isoformat().encode('ascii'))
+    for tex_path in [master_tex_path, *chapter_tex_paths]:
+        try:
+            content = tex_path.read_bytes()
+        except OSError:
+            continue
+        for match in _INCLUDEGRAPHICS_RE.finditer(content):
+            digest.update(match.group(1) + b'\x00')
+            try:
+                st = os.stat(match.group(1))
+                digest.update(f"{st.st_size}:{st.st_mtime_ns}".encode('ascii'))
+            except OSError:
+                digest.update(b'missing')
+    return digest.hexdigest()
+
+
+def _restore_cached_book_pdf(cached_pdf_path: Path, final_pdf_path: Path) -> bool:
+    """缓存命中时把 PDF 复制到最终位置，并刷新它的使用时间。"""
+    if not cached_pdf_path.is_file():
+        return False
+    try:
+        # 使用复制而不是硬链接：之后的构建会原地覆盖最终的 PDF，硬链接会把缓存一起改掉
+        shutil.copyfile(cached_pdf_path, final_pdf_path)
+        os.utime(cached_pdf_path)
+    except OSError:
+        return False
+    return True
+
+
+def _store_cached_book_pdf(final_pdf_path: Path, cached_pdf_path: Path):
+    """把成功构建的 PDF 放入缓存，只保留最近使用的 BOOK_PDF_CACHE_SIZE 份。"""
+    cache_dir = cached_pdf_path.parent
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cached_pdf_path.with_suffix(f".{os.getpid()}.tmp")
+        shutil.copyfile(final_pdf_path, tmp_path)
+        os.replace(tmp_path, cached_pdf_path)
+
+        # 很多文件系统不更新 atime，命中时用 os.utime 刷新 mtime，按 mtime 淘汰
+        cached = sorted(cache_dir.glob("*.pdf"), key=lambda p: p.stat().st_mtime_ns, reverse=True)
+        for stale in cached[BOOK_PDF_CACHE_SIZE:]:
+            stale.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"⚠️  Warning: Could not update the book PDF cache: {e}")
+
+
+def _book_aux_files(master_tex_path: Path) -> list[Path]:
+    """主文件的辅助文件；章节通过 \\input 引入，没有各自的 .aux。"""
+    return [master_tex_path.with_suffix(suffix) for suffix in BOOK_AUX_SUFFIXES]
+
+
+def _hash_files(paths: list[Path]) -> bytes:
+    """一组文件内容的摘要；文件是否存在也参与摘要。"""
+    digest = hashlib.blake2b()
+    for path in paths:
+        try:
+            digest.update(path.read_bytes())
+            digest.update(b'\x00present')
+        except OSError:
+            digest.update(b'\x00missing')
+    return digest.digest()
+
+
+def _restore_aux_cache(cache_dir: Path, inputs_hash: str, output_dir: Path) -> bool:
+    """如果缓存对应的输入与本次相同，把缓存的辅助文件复制回输出目录。"""
+    key_file = cache_dir / _AUX_CACHE_KEY_FILE
+    try:
+        if key_file.read_text(encoding='utf-8') != inputs_hash:
+            return False
+    except OSError:
+        return False
+
+    for cached in cache_dir.rglob("*"):
+        if cached.is_file() and cached != key_file:
+            target = output_dir / cached.relative_to(cache_dir)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(cached, target)
+    return True
+
+
+def _store_aux_cache(cache_dir: Path, inputs_hash: str, output_dir: Path, aux_files: list[Path]):
+    """成功构建后，用本次的辅助文件替换缓存。"""
+    try:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        for aux_path in aux_files:
+            if aux_path.is_file():
+                target = cache_dir / aux_path.relative_to(output_dir)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(aux_path, target)
+        # 最后写入摘要，保证缓存只有在完整写入后才会被使用
+        (cache_dir / _AUX_CACHE_KEY_FILE).write_text(inputs_hash, encoding='utf-8')
+    except OSError as e:
+        print(f"⚠️  Warning: Could not update the auxiliary file cache: {e}")
+
+
+def _compute_sort_keys(md_files: list[Path], sorter_func: Callable) -> dict:
+    """
+    Computes the sort key of every file up front.
+
+    Sorting scripts typically open each note to read its metadata, so the
+    calls are I/O-bound and are run concurrently in a thread pool.
+    """
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(md_files, executor.map(sorter_func, md_files)))
+
+def generate_master_tex(cfg: Config, compiled_tex_files: dict, sorter_func: Callable, out_fp: TextIO):
+    """Generates the content for the master TeX file and writes it line by line to out_fp."""
+
+    def emit(line: str):
+        out_fp.write(line)
+        out_fp.write("\n")
+
+    def emit_chapter(tex_path: Path):
+        # 不使用 \include (它会为每个章节单独打开、写出一个 .aux)，
+        # 而是 \clearpage + \input，保留分页的效果
+        # \input 需要相对于 master.tex 的路径，我们让它们都在 output_dir
+        emit("\\clearpage")
+        emit(f"\\input{{tex_chapters/{tex_path.name}}}")
 
     if cfg.cover_image:
         if cfg.cover_image.exists():
@@ -120,7 +307,7 @@ def generate_master_tex(cfg: Config, compiled_tex_files: dict, sorter_func: Call
 """
 
     # --- Preamble ---
-    tex = [
+    preamble = [
         # 1. 使用 book 文档类。'twoside' 是书籍印刷的标准，为左右页设置不同页边距。
         r"\documentclass[a4paper, 11pt, twoside]{book}",
 
@@ -145,21 +332,22 @@ def generate_master_tex(cfg: Config, compiled_tex_files: dict, sorter_func: Call
         "\\maketitle",
         "\\tableofcontents",
     ]
+    for line in preamble:
+        emit(line)
 
     # --- Front Matter ---
     if cfg.front_matter:
-        tex.append("% --- Front Matter ---")
+        emit("% --- Front Matter ---")
         for md_path_str in cfg.front_matter:
             md_path = cfg.vault_root / md_path_str
             tex_path = compiled_tex_files.get(md_path)
             if tex_path:
-                # \include 需要相对于 master.tex 的路径，我们让它们都在 output_dir
-                tex.append(f"\\include{{tex_chapters/{tex_path.name}}}")
+                emit_chapter(tex_path)
             else:
                 print(f"⚠️  Warning: Front matter file not found in compiled files: {md_path_str}")
 
     # --- Main Matter (Table of Contents, Parts, Chapters) ---
-    tex.append("\\mainmatter")
+    emit("\\mainmatter")
 
     # 解析 book_parts
     for part_item in cfg.book_parts:
@@ -168,7 +356,7 @@ def generate_master_tex(cfg: Config, compiled_tex_files: dict, sorter_func: Call
         else:  # 是 [path, title] 格式
             part_dir, part_title = part_item
 
-        tex.append(f"\\part{{{part_title}}}")
+        emit(f"\\part{{{part_title}}}")
 
         # 找到这个 part 目录下的所有 md 文件并排序
         part_full_path = cfg.vault_root / part_dir
@@ -182,9 +370,13 @@ def generate_master_tex(cfg: Config, compiled_tex_files: dict, sorter_func: Call
 
             # 步骤 2: 根据 sorter_func 是否存在，应用不同的排序策略
             if sorter_func:
-                # 如果自定义排序函数存在，就用它作为排序的 `key`
-                # .sort() 方法会就地修改列表
-                md_files_in_part.sort(key=sorter_func)
+                # 如果自定义排序函数存在，先并发算出每个文件的 key，再排序
+                # (每个文件只调用一次 sorter_func，排序时只查表)
+                # .sort() 方法会就地修改列表；先按字母排序，key 相同的章节
+                # 顺序就不再取决于 glob 返回的目录顺序，主 TeX 文件在多次构建间保持一致
+                sort_keys = _compute_sort_keys(md_files_in_part, sorter_func)
+                md_files_in_part.sort()
+                md_files_in_part.sort(key=sort_keys.__getitem__)
             else:
                 # 如果不存在，就回退到默认的按字母排序
                 md_files_in_part.sort()
@@ -192,7 +384,7 @@ def generate_master_tex(cfg: Config, compiled_tex_files: dict, sorter_func: Call
             for md_path in md_files_in_part:
                 tex_path = compiled_tex_files.get(md_path)
                 if tex_path:
-                    tex.append(f"\\include{{tex_chapters/{tex_path.name}}}")
+                    emit_chapter(tex_path)
                 #else:
                     #print(f"⚠️  Warning: Chapter file not found in compiled files: {md_path}")
 
@@ -201,21 +393,45 @@ def generate_master_tex(cfg: Config, compiled_tex_files: dict, sorter_func: Call
 
     # --- Back Matter ---
     if cfg.back_matter:
-        tex.append("\\backmatter")
-        tex.append("% --- Back Matter ---")
+        emit("\\backmatter")
+        emit("% --- Back Matter ---")
         for md_path_str in cfg.back_matter:
             md_path = cfg.vault_root / md_path_str
             tex_path = compiled_tex_files.get(md_path)
             if tex_path:
-                tex.append(f"\\include{{tex_chapters/{tex_path.name}}}")
+                emit_chapter(tex_path)
             else:
                 print(f"⚠️  Warning: Back matter file not found in compiled files: {md_path_str}")
 
-    tex.append("\\end{document}")
-    return "\n".join(tex)
+    emit("\\end{document}")
 
 
-PROGRESS_RE = re.compile(r"PYTEX-PROGRESS-SIGNAL\s+(\d+)(?:\s+of\s+(\d+))?")
+# 以字节形式匹配，XeLaTeX 的输出不必逐行解码
+PROGRESS_MARKER = b"PYTEX-PROGRESS-SIGNAL"
+PROGRESS_RE = re.compile(rb"PYTEX-PROGRESS-SIGNAL\s+(\d+)(?:\s+of\s+(\d+))?")
+# 每次从管道读取的字节数
+_READ_CHUNK_SIZE = 65536
+# 进度条的最短刷新间隔 (秒)
+UI_UPDATE_INTERVAL = 0.05
+
+
+def _iter_output_lines(stream, log_chunks: list[bytes]):
+    """
+    以大块读取子进程的原始输出并按行切分，逐行产出 bytes。
+    读到的原始数据同时追加到 log_chunks 中，供失败时输出日志。
+    """
+    fd = stream.fileno()
+    pending = b""
+    while True:
+        chunk = os.read(fd, _READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        log_chunks.append(chunk)
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
 
 
 def _run_latex_pass_with_progress(
@@ -224,6 +440,12 @@ def _run_latex_pass_with_progress(
         pass_num: int,
         total_passes: int
 ) -> tuple[bool, str]:
+    """
+    运行一遍 XeLaTeX 并显示按页的进度条。
+    返回 (是否成功, 日志)；日志只在失败时才被解码，成功时为空字符串。
+    """
+    from tqdm import tqdm
+
     command = ["xelatex", "-interaction=nonstopmode", "-shell-escape", tex_file.name]
 
     process = subprocess.Popen(
@@ -231,18 +453,26 @@ def _run_latex_pass_with_progress(
         cwd=output_dir,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
-        encoding='utf-8',
-        errors='ignore'
     )
 
     full_log = []
 
+    def finish() -> tuple[bool, str]:
+        process.stdout.close()
+        return_code = process.wait()
+        if return_code == 0:
+            return True, ""
+        return False, b"".join(full_log).decode('utf-8', errors='ignore')
+
+    lines = _iter_output_lines(process.stdout, full_log)
+
     # --- 阶段 1: 侦察 ---
     first_page = None
     total_pages = None
-    for line in iter(process.stdout.readline, ''):
-        full_log.append(line)
+    for line in lines:
+        # 绝大多数行不包含进度信号，先用廉价的子串查找排除它们
+        if PROGRESS_MARKER not in line:
+            continue
         match = PROGRESS_RE.search(line)
         if match:
             first_page = int(match.group(1))
@@ -252,46 +482,47 @@ def _run_latex_pass_with_progress(
 
     if first_page is None:
         print(f"\n[Warning] Pass {pass_num}: No progress signals received. Maybe a quick pass or an error.")
-        process.stdout.close()
-        return_code = process.wait()
-        return return_code == 0, "".join(full_log)
+        return finish()
 
     # --- 阶段 2: 执行 ---
-    bar_style = "smooth" if total_pages else "classic"
-
-    with alive_bar(
+    # tqdm 没有后台动画线程，mininterval 让刷新频率与信号频率无关
+    with tqdm(
             total=total_pages,
-            title=f"  Pass {pass_num}/{total_passes}",
-            spinner="waves2",
-            length=40,
-            bar=bar_style
+            desc=f"  Pass {pass_num}/{total_passes}",
+            unit="pg",
+            mininterval=0.25
     ) as bar:
 
         last_known_page = 0
+        # 已收到但尚未推送到进度条的最新页码
+        pending_page = 0
+        last_ui_update = time.monotonic()
 
         # --- 核心逻辑: 增量更新 ---
-        def update_progress(page):
+        def flush_progress():
             nonlocal last_known_page
             # 确保页码是前进的，防止意外情况
-            if page > last_known_page:
-                increment = page - last_known_page
-                bar(increment)
-                last_known_page = page
+            if pending_page > last_known_page:
+                bar.update(pending_page - last_known_page)
+                last_known_page = pending_page
 
         # 手动处理第一个信号
-        bar.text(f"Page {first_page} of {total_pages or '...'}")
-        update_progress(first_page)
+        pending_page = first_page
+        flush_progress()
 
-        # 处理剩余的输出流
-        for line in iter(process.stdout.readline, ''):
-            full_log.append(line)
+        # 处理剩余的输出流；相邻的页码信号合并，最多每 UI_UPDATE_INTERVAL 秒推送一次
+        for line in lines:
+            if PROGRESS_MARKER not in line:
+                continue
             match = PROGRESS_RE.search(line)
             if match:
-                current_page = int(match.group(1))
-                bar.text(f"Page {current_page} of {total_pages or '...'}")
-                update_progress(current_page)
+                pending_page = max(pending_page, int(match.group(1)))
+                now = time.monotonic()
+                if now - last_ui_update >= UI_UPDATE_INTERVAL:
+                    flush_progress()
+                    last_ui_update = now
 
-    process.stdout.close()
-    return_code = process.wait()
+        # 子进程输出结束后推送最后一批页码
+        flush_progress()
 
-    return return_code == 0, "".join(full_log)
\ No newline at end of file
+    return finish()
@@ -0,0 +1,141 @@
+"""
+    OFMC: Obsidian-Flavored Markdown to LaTeX Compiler.
+    Copyright (C) 2025  Nuaptan F. Evalisk = Z. F. Wang
+
+    This file is part of OFMC.
+
+    OFMC is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published
+    by the Free Software Foundation, either version 3 of the License,
+    or (at your option) any later version.
+
+    OFMC is distributed in the hope that it will be useful, but WITHOUT
+    ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+    or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+    License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with OFMC. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# ofmc/build_cache.py
+# 基于内容哈希的增量编译缓存：源文件和构建环境都没变时，直接复用上一次的编译结果。
+
+import hashlib
+import json
+import os
+import shutil
+from datetime import date
+from pathlib import Path
+
+# 缓存目录位于输出目录下
+BUILD_CACHE_DIRNAME = ".ofmc_cache"
+
+
+def _update_with_processors(digest, processors: list[str]):
+    """处理器的名字，以及外部处理器脚本本身的内容，都会影响编译结果。"""
+    for name in processors:
+        digest.update(name.encode('utf-8') + b'\x00')
+        if ":" in name and not name.startswith('$'):
+            script_path = Path(name.split(":", 1)[0])
+            try:
+                digest.update(script_path.read_bytes())
+            except OSError:
+                digest.update(b'\x00missing')
+
+
+def compute_build_fingerprint(config, is_book_mode: bool, link_registry: dict | None,
+                              files_to_compile: list[Path]) -> bytes:
+    """
+    计算本次构建中所有文件共享的那部分输入的摘要：
+    OFMC 自身的源码、编译模式、作者、处理器链、vault 中的文件列表
+    (决定链接能否解析) 以及图书模式下的链接注册表。
+    其中任何一项改变，所有缓存都会失效。
+    """
+    digest = hashlib.blake2b()
+
+    # OFMC 自身的代码 (比版本号更可靠，开发时修改代码也会让缓存失效)
+    package_dir = Path(__file__).parent
+    for source in sorted(package_dir.rglob("*.py")):
+        digest.update(source.relative_to(package_dir).as_posix().encode('utf-8') + b'\x00')
+        digest.update(source.read_bytes())
+
+    digest.update(b'book' if is_book_mode else b'standalone')
+    digest.update(str(config.author).encode('utf-8') + b'\x00')
+
+    digest.update(b'pre\x00')
+    _update_with_processors(digest, config.pre_processors)
+    digest.update(b'post\x00')
+    _update_with_processors(digest, config.post_processors)
+
+    for md_path in files_to_compile:
+        digest.update(md_path.relative_to(config.vault_root).as_posix().encode('utf-8') + b'\x00')
+
+    if link_registry:
+        digest.update(json.dumps(link_registry, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+
+    return digest.digest()
+
+
+def compute_cache_key(md_path: Path, fingerprint: bytes, vault_root: Path, is_book_mode: bool) -> str | None:
+    """
+    返回单个文件的缓存键。
+    文件嵌入了其他笔记或图片 (![[...]]、![...](...)) 或设置了 banner 时，
+    结果还依赖于别的文件的内容，这类文件不缓存，返回 None。
+    """
+    try:
+        content = md_path.read_bytes()
+    except OSError:
+        return None
+
+    if b'![' in content or b'banner:' in content:
+        return None
+
+    digest = hashlib.blake2b(fingerprint)
+    # 标题、章节名和标签都由文件的路径决定，内容相同的两篇笔记也不能共用缓存
+    digest.update(md_path.relative_to(vault_root).as_posix().encode('utf-8') + b'\x00')
+    if not is_book_mode:
+        # 独立 PDF 的标题使用 \date{\today}，日期变了就要重新编译
+        digest.update(date.today().isoformat().encode('ascii'))
+    digest.update(content)
+    return digest.hexdigest()
+
+
+def compute_note_key(md_path: Path, vault_root: Path) -> str:
+    """
+    只由笔记路径决定的键，笔记内容改变时保持不变。
+    用于那些需要取上一次结果作为起点的缓存 (例如 XeLaTeX 的辅助文件)。
+    """
+    rel_path = md_path.relative_to(vault_root).as_posix().encode('utf-8')
+    return hashlib.blake2b(rel_path, digest_size=16).hexdigest()
+
+
+def store_cached_output(cache_dir: Path, cache_key: str, suffix: str, result_path: Path):
+    """
+    把编译结果放入缓存。先写入临时文件再替换，
+    中途被打断或同时有两次构建写入时，缓存中也不会留下不完整的文件。
+    """
+    cache_path = cache_dir / f"{cache_key}{suffix}"
+    tmp_path = cache_dir / f".{cache_key}{suffix}.{os.getpid()}.tmp"
+    try:
+        shutil.copyfile(result_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def prune_build_cache(cache_dir: Path, suffix: str, live_keys: set[str]):
+    """
+    删除本次构建中没有任何笔记引用的缓存文件 (笔记被修改、移动或删除后留下的旧结果)，
+    以及被打断的写入留下的临时文件。只处理缓存目录顶层的文件，
+    tokens 等子目录由各自的模块管理。
+    """
+    for entry in cache_dir.iterdir():
+        name = entry.name
+        if name.endswith('.tmp') or (name.endswith(suffix) and name[:-len(suffix)] not in live_keys):
+            try:
+                if entry.is_file():
+                    entry.unlink()
+            except OSError:
+                pass
@@ -43,7 +43,8 @@ class Config:
                  cover_image: Optional[Path] = None,
                  sorting_script: Optional[Path] = None,
                  post_processors: Optional[List[str]] = None,
-                 pre_processors: Optional[List[str]] = None):
+                 pre_processors: Optional[List[str]] = None,
+                 jobs: Optional[int] = None):
         self.vault_root = vault_root
         self.markdown_file = markdown_file
         self.author = author
@@ -60,6 +61,8 @@ class Config:
         self.sorting_script = sorting_script
         self.post_processors = post_processors or []
         self.pre_processors = pre_processors or []
+        # 并行编译的进程数，None 表示根据 CPU 核心数自动决定
+        self.jobs = jobs
 
 def load_config(config_path: str = "config.toml") -> Config:
     """
@@ -99,6 +102,8 @@ def load_config(config_path: str = "config.toml") -> Config:
         post_processors = processor_config.get("post", [])
         pre_processors = processor_config.get("pre", [])
 
+        jobs = data.get("jobs")
+
         sorting_script_str = data.get("sorting_script")
         sorting_script = config_file.parent / sorting_script_str if sorting_script_str else None
 
@@ -106,6 +111,9 @@ def load_config(config_path: str = "config.toml") -> Config:
         # vault_root 是唯一在任何模式下都必须存在的键
         raise KeyError(f"Missing required key in config file: {e}")
 
+    if jobs is not None and (not isinstance(jobs, int) or isinstance(jobs, bool) or jobs < 1):
+        raise ValueError(f"Configuration Error: 'jobs' must be a positive integer, but got {jobs!r}")
+
     # --- 步骤 2: 验证通用路径 ---
     if not vault_root.is_dir():
         raise NotADirectoryError(f"Vault root is not a valid directory: {vault_root}")
@@ -141,4 +149,5 @@ def load_config(config_path: str = "config.toml") -> Config:
         sorting_script=sorting_script,
         post_processors=post_processors,
         pre_processors=pre_processors,
+        jobs=jobs,
     )
\ No newline at end of file
@@ -20,9 +20,14 @@
 
 # ofmc/content_extractor.py
 
-import re
+import hashlib
+import os
+import pickle
+from functools import lru_cache
+from pathlib import Path
 from typing import List, Callable
 
+import markdown_it
 from markdown_it import MarkdownIt
 
 from .utils import preprocess_nested_blockquotes
@@ -35,31 +40,171 @@ from .utils import insert_blank_blockquote_lines
 
 # --- FIX ENDS HERE ---
 
+class _SlugTable(dict):
+    """
+    Translation table for str.translate that keeps alphanumeric and
+    whitespace characters and drops everything else. Entries are filled in
+    lazily the first time a code point is seen.
+    """
+    def __missing__(self, codepoint: int) -> int | None:
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char.isspace() else None
+        self[codepoint] = value
+        return value
+
+
+_SLUG_TABLE = _SlugTable()
+
+
+@lru_cache(maxsize=4096)
 def _heading_to_slug(text: str) -> str:
     """Converts a heading text to a URL-friendly slug."""
     text = text.lower()
-    text = ''.join(c if c.isalnum() or c.isspace() else '' for c in text)
+    text = text.translate(_SLUG_TABLE)
     return '-'.join(text.split())
 
 
+# 解析结果 (token 列表) 的磁盘缓存目录，由 set_token_cache_dir 设置；为 None 时只在内存中缓存
+_TOKEN_CACHE_DIR: Path | None = None
+
+
+def set_token_cache_dir(cache_dir: Path | None):
+    """设置 token 的磁盘缓存目录。批量编译时，每个工作进程启动时调用一次。"""
+    global _TOKEN_CACHE_DIR
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    _TOKEN_CACHE_DIR = cache_dir
+
+
+@lru_cache(maxsize=None)
+def _parser_fingerprint() -> bytes:
+    """
+    决定 token 结构的代码的摘要：markdown-it 的版本，以及插件和本模块的源码
+    (与 build_cache.compute_build_fingerprint 一样，修改代码就会让缓存失效)。
+    """
+    digest = hashlib.blake2b(markdown_it.__version__.encode('utf-8') + b'\x00')
+    for source in (Path(plugins.__file__), Path(__file__)):
+        digest.update(source.read_bytes())
+    return digest.digest()
+
+
+def _token_cache_key(md_content: str) -> str:
+    """内容和解析器的代码共同决定缓存键，任何一个变化都会让缓存失效。"""
+    digest = hashlib.blake2b(_parser_fingerprint(), digest_size=16)
+    digest.update(md_content.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def prune_token_cache(cache_dir: Path, used_since: float):
+    """
+    删除自 used_since (time.time() 的时间戳) 以来没有被读取或写入的缓存文件
+    (被嵌入的笔记修改之后留下的旧结果)，以及被打断的写入留下的临时文件。
+    命中缓存时 _parse_tokens 会刷新文件的修改时间。
+    """
+    for entry in cache_dir.iterdir():
+        try:
+            if entry.suffix == '.tmp' or (entry.suffix == '.pkl' and entry.stat().st_mtime < used_since):
+                entry.unlink()
+        except OSError:
+            pass
+
+
+@lru_cache(maxsize=128)
+def _parse_tokens(md_content: str) -> list:
+    """
+    解析 Markdown，返回 token 列表 (调用方不得修改)。
+    同一个进程中多次嵌入同一个笔记时直接命中内存缓存；
+    设置了磁盘缓存目录时，跨运行复用未改变内容的解析结果。
+    """
+    cache_path = None
+    if _TOKEN_CACHE_DIR is not None:
+        cache_path = _TOKEN_CACHE_DIR / f"{_token_cache_key(md_content)}.pkl"
+        try:
+            with open(cache_path, 'rb') as f:
+                tokens = pickle.load(f)
+            # 很多文件系统不更新 atime，用 mtime 记录最近一次使用，见 prune_token_cache
+            os.utime(cache_path)
+            return tokens
+        except Exception:
+            # 文件不存在、内容损坏或由不兼容的版本写入时，重新解析即可
+            pass
+
+    # We need a parser just to analyze the token structure
+    md = MarkdownIt("commonmark")
+
+    # --- FIX STARTS HERE ---
+    # Correctly apply the plugin using the imported module
+    plugins.block_id_plugin(md)
+    # --- FIX ENDS HERE ---
+
+    # We don't need to parse with env here, as block_id_plugin works on raw tokens
+    tokens = md.parse(md_content)
+
+    if cache_path is not None:
+        # 先写入临时文件再替换，多个工作进程同时写同一个缓存文件也不会读到不完整的内容
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(tokens, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except (OSError, pickle.PicklingError):
+            tmp_path.unlink(missing_ok=True)
+
+    return tokens
+
+
 class ContentExtractor:
     def __init__(self, md_content: str, pre_processor_chain: List[Callable[[str], str]]):
         self.md_content = md_content
         self.lines = md_content.splitlines()
 
-        # We need a parser just to analyze the token structure
-        md = MarkdownIt("commonmark")
-
-        # --- FIX STARTS HERE ---
-        # Correctly apply the plugin using the imported module
-        plugins.block_id_plugin(md)
-        # --- FIX ENDS HERE ---
-
-        # We don't need to parse with env here, as block_id_plugin works on raw tokens
-        self.tokens = md.parse(self.md_content)
+        # 解析结果按内容缓存 (内存 + 可选的磁盘缓存)
+        self.tokens = _parse_tokens(self.md_content)
 
         self.pre_processor_chain = pre_processor_chain
 
+        # Heading index, built on the first heading lookup (see _build_heading_index)
+        self._headings = None
+        self._heading_by_text = None
+        self._heading_by_slug = None
+        # Block-id index, built on the first block lookup (see _build_block_index)
+        self._block_index = None
+
+    def _build_block_index(self):
+        """
+        Scans the lines once and maps every block id to the first line ending
+        with it: a line whose stripped text ends with '^<id>' defines <id>.
+        Every '^' in the line starts a candidate, so ids that themselves
+        contain '^' resolve exactly as they did with a per-id regex search.
+        """
+        self._block_index = {}
+        for i, line in enumerate(self.lines):
+            if '^' not in line:
+                continue
+            stripped = line.strip()
+            caret = stripped.find('^')
+            while caret != -1:
+                self._block_index.setdefault(stripped[caret + 1:], i)
+                caret = stripped.find('^', caret + 1)
+
+    def _build_heading_index(self):
+        """
+        Scans the tokens once and records every heading:
+          - self._headings: [(token index, level)] in document order
+          - self._heading_by_text / self._heading_by_slug: lowercased text / slug
+            -> position in self._headings of the first heading that has it
+        """
+        self._headings = []
+        self._heading_by_text = {}
+        self._heading_by_slug = {}
+        for i, token in enumerate(self.tokens):
+            if token.type == 'heading_open':
+                content_text = self.tokens[i + 1].content.strip()
+                position = len(self._headings)
+                self._headings.append((i, int(token.tag[1])))
+                self._heading_by_text.setdefault(content_text.lower(), position)
+                self._heading_by_slug.setdefault(_heading_to_slug(content_text), position)
+
     def _run_pre_processing(self, content: str) -> str:
         # 这是一个小型的链运行器
         for process_func in self.pre_processor_chain:
@@ -87,17 +232,11 @@ class ContentExtractor:
         return None
 
     def _extract_by_block_id(self, block_id: str) -> str | None:
-        import re
+        if self._block_index is None:
+            self._build_block_index()
 
-        pattern = re.compile(rf'\^({re.escape(block_id)})\s*$')
         lines = self.lines
-
-        target_idx = -1
-        for i, line in enumerate(lines):
-            if pattern.search(line.strip()):
-                target_idx = i
-                break
-
+        target_idx = self._block_index.get(block_id, -1)
         if target_idx == -1:
             return None  # not found
 
@@ -116,35 +255,31 @@ class ContentExtractor:
         return '\n'.join(extracted)
 
     def _extract_by_heading(self, heading_text: str) -> str | None:
-        start_token_idx = -1
-        start_level = -1
+        if self._headings is None:
+            self._build_heading_index()
 
         # Normalize the input heading
         heading_text_norm = heading_text.strip().lower()
         heading_slug = _heading_to_slug(heading_text_norm)
 
-        # Find the starting heading token
-        for i, token in enumerate(self.tokens):
-            if token.type == 'heading_open':
-                content_token = self.tokens[i + 1]
-                content_text = content_token.content.strip()
-                if (
-                        content_text.lower() == heading_text_norm or
-                        _heading_to_slug(content_text) == heading_slug
-                ):
-                    start_token_idx = i
-                    start_level = int(token.tag[1])
-                    break
-
-        if start_token_idx == -1:
+        # Find the first heading whose text or slug matches
+        candidates = [
+            position for position in (
+                self._heading_by_text.get(heading_text_norm),
+                self._heading_by_slug.get(heading_slug),
+            ) if position is not None
+        ]
+        if not candidates:
             return None  # Heading not found
 
-        # Find the end of the section
+        position = min(candidates)
+        start_token_idx, start_level = self._headings[position]
+
+        # Find the end of the section: the next heading of the same or a higher level
         end_token_idx = len(self.tokens)
-        for i in range(start_token_idx + 1, len(self.tokens)):
-            token = self.tokens[i]
-            if token.type == 'heading_open' and int(token.tag[1]) <= start_level:
-                end_token_idx = i
+        for token_idx, level in self._headings[position + 1:]:
+            if level <= start_level:
+                end_token_idx = token_idx
                 break
 
         # Safe line mapping
@@ -20,6 +20,84 @@
 
 import re
 
+# 所有正则在模块导入时编译一次，避免每处理一个文件都重新编译
+
+# 规则 1: 特殊标题 (例如 "**证明:**")
+# 核心修正：将结尾的匹配从 `\*\*:` 改为 `:\*\*`
+# 同时使用命名捕获组以提高可读性和健壮性
+_HEADER_PATTERN = r"^(?P<header>\s*\*\*[^*]+:\*\*\s*)(?P<newline>\r?\n)(?!\s*\n|$)"
+_HEADER_RE = re.compile(_HEADER_PATTERN, flags=re.MULTILINE)
+
+# 规则 2: 所有类型的列表项
+# 逐行扫描，每行只匹配一次，不再用跨行的 (?P=prefix) 反向引用先行断言，
+# 对任意输入都是线性时间。
+#   ((?:>\s*)*)          块引用前缀 (0个或多个 '>')
+#   \s*(?:[-*+]|\d+\.)\s+ 可选的前导空格、列表标记 ('-', '*', '+' 或 '数字.') 和必要空格
+_LIST_ITEM_RE = re.compile(r"((?:>\s*)*)\s*(?:[-*+]|\d+\.)\s+")
+# 去掉前缀之后的列表标记部分，用来判断下一行是否是同一前缀下的另一个列表项
+_LIST_MARKER_RE = re.compile(r"\s*(?:[-*+]|\d+\.)\s+")
+# 预过滤时从行首剥掉的字符: 块引用标记和常见空白
+_PREFIX_CHARS = '> \t\r\n'
+
+# 规则 1 必须含有 '**'，规则 2 必须含有列表标记；用这个探针判断是否可能存在有序列表
+_HAS_OL_RE = re.compile(r"\d\.")
+
+# 书籍引用链接的固定前缀: [[Book Titles#^SomeID]]
+_BOOK_REF_PREFIX = "[[Book Titles#^"
+_BOOK_REF_PATTERN = r"\[\[Book Titles#\^(?P<book_id>\S+)\]\]"
+
+# preprocess_book_references + 规则 1 的合并版本：两条规则作为带名字的顶层分支，
+# 一遍扫描完成。外层分组用于在回调中通过 lastgroup 分派。
+_COMBINED_RE = re.compile(
+    f"(?P<book>{_BOOK_REF_PATTERN})|(?P<hdr>{_HEADER_PATTERN})",
+    flags=re.MULTILINE
+)
+
+def _insert_list_spacing(content: str) -> str:
+    """
+    规则 2: 在列表项后添加一个带相同块引用前缀的空行，
+    前提是下一行既不是空行，也不是同一前缀下的另一个列表项。
+    """
+    # 只按 '\n' 切分 (与正则的 MULTILINE 语义一致)，并保留行尾换行符
+    lines = content.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+
+    output = []
+    line_count = len(lines)
+    for i, line in enumerate(lines):
+        output.append(line)
+
+        # 没有换行符的最后一行不需要处理
+        if not line.endswith('\n'):
+            continue
+
+        # 廉价的预过滤：去掉块引用前缀和空白后，第一个字符必须是列表标记或数字，
+        # 绝大多数普通文本行在这里就被排除，不必进入正则引擎
+        first = line.lstrip(_PREFIX_CHARS)[:1]
+        if not first or not (first in '-*+' or first.isdecimal() or first.isspace()):
+            continue
+
+        m = _LIST_ITEM_RE.match(line)
+        if not m:
+            continue
+
+        prefix = m.group(1)
+        next_line = lines[i + 1] if i + 1 < line_count else ''
+
+        # 下一行是空行或文件末尾
+        if not next_line.strip():
+            continue
+        # 下一行是同一前缀下的另一个列表项
+        if next_line.startswith(prefix) and _LIST_MARKER_RE.match(next_line, len(prefix)):
+            continue
+
+        output.append(prefix + '\n')
+
+    return ''.join(output)
+
 def fix_markdown_spacing(content: str) -> str:
     """
     一个自定义的 Markdown 预处理器，用于解决布局间距问题。
@@ -30,43 +108,17 @@ def fix_markdown_spacing(content: str) -> str:
        这个操作能正确处理嵌套的块引用。
     """
 
-    # --- 规则 1: 处理特殊标题 (例如 "**证明:**") (已修正) ---
-    # 核心修正：将结尾的匹配从 `\*\*:` 改为 `:\*\*`
-    # 同时使用命名捕获组以提高可读性和健壮性
-    header_pattern = re.compile(
-        r"^(?P<header>\s*\*\*[^*]+:\*\*\s*)(?P<newline>\r?\n)(?!\s*\n|$)",
-        flags=re.MULTILINE
-    )
+    # 快速退出：既没有 '*'、'-'、'+'，也没有 '数字.' 的文档不可能被任何规则匹配
+    if ('*' not in content and '-' not in content and '+' not in content
+            and not _HAS_OL_RE.search(content)):
+        return content
+
+    # --- 规则 1: 处理特殊标题 (例如 "**证明:**") ---
     # 替换逻辑: 保留标题行和它的换行符，再额外添加一个换行符
-    content = header_pattern.sub(r"\g<header>\g<newline>\g<newline>", content)
-
-
-    # --- 规则 2: 处理所有类型的列表项 (工作正常，保持不变) ---
-    list_item_pattern = re.compile(r"""
-    ^                           # 匹配行的开始
-    (                           # 开始捕获组 1: list_item_line (整个列表项所在的行)
-        (?P<prefix>(?:>\s*)*)   #   开始命名捕获组 'prefix': 块引用前缀 (0个或多个 '>')
-        \s*                     #   可选的前导空格
-        (?:[-*+]|\d+\.)          #   列表标记: 匹配 '-', '*', '+' 或 '数字.'
-        \s+                     #   列表标记和内容之间的必要空格
-        .*                      #   列表项的其余所有内容
-    )                           # 结束捕获组 1
-    (?P<newline_list>\r?\n)      # 命名捕获组 'newline_list': 列表项的换行符
-    (?!                         # 开始负向先行断言 (下一行必须不是...)
-        \s*$                    #   ...一个空行或文件末尾
-        |                       #   或
-        (?P=prefix)             #   ...与之前匹配的相同的前缀
-        \s*
-        (?:[-*+]|\d+\.)\s+      #   ...另一个列表项
-    )
-    """, flags=re.MULTILINE | re.VERBOSE)
-
-    content = list_item_pattern.sub(
-        lambda m: f"{m.group(1)}{m.group('newline_list')}{m.group('prefix')}{m.group('newline_list')}",
-        content
-    )
-
-    return content
+    content = _HEADER_RE.sub(r"\g<header>\g<newline>\g<newline>", content)
+
+    # --- 规则 2: 处理所有类型的列表项 ---
+    return _insert_list_spacing(content)
 
 def preprocess_book_references(markdown_text: str) -> str:
     """
@@ -81,22 +133,48 @@ def preprocess_book_references(markdown_text: str) -> str:
     ==(Book with id: SomeID)==
     """
 
-    # 正则表达式解释:
-    # \[\[Book Titles#\^  - 匹配固定的前缀 "[[Book Titles#^"
-    #                          注意: [ 需要被转义为 \[
-    # (\S+)                - 这是捕获组 1。
-    #                          \S  匹配任何非空白字符。
-    #                          +   表示匹配一个或多个。
-    #                          所以 (\S+) 会捕获像 "IM" 或 "GTM82" 这样的 ID。
-    # \]\]                 - 匹配固定的后缀 "]]"
-    #                          注意: ] 需要被转义为 \]
-    pattern = r"\[\[Book Titles#\^(\S+)\]\]"
-
-    # 替换字符串解释:
-    # ==(Book with id: \1)== - 这是一个固定的模板。
-    #                          \1 会被替换为正则表达式中第一个捕获组匹配到的内容，
-    #                          也就是我们捕获到的那个不含空格的 ID。
-    replacement = r"==(Book with id: \1)=="
-
-    # 使用 re.sub 执行全局查找和替换
-    return re.sub(pattern, replacement, markdown_text)
\ No newline at end of file
+    # 前缀 "[[Book Titles#^" 和后缀 "]]" 都是字面量，只有中间的 ID 可变，
+    # 因此用 str.split 切分即可，完全不经过正则引擎。
+    # 它与原来的正则 r"\[\[Book Titles#\^(\S+)\]\]" 等价：
+    # ID 取前缀之后那一段连续非空白字符中，最后一个 "]]" 之前的部分。
+    if _BOOK_REF_PREFIX not in markdown_text:
+        # 常见情况：文档里没有任何书籍引用
+        return markdown_text
+
+    parts = markdown_text.split(_BOOK_REF_PREFIX)
+
+    output = [parts[0]]
+    for part in parts[1:]:
+        run = part.split(None, 1)[0] if part and not part[0].isspace() else ""
+        end = run.rfind("]]")
+        if end < 1:
+            # 不构成合法的引用，原样保留
+            output.append(_BOOK_REF_PREFIX)
+            output.append(part)
+            continue
+
+        output.append(f"==(Book with id: {run[:end]})==")
+        output.append(part[end + 2:])
+
+    return "".join(output)
+
+def _combined_replacer(m: re.Match) -> str:
+    if m.lastgroup == 'book':
+        return f"==(Book with id: {m.group('book_id')})=="
+
+    # 标题行会被整行匹配，行内的书籍引用需要在这里一并替换
+    newline = m.group('newline')
+    return f"{preprocess_book_references(m.group('header'))}{newline}{newline}"
+
+def preprocess_book_references_and_spacing(content: str) -> str:
+    """
+    等价于依次运行 preprocess_book_references 和 fix_markdown_spacing，
+    但书籍引用和特殊标题只需一遍正则扫描。可在配置中替代这两个处理器：
+    "custom_fixes.py:preprocess_book_references_and_spacing"
+    """
+    if (_BOOK_REF_PREFIX not in content and '*' not in content and '-' not in content
+            and '+' not in content and not _HAS_OL_RE.search(content)):
+        return content
+
+    content = _COMBINED_RE.sub(_combined_replacer, content)
+    return _insert_list_spacing(content)
@@ -20,58 +20,138 @@
 
 # ofmc/locator.py
 
+import os
+import unicodedata
 from pathlib import Path
 from collections import deque
 
+
+def _fold_name(name: str) -> str:
+    """Index key for filesystems that ignore case (and, on macOS, Unicode normalization)."""
+    return unicodedata.normalize('NFC', name).casefold()
+
+
 class Locator:
     def __init__(self, vault_root: Path, current_file: Path):
         if not vault_root.is_dir():
             raise ValueError("Vault root must be an existing directory.")
         self.vault_root = vault_root.resolve()
         self.current_file = current_file.resolve()
-
-    def _bfs_search(self, start_dir: Path, target_filename: str) -> Path | None:
+        # filename -> every path with that name, in vault-wide BFS order.
+        # Built on the first resolve() call, see _build_index.
+        self._by_name = None
+        # Maps a filename to its index key, see _build_index
+        self._key = str
+        # link_target -> result of resolve(); the same target is often linked
+        # or embedded many times from one note
+        self._resolved: dict[str, str | None] = {}
+
+    def _build_index(self) -> dict[str, list[Path]]:
         """
-        Performs a Breadth-First Search for a file starting from a directory.
+        Walks the whole vault once, breadth-first from the vault root, and
+        indexes every file by its name.
 
-        Args:
-            start_dir: The directory to start the search from.
-            target_filename: The name of the file to find (e.g., "1.png").
-
-        Returns:
-            The absolute Path to the first match found, or None if not found.
+        Because the walk is breadth-first, the paths for each name are ordered
+        by depth. Restricted to any subdirectory, that order is also the order
+        a BFS started from that subdirectory would find them in, so both search
+        rules in resolve() become a scan of one short list.
         """
-        queue = deque([start_dir])
-        visited = {start_dir}
+        files = []  # (name, path) in BFS order
+        queue = deque([self.vault_root])
+        visited = {self.vault_root}
 
         while queue:
             current_dir = queue.popleft()
 
-            # Check if the file exists in the current directory
-            potential_path = current_dir / target_filename
-            if potential_path.is_file():
-                return potential_path
-
-            # Add subdirectories to the queue for the next level of search
+            # os.scandir yields DirEntry objects whose file type comes from the
+            # directory listing itself, so is_dir()/is_file() need no extra
+            # stat call except for symlinks.
             try:
-                for entry in current_dir.iterdir():
-                    if entry.is_dir() and entry not in visited:
-                        visited.add(entry)
-                        queue.append(entry)
+                with os.scandir(current_dir) as it:
+                    entries = sorted(it, key=lambda e: e.name)
             except PermissionError:
                 # Ignore directories we can't read
                 continue
 
+            for entry in entries:
+                if entry.is_dir():
+                    # Add subdirectories to the queue for the next level of search
+                    dir_path = Path(entry.path)
+                    if dir_path not in visited:
+                        visited.add(dir_path)
+                        queue.append(dir_path)
+                elif entry.is_file():
+                    files.append((entry.name, Path(entry.path)))
+
+        # On a case-insensitive filesystem (Windows, default macOS) the old
+        # `(current_dir / name).is_file()` lookup matched ![[Image.PNG]] to
+        # image.png, so key the index by the folded name there.
+        if self._folds_case(files):
+            self._key = _fold_name
+        by_name = {}
+        for name, path in files:
+            by_name.setdefault(self._key(name), []).append(path)
+        return by_name
+
+    @staticmethod
+    def _folds_case(files: list[tuple[str, Path]]) -> bool:
+        """
+        Tells whether the filesystem holding the vault ignores case, by asking
+        for the first indexed file under its name with the case swapped.
+        """
+        if os.path.normcase("A") == "a":
+            return True
+        names = {path for _, path in files}
+        for name, path in files:
+            swapped = name.swapcase()
+            if swapped != name:
+                probe = path.with_name(swapped)
+                return probe not in names and probe.is_file()
+        return False
+
+    def _find(self, target_filename: str, start_dir: Path) -> Path | None:
+        """
+        Returns the first file named target_filename at or below start_dir,
+        in BFS order, or None if there is none.
+        """
+        if self._by_name is None:
+            self._by_name = self._build_index()
+
+        candidates = self._by_name.get(self._key(target_filename))
+        if not candidates:
+            return None
+
+        if start_dir == self.vault_root:
+            return candidates[0]
+
+        for candidate in candidates:
+            if start_dir in candidate.parents:
+                return candidate
         return None
 
     def resolve(self, link_target: str) -> str | None:
+        """
+        Resolves a wikilink target name to an absolute file path, see
+        _resolve_uncached. Results are memoized per Locator.
+        """
+        try:
+            return self._resolved[link_target]
+        except KeyError:
+            pass
+        result = self._resolved[link_target] = self._resolve_uncached(link_target)
+        return result
+
+    def _resolve_uncached(self, link_target: str) -> str | None:
         """
         Resolves a wikilink target name to an absolute file path.
 
         The search order is:
         1. If link_target contains slashes, treat it as a relative path from the vault root.
-        2. Perform a BFS search starting from the current file's directory ("downwards").
-        3. If not found, perform a vault-wide BFS search from the vault root ("upwards/sideways").
+        2. Search breadth-first starting from the current file's directory ("downwards").
+        3. If not found, search the whole vault breadth-first from the vault root ("upwards/sideways").
+
+        Both searches use a filename index of the vault that is built once per
+        Locator, instead of walking the directory tree on every call.
 
         Args:
             link_target: The filename from the wikilink, e.g., "1.png".
@@ -92,7 +172,7 @@ class Locator:
         # This will find the closest match in or below the current folder.
         # For test.md in /folder, this searches /folder, then /folder/assets, etc.
         local_search_start_dir = self.current_file.parent
-        found_path = self._bfs_search(local_search_start_dir, target_path.name)
+        found_path = self._find(target_path.name, local_search_start_dir)
         if found_path:
             return str(found_path)
 
@@ -101,7 +181,7 @@ class Locator:
         # For test.md, this will search the entire vault from the top.
         # It's crucial to avoid re-searching if the local dir IS the vault root.
         if local_search_start_dir != self.vault_root:
-            found_path = self._bfs_search(self.vault_root, target_path.name)
+            found_path = self._find(target_path.name, self.vault_root)
             if found_path:
                 return str(found_path)
 
@@ -24,22 +24,18 @@ import os
 import sys
 import shutil
 import uuid
-from art import *
 from pathlib import Path
-from .parser import OFMCompiler
 from .config import load_config
 from .batch_compiler import run_batch_compilation, run_xelatex, get_temp_dir
 
-import colorama
-from colorama import Fore, Style
+# art、colorama 和编译器 (markdown-it 等) 都在真正需要时才导入，
+# 这样 ofmc --help 之类的调用不必付出导入它们的启动开销
 
 def main():
     """
     Main execution function using the config.toml file.
     """
 
-    colorama.init()
-
     # 1. 设置命令行参数解析器g
     #    - description 会在用户使用 -h 或 --help 时显示，非常有用。
     parser = argparse.ArgumentParser(
@@ -71,7 +67,11 @@ def main():
 
     args = parser.parse_args()
 
+    import colorama
+    colorama.init()
+
     if not args.no_logo:
+        from art import tprint
         tprint("ofmc", "isometric1")
     print("OFMC Obsidian-Flavored Markdown to LaTeX compiler.")
 
@@ -109,6 +109,7 @@ def main():
             os.makedirs(build_assets_dir, exist_ok=True)
 
             # 1. Compile Markdown to a LaTeX string in memory
+            from .parser import OFMCompiler
             compiler = OFMCompiler(
                 vault_root=str(cfg.vault_root),
                 author=cfg.author,
@@ -19,7 +19,10 @@
 """
 
 # ofmc/parser.py
+import hashlib
 import importlib
+import os
+from functools import reduce
 from pathlib import Path
 from typing import Callable, List
 
@@ -37,8 +40,30 @@ from . import plugins
 from .locator import Locator
 
 
+# 已加载的外部处理器: {(脚本绝对路径, 修改时间, 函数名): 函数}。
+# 同一进程中创建多个编译器时，外部脚本只需执行一次；脚本被修改后自动重新加载。
+_PROCESSOR_CACHE: dict[tuple[str, int, str], Callable[[str], str]] = {}
+
+
+# 自定义插件 (按注册顺序)，以及它能匹配到内容时文本中必然出现的字符串
+_PLUGIN_TRIGGERS = (
+    ('[!', plugins.callout_plugin),
+    ('==', plugins.mark_plugin),
+    ('![[', plugins.embed_plugin),  # Use the new embed plugin
+    ('[[', plugins.wikilink_plugin),
+    ('^', plugins.block_id_plugin),
+)
+
+# 按启用的插件缓存的解析器变体，见 OFMCompiler._get_md。
+# 所有编译器使用相同的选项，MarkdownIt 实例在解析时不保存状态，
+# 因此同一进程中的编译器共享这些实例，不必每次构造都重新注册规则。
+_MD_VARIANTS: dict[tuple[bool, ...], MarkdownIt] = {}
+
+
 class OFMCompiler:
     MAX_RECURSION_DEPTH = 5
+    # 解析结果缓存最多保存的条目数
+    PARSE_CACHE_SIZE = 512
 
     def __init__(self, vault_root: str, author: str = "", link_registry: dict = None, build_assets_dir: Path = None, post_processors: list = None, pre_processors: list = None):
         self.vault_root = Path(vault_root).resolve()
@@ -62,18 +87,44 @@ class OFMCompiler:
 
         self.renderer = LatexRenderer(self, self.link_registry, self.book_mode)
 
-        self.md = (
+        # 启用了所有插件的完整解析器
+        self.md = self._get_md_variant((True,) * len(_PLUGIN_TRIGGERS))
+
+        # 解析结果缓存: {(内容摘要, 所在文件): tokens}。
+        # 同一篇笔记 (或同一个片段) 被多处嵌入时只解析一次。
+        # 解析只依赖于文本、所在文件 (链接解析和块 ID 标签) 以及本实例固定的链接注册表，
+        # 渲染器不会修改 token，因此缓存的列表可以直接共享。
+        self._parse_cache: dict[tuple[bytes, Path], list[Token]] = {}
+
+        # 每个文件的 Locator 只创建一次 (构造时需要 is_dir 和 resolve 系统调用)
+        self._locator_cache: dict[Path, Locator] = {}
+
+    @staticmethod
+    def _build_md(enabled: tuple[bool, ...]) -> MarkdownIt:
+        md = (
             MarkdownIt("commonmark", {"breaks": True})
             .enable("table")
             .use(texmath_plugin, delimiters='dollars')
         )
 
-        # Apply our custom plugins
-        plugins.callout_plugin(self.md)
-        plugins.mark_plugin(self.md)
-        plugins.embed_plugin(self.md)  # Use the new embed plugin
-        plugins.wikilink_plugin(self.md)
-        plugins.block_id_plugin(self.md)
+        # Apply our custom plugins (only the enabled ones, in registration order)
+        for (_, plugin), is_enabled in zip(_PLUGIN_TRIGGERS, enabled):
+            if is_enabled:
+                plugin(md)
+        return md
+
+    def _get_md_variant(self, enabled: tuple[bool, ...]) -> MarkdownIt:
+        md = _MD_VARIANTS.get(enabled)
+        if md is None:
+            md = _MD_VARIANTS[enabled] = self._build_md(enabled)
+        return md
+
+    def _get_md(self, markdown_text: str) -> MarkdownIt:
+        """
+        返回只注册了文本可能用到的插件的解析器。
+        例如没有 '[!' 的笔记不需要 callout_transformer 遍历所有 token。
+        """
+        return self._get_md_variant(tuple(trigger in markdown_text for trigger, _ in _PLUGIN_TRIGGERS))
 
     @staticmethod
     def _load_processor_chain(names: List[str], builtin_registry: dict, chain_type: str) -> List[Callable[[str], str]]:
@@ -92,11 +143,15 @@ class OFMCompiler:
                     # 路径相对于项目根目录（config.toml 所在位置）
                     script_path = path_str
 
-                    spec = importlib.util.spec_from_file_location(name, script_path)
-                    module = importlib.util.module_from_spec(spec)
-                    spec.loader.exec_module(module)
+                    cache_key = (os.path.abspath(script_path), os.stat(script_path).st_mtime_ns, func_name)
+                    func = _PROCESSOR_CACHE.get(cache_key)
+                    if func is None:
+                        spec = importlib.util.spec_from_file_location(name, script_path)
+                        module = importlib.util.module_from_spec(spec)
+                        spec.loader.exec_module(module)
 
-                    func = getattr(module, func_name)
+                        func = getattr(module, func_name)
+                        _PROCESSOR_CACHE[cache_key] = func
                     chain.append(func)
                 except Exception as e:
                     print(f"Warning: Cannot load processor: '{name}': {e}")
@@ -107,18 +162,21 @@ class OFMCompiler:
     @staticmethod
     def _run_chain(content: str, chain: List[Callable[[str], str]]) -> str:
         """通用管道运行器"""
-        for process_func in chain:
-            content = process_func(content)
-        return content
+        return reduce(lambda text, process_func: process_func(text), chain, content)
 
-    def compile(self, input_file: str, mode: str = 'standalone') -> str:
-        """Public method to compile a file into a full LaTeX document."""
+    def compile(self, input_file: str, mode: str = 'standalone', markdown_text: str | None = None) -> str:
+        """
+        Public method to compile a file into a full LaTeX document.
+        If the caller has already read the file, pass its content as
+        markdown_text to skip reading it again.
+        """
         input_path = Path(input_file).resolve()
-        try:
-            with open(input_path, 'r', encoding='utf-8') as f:
-                markdown_text = f.read()
-        except FileNotFoundError:
-            raise
+        if markdown_text is None:
+            try:
+                with open(input_path, 'r', encoding='utf-8') as f:
+                    markdown_text = f.read()
+            except FileNotFoundError:
+                raise
 
         markdown_text, banner_path = extract_banner_path(markdown_text)
         # markdown_text = (
@@ -141,7 +199,7 @@ class OFMCompiler:
         # Wrap the body with the preamble and postamble
         title = input_path.stem
 
-        locator = Locator(self.vault_root, input_path)
+        locator = self._get_locator(input_path)
 
         raw_doc = self.renderer.render_document(body_content,
                                              title=title,
@@ -161,7 +219,7 @@ class OFMCompiler:
             return r"\textcolor{red}{\textbf{Error: Max recursion depth reached.}}"
 
         # Each compilation needs a locator relative to its own file path
-        locator = Locator(self.vault_root, current_file)
+        locator = self._get_locator(current_file)
 
         # Pass necessary data through the environment
         env = {
@@ -177,5 +235,25 @@ class OFMCompiler:
         if recursion_depth > 0:
             env['in_tcolorbox'] = True
 
-        tokens: list[Token] = self.md.parse(markdown_text, env)
+        tokens = self._parse(markdown_text, current_file, env)
         return self.renderer.render_tokens(tokens, env)
+
+    def _get_locator(self, current_file: Path) -> Locator:
+        """Returns the Locator for current_file, creating it on first use."""
+        locator = self._locator_cache.get(current_file)
+        if locator is None:
+            locator = Locator(self.vault_root, current_file)
+            self._locator_cache[current_file] = locator
+        return locator
+
+    def _parse(self, markdown_text: str, current_file: Path, env: dict) -> list[Token]:
+        """Parses markdown_text, reusing the tokens of an identical earlier parse."""
+        key = (hashlib.blake2b(markdown_text.encode('utf-8')).digest(), current_file)
+        tokens = self._parse_cache.get(key)
+        if tokens is None:
+            tokens = self._get_md(markdown_text).parse(markdown_text, env)
+            if len(self._parse_cache) >= self.PARSE_CACHE_SIZE:
+                # 丢弃最早加入的条目
+                del self._parse_cache[next(iter(self._parse_cache))]
+            self._parse_cache[key] = tokens
+        return tokens
@@ -21,6 +21,8 @@
 # ofmc/plugins.py
 
 import re
+from bisect import bisect_right
+from itertools import accumulate
 from markdown_it import MarkdownIt
 from markdown_it.rules_core import StateCore
 # from markdown_it.rules_inline import RuleInline
@@ -32,15 +34,19 @@ from pathlib import Path
 WIKILINK_RE = re.compile(r'\[\[([^\]]+)\]\]')
 
 def wikilink_rule(state: StateInline, silent: bool):    # We are looking for [[, but not ![[
-    # Check if the previous character is '!'
-    if state.pos > 0 and state.src[state.pos - 1] == '!':
+    src = state.src
+    pos = state.pos
+
+    # Standard check for [[ (the ruler also calls us at other terminator
+    # characters, so test the current character first)
+    if src[pos] != '[' or pos + 1 >= len(src) or src[pos + 1] != '[':
         return False
 
-    # Standard check for [[
-    if not state.src.startswith('[[', state.pos):
+    # Check if the previous character is '!'
+    if pos > 0 and src[pos - 1] == '!':
         return False
 
-    match = WIKILINK_RE.match(state.src, state.pos)
+    match = WIKILINK_RE.match(src, pos)
     if not match:
         return False
 
@@ -84,6 +90,30 @@ CALLOUT_REGEX = re.compile(r"^\s*\[!([a-zA-Z]+)\](.*)")
 # Use a non-greedy match for the title to handle titles like "Note-1"
 TITLE_BODY_REGEX = re.compile(r"^\s*(\S+)(.*)", re.DOTALL)
 
+def _trim_text_children(children: list, chars_to_trim: int) -> list:
+    """
+    Removes the first chars_to_trim characters of text from an inline token's
+    children. Only 'text' children count towards the trimmed length; other
+    children (math, code, ...) are always kept.
+    """
+    # Running total of text length; non-text children contribute nothing
+    text_ends = list(accumulate(
+        len(child.content) if child.type == 'text' else 0 for child in children
+    ))
+    # The first child whose text reaches past the cut is the one to slice
+    cut = bisect_right(text_ends, chars_to_trim)
+
+    # Text before the cut is removed entirely
+    kept = [child for child in children[:cut] if child.type != 'text']
+    if cut == len(children):
+        return kept
+
+    child = children[cut]
+    child.content = child.content[chars_to_trim - (text_ends[cut - 1] if cut else 0):]
+    kept.append(child)
+    kept.extend(children[cut + 1:])
+    return kept
+
 def callout_transformer(state: StateCore):
     """
     Scans the token stream and transforms blockquotes into callouts.
@@ -91,25 +121,45 @@ def callout_transformer(state: StateCore):
         preserving all nested tokens like math.
     """
     tokens = state.tokens
-    i = 0
-    while i < len(tokens):
-        token = tokens[i]
+    token_count = len(tokens)
+    # Read every token type once; the scans below index this list instead of
+    # going through Token attribute lookups
+    types = [token.type for token in tokens]
+
+    # Match every blockquote_open with its blockquote_close in one pass,
+    # so finding the end of a callout is a lookup instead of a nesting scan
+    closing_index = {}
+    open_indices = []
+    open_stack = []
+    for index, token_type in enumerate(types):
+        if token_type == 'blockquote_open':
+            open_indices.append(index)
+            open_stack.append(index)
+        elif token_type == 'blockquote_close' and open_stack:
+            closing_index[open_stack.pop()] = index
+
+    # Tokens inside a converted callout are not scanned again
+    resume_index = 0
+    for i in open_indices:
+        if i < resume_index:
+            continue
 
-        if not (token.type == 'blockquote_open' and i + 2 < len(tokens) and
-                tokens[i + 1].type == 'paragraph_open' and tokens[i + 2].type == 'inline'):
-            i += 1
+        if not (i + 2 < token_count and
+                types[i + 1] == 'paragraph_open' and types[i + 2] == 'inline'):
             continue
 
+        token = tokens[i]
         inline_token = tokens[i + 2]
         if not inline_token.children:
-            i += 1
             continue
 
         # We check the content of the first child token to see if it's a callout
-        first_line_of_content = inline_token.content.split('\n', 1)[0]
+        # (slice up to the first newline instead of splitting the whole content)
+        content = inline_token.content
+        newline_index = content.find('\n')
+        first_line_of_content = content if newline_index < 0 else content[:newline_index]
         callout_match = CALLOUT_REGEX.match(first_line_of_content)
         if not callout_match:
-            i += 1
             continue
 
         # --- IT'S A CALLOUT. PERFORM DIRECT TOKEN STREAM MANIPULATION. ---
@@ -136,28 +186,12 @@ def callout_transformer(state: StateCore):
         # 2. THE CRITICAL FIX: Trim the prefix from the children token list.
         chars_to_trim = len(prefix_to_remove)
 
-        new_children = []
-        trimming_done = False
-        for child in inline_token.children:
-            if trimming_done:
-                new_children.append(child)
-                continue
-
-            if child.type != 'text':
-                new_children.append(child)
-                continue
-
-            content_len = len(child.content)
-            if content_len <= chars_to_trim:
-                chars_to_trim -= content_len
-                continue
-            else:
-                child.content = child.content[chars_to_trim:]
-                new_children.append(child)
-                trimming_done = True
+        new_children = _trim_text_children(inline_token.children, chars_to_trim)
 
         inline_token.children = new_children
-        inline_token.content = ''.join(child.content for child in new_children)
+        # prefix_to_remove is the head of the raw first line, so trimming the
+        # content is a single slice; no need to re-join every child
+        inline_token.content = content[len(prefix_to_remove):]
 
         # 3. Update the blockquote tokens to callout tokens.
         token.type = 'callout_open';
@@ -165,20 +199,12 @@ def callout_transformer(state: StateCore):
         token.info = callout_type;
         token.meta = {'title': custom_title}
 
-        nesting = 1;
-        j = i + 1
-        while j < len(tokens):
-            if tokens[j].type == 'blockquote_open':
-                nesting += 1
-            elif tokens[j].type == 'blockquote_close':
-                nesting -= 1
-            if nesting == 0:
-                tokens[j].type = 'callout_close';
-                tokens[j].tag = 'div'
-                break
-            j += 1
+        j = closing_index.get(i, token_count)
+        if j < token_count:
+            tokens[j].type = 'callout_close';
+            tokens[j].tag = 'div'
 
-        i = j + 1
+        resume_index = j + 1
 
 
 def callout_plugin(md: MarkdownIt):
@@ -241,21 +267,32 @@ def block_id_processor(state: StateCore):
     if not registry or not current_note:
         return
 
+    # 块 ID 必然包含 '^'：文档里没有 '^' 时不必逐个检查 token
+    if '^' not in state.src:
+        return
+
     for token in state.tokens:
-        if token.type != 'inline' or not token.content:
+        if token.type != 'inline' or '^' not in token.content:
             continue
 
         original_content = token.content
         lines = original_content.split('\n')
         new_lines = []
         found_block_id_in_token = False
-
-        for line in lines:
-            # Rule 1: 独立一行的块ID
-            if BLOCK_ID_STANDALONE_RE.fullmatch(line.strip()):
-                match = BLOCK_ID_STANDALONE_RE.fullmatch(line.strip())
+        block_id = None
+        # 只有最后一行行尾的块ID 被删掉时，可以直接修剪最后一个 text 子 token，
+        # 不必重新解析；其他改动 (删掉整行、中间行的块ID) 都需要重新解析
+        last_line_index = len(lines) - 1
+        needs_reparse = False
+        removed_tail = None
+
+        for line_index, line in enumerate(lines):
+            # Rule 1: 独立一行的块ID (正则两端的 \s* 已经处理了空白，不需要 strip)
+            match = BLOCK_ID_STANDALONE_RE.fullmatch(line)
+            if match:
                 block_id = match.group(1)
                 found_block_id_in_token = True
+                needs_reparse = True
                 # 我们跳过这一行，但标记已找到
                 continue
 
@@ -268,14 +305,18 @@ def block_id_processor(state: StateCore):
                     # 找到了！将标签附加到 token 的 meta 中
                     token.meta['latex_label'] = registry[target_key]
 
-                # 清理掉 ID
-                cleaned_line = BLOCK_ID_EOL_RE.sub('', line)
-                new_lines.append(cleaned_line)
+                # 清理掉 ID (行尾锚定，只会有这一处匹配)
+                new_lines.append(line[:match.start()])
+                # (剩下的部分如果还含有 '^'，重新解析时会再次触发本规则，仍然走重新解析)
+                if line_index == last_line_index and '^' not in line[:match.start()]:
+                    removed_tail = match.group(0)
+                else:
+                    needs_reparse = True
             else:
                 new_lines.append(line)
 
         # 如果是独立一行的ID，我们要确保标签被附加
-        if found_block_id_in_token and not token.meta.get('latex_label') and 'block_id' in locals():
+        if found_block_id_in_token and not token.meta.get('latex_label'):
             target_key = f"{current_note}^{block_id}"
             if target_key in registry:
                 token.meta['latex_label'] = registry[target_key]
@@ -284,6 +325,20 @@ def block_id_processor(state: StateCore):
 
         if new_content != original_content:
             token.content = new_content
+            if not new_content:
+                # 只剩下块 ID 的 token：没有内容需要重新解析
+                token.children = []
+                continue
+
+            # 块ID 只是最后一个 text 子 token 的纯文本尾部，删掉它不会影响其他行内结构
+            children = token.children
+            if (not needs_reparse and removed_tail and children
+                    and children[-1].type == 'text' and children[-1].content.endswith(removed_tail)):
+                children[-1].content = children[-1].content[:-len(removed_tail)]
+                if not children[-1].content:
+                    children.pop()
+                continue
+
             # Re-parsing is important if content changes significantly,
             # but for simple removal, just updating content might be enough.
             # Let's keep the robust way.
@@ -305,37 +360,40 @@ def mark_rule(state: StateInline, silent: bool):
     """
     Parses '==' highlighted text '=='.
     """
-    if state.src[state.pos:state.pos + 2] != '==':
+    src = state.src
+    pos = state.pos
+    old_pos_max = state.posMax
+
+    if not src.startswith('==', pos):
         return False
 
-    scan_pos = state.pos + 2
-    while scan_pos < state.posMax:
-        if state.src[scan_pos:scan_pos + 2] == '==':
-            if not silent:
-                state.push('mark_open', 'mark', 1)
+    # Let str.find locate the closing marker instead of stepping one character
+    # at a time. Both markers must lie inside [pos, posMax).
+    scan_pos = src.find('==', pos + 2, old_pos_max)
+    if scan_pos == -1:
+        return False
 
-                # --- CORRECTED STATE MANAGEMENT ---
-                # 1. Save the original posMax.
-                old_pos_max = state.posMax
+    if not silent:
+        state.push('mark_open', 'mark', 1)
 
-                # 2. Set new boundaries for the inner tokenizer.
-                state.pos += 2
-                state.posMax = scan_pos
+        # --- CORRECTED STATE MANAGEMENT ---
+        # 1. The original posMax is saved in old_pos_max above.
 
-                # 3. Tokenize the content *inside* the markers.
-                state.md.inline.tokenize(state)
+        # 2. Set new boundaries for the inner tokenizer.
+        state.pos = pos + 2
+        state.posMax = scan_pos
 
-                # 4. Restore the original posMax and advance the cursor past the closing marker.
-                state.posMax = old_pos_max
-                state.pos = scan_pos + 2
-                # --- END OF FIX ---
+        # 3. Tokenize the content *inside* the markers.
+        state.md.inline.tokenize(state)
 
-                state.push('mark_close', 'mark', -1)
+        # 4. Restore the original posMax and advance the cursor past the closing marker.
+        state.posMax = old_pos_max
+        state.pos = scan_pos + 2
+        # --- END OF FIX ---
 
-            return True
-        scan_pos += 1
+        state.push('mark_close', 'mark', -1)
 
-    return False
+    return True
 
 def mark_plugin(md: MarkdownIt):
     """
@@ -344,9 +402,18 @@ def mark_plugin(md: MarkdownIt):
     md.inline.ruler.push('mark', mark_rule)
 
 EMBED_RE = re.compile(r'!\[\[([^\]]+)\]\]')
+# Embeds with these (lower-cased) suffixes are rendered as images
+IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg'})
 
 def embed_rule(state: StateInline, silent: bool):
-    match = EMBED_RE.match(state.src, state.pos)
+    # Cheap literal prefilter: the ruler calls us at every '!', but only '![['
+    # can start an embed, so most calls never reach the regex engine
+    src = state.src
+    pos = state.pos
+    if not src.startswith('![[', pos):
+        return False
+
+    match = EMBED_RE.match(src, pos)
     if not match:
         return False
 
@@ -390,8 +457,7 @@ def embed_rule(state: StateInline, silent: bool):
     resolved_path = Path(resolved_path_str)
 
     # --- Decide if it's an Image or a Transclusion ---
-    image_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg']
-    if resolved_path.suffix.lower() in image_extensions:
+    if resolved_path.suffix.lower() in IMAGE_EXTENSIONS:
         token = state.push('image', '', 0)
         # --- THE FIX IS HERE ---
         # Use a standard Python dictionary instead of AttrDict
@@ -21,6 +21,7 @@
 # ofmc/renderer.py
 import hashlib
 import importlib
+import os
 import re
 import shutil
 import urllib
@@ -32,49 +33,114 @@ from .utils import get_shared_latex_preamble
 # from .utils import fix_smaller_than
 # from .utils import replace_array_with_matrix_environments
 # from .utils import fix_mathbb_k
-from .utils import replace_tagged_dollars, split_inline_display_math
+from .utils import post_process_transclusion
 # from .utils import fix_align_environment
-from .utils import demote_headings
 # from .utils import fix_tcolorbox_label_tcolorbox
 from .utils import BUILTIN_POST_PROCESSORS
 
 from .content_extractor import ContentExtractor
 from markdown_it.token import Token
 
-import colorama
-from colorama import Fore, Style
-
 # Forward declaration for type hinting to avoid circular import error
 from typing import TYPE_CHECKING, List, Callable
 
 if TYPE_CHECKING:
     from .parser import OFMCompiler
 
+# This mapping is crucial for correctness.
+_LATEX_ESCAPE_MAP = {
+    '&': r'\&',
+    '%': r'\%',
+    '$': r'\$',
+    '#': r'\#',
+    '_': r'\_',
+    '{': r'\{',
+    '}': r'\}',
+    '~': r'\textasciitilde{}',
+    '^': r'\^{}',
+    '\\': r'\textbackslash{}',
+    '<': r'\textless{}',
+    '>': r'\textgreater{}',
+}
+# All keys are single characters, so one str.translate pass handles every
+# replacement in C without a Python callback per match.
+_LATEX_ESCAPE_TABLE = str.maketrans(_LATEX_ESCAPE_MAP)
+_LATEX_NEEDS_ESCAPE = re.compile(r'[&%$#_{}~^\\<>]')
+
+# Heading level (h1-h3) -> sectioning command; deeper levels use \paragraph
+_SECTION_BY_LEVEL = (None, r'\section', r'\subsection', r'\subsubsection')
+
+# Points where a link registry key can be split into note name and "#..." / "^..." part
+_REGISTRY_SPLIT_RE = re.compile(r'[#^]')
+
 def escape_latex(text: str) -> str:
     """
     Escapes characters with special meaning in LaTeX.
     """
-    # This mapping is crucial for correctness.
-    replacements = {
-        '&': r'\&',
-        '%': r'\%',
-        '$': r'\$',
-        '#': r'\#',
-        '_': r'\_',
-        '{': r'\{',
-        '}': r'\}',
-        '~': r'\textasciitilde{}',
-        '^': r'\^{}',
-        '\\': r'\textbackslash{}',
-        '<': r'\textless{}',
-        '>': r'\textgreater{}',
-    }
-    # Use a regex to perform all replacements in one go.
-    # This is more efficient and correct than chained .replace().
-    # The regex pattern is created by joining the escaped keys.
-    regex = re.compile('|'.join(re.escape(key) for key in replacements.keys()))
-    return regex.sub(lambda match: replacements[match.group(0)], text)
-    #return text
+    # Most prose, captions and file names contain no special characters;
+    # str.translate would still copy them character by character, while a
+    # failed character-class search is a single C-level scan.
+    if not _LATEX_NEEDS_ESCAPE.search(text):
+        return text
+    return text.translate(_LATEX_ESCAPE_TABLE)
+
+class _RenderState:
+    """Mutable state shared by the block handlers during one render_tokens call."""
+    __slots__ = ('in_table', 'table_current_col', 'in_header', 'skip_until_index', 'table_cols',
+                 'in_tcolorbox', 'callout_depth', 'inline_in_tcolorbox')
+
+    def __init__(self, in_tcolorbox: bool = False, callout_depth: int = 0):
+        self.in_table = False
+        self.table_current_col = 0
+        self.in_header = False
+        self.skip_until_index = -1
+        # table_open index -> number of columns, filled on the first table
+        self.table_cols = None
+        # Embedded content is always inside a tcolorbox; callouts open one too.
+        # inline_in_tcolorbox is what inline tokens receive, updated on callout open/close.
+        self.in_tcolorbox = in_tcolorbox
+        self.callout_depth = callout_depth
+        self.inline_in_tcolorbox = in_tcolorbox or callout_depth > 0
+
+# Column count -> tabularx column spec. A single column MUST be X to wrap.
+_COL_SPEC_CACHE = {1: 'X'}
+
+def _col_spec(num_cols: int) -> str:
+    """
+    Heuristic: First column 'l' (non-wrapping), rest 'X' (wrapping).
+    This works well for identifier/description tables.
+    """
+    col_spec = _COL_SPEC_CACHE.get(num_cols)
+    if col_spec is None:
+        col_spec = ' '.join(['l'] + ['X'] * (num_cols - 1))
+        _COL_SPEC_CACHE[num_cols] = col_spec
+    return col_spec
+
+def _count_table_columns(tokens: list[Token], start: int) -> dict[int, int]:
+    """
+    Maps the index of every table_open at or after start to the number of
+    th_open tokens in the first row that follows it.
+    """
+    table_cols = {}
+    pending = []
+    n = len(tokens)
+    j = start
+    while j < n:
+        token_type = tokens[j].type
+        if token_type == 'table_open':
+            pending.append(j)
+        elif token_type == 'tr_open' and pending:
+            num_cols = 0
+            j += 1
+            while j < n and tokens[j].type != 'tr_close':
+                if tokens[j].type == 'th_open':
+                    num_cols += 1
+                j += 1
+            for table_index in pending:
+                table_cols[table_index] = num_cols
+            pending.clear()
+        j += 1
+    return table_cols
 
 class LatexRenderer:
     """
@@ -87,6 +153,100 @@ class LatexRenderer:
         self.link_registry = link_registry or {}
         self.book_mode = book_mode
 
+        # note name -> {"#heading" / "^block_id": label}
+        self._note_registry = self._split_registry_by_note(self.link_registry)
+
+        # wikilink target -> (alias-free canonical lookup key, whether it is a local link)
+        self._wikilink_keys: dict[str, tuple[str, bool]] = {}
+
+        # abs_src_path -> (path string used in LaTeX, \includesvg or \includegraphics)
+        # for images already copied into build_assets_dir, so repeated figures
+        # skip hashing, file checks and path formatting.
+        self._image_cache: dict[Path, tuple[str, str]] = {}
+        # (absolute_path, sub_target, mtime_ns[, depth]) -> (rendered body, height),
+        # where height is how many embed levels the body itself contains.
+        # The depth element is only present for bodies cut off by MAX_RECURSION_DEPTH.
+        self._transclusion_cache: dict[tuple, tuple[str, int]] = {}
+        # Deepest recursion depth reached, and whether the depth limit was hit,
+        # inside the transclusion currently being rendered.
+        self._transclusion_reach = 0
+        self._transclusion_clamped = False
+        # (absolute_path, mtime_ns) -> ContentExtractor of that file
+        self._extractor_cache: dict[tuple[str, int], ContentExtractor] = {}
+
+        # token.type -> handler. Token types not listed here produce no output.
+        self._block_handlers = {
+            'heading_open': self._block_heading_open,
+            'heading_close': self._block_heading_close,
+            'paragraph_close': self._block_paragraph_close,
+            'inline': self._block_inline,
+            'fence': self._block_fence,
+            'bullet_list_open': self._block_list_open,
+            'bullet_list_close': self._block_list_close,
+            'ordered_list_open': self._block_list_open,
+            'ordered_list_close': self._block_list_close,
+            'list_item_open': self._block_list_item_open,
+            'list_item_close': self._block_list_item_close,
+            'table_open': self._block_table_open,
+            'blockquote_open': self._block_blockquote_open,
+            'blockquote_close': self._block_blockquote_close,
+            'callout_open': self._block_callout_open,
+            'callout_close': self._block_callout_close,
+        }
+        # Handlers used between table_open and table_close of a rendered table
+        self._table_handlers = {
+            **self._block_handlers,
+            'table_close': self._table_table_close,
+            'thead_open': self._table_thead_open,
+            'thead_close': self._table_thead_close,
+            'tbody_open': self._table_tbody_open,
+            'tr_open': self._table_tr_open,
+            'tr_close': self._table_tr_close,
+            'th_open': self._table_cell_open,
+            'td_open': self._table_cell_open,
+            'th_close': self._table_th_close,
+        }
+        # child.type -> handler, used by _render_inline.
+        self._inline_handlers = {
+            'text': self._inline_text,
+            'strong_open': self._inline_strong_open,
+            'strong_close': self._inline_close_brace,
+            'em_open': self._inline_em_open,
+            'em_close': self._inline_close_brace,
+            'mark_open': self._inline_mark_open,
+            'mark_close': self._inline_close_brace,
+            'wikilink': self._inline_wikilink,
+            'code_inline': self._inline_code_inline,
+            'math_inline': self._inline_math_inline,
+            'image': self._inline_image,
+            'transclusion': self._inline_transclusion,
+            'math_single': self._inline_math_single,
+            'math_block': self._inline_math_block,
+            'softbreak': self._inline_softbreak,
+            'hardbreak': self._inline_hardbreak,
+        }
+
+    @staticmethod
+    def _split_registry_by_note(link_registry: dict) -> dict[str, dict[str, str]]:
+        """
+        Groups "note#heading" and "note^id" registry keys by note name, so
+        per-note lookups don't need to rebuild the full key. A key is stored
+        under every '#' / '^' split point, which keeps lookups exact even when
+        a heading itself contains those characters.
+        """
+        note_registry = {}
+        for key, label in link_registry.items():
+            for match in _REGISTRY_SPLIT_RE.finditer(key):
+                pos = match.start()
+                note_registry.setdefault(key[:pos], {})[key[pos:]] = label
+        return note_registry
+
+    # build_assets_dir 中本进程已经复制或确认存在的图片，所有渲染器共享
+    _copied_assets: set[Path] = set()
+
+    # 最多保留多少个文件的 ContentExtractor
+    EXTRACTOR_CACHE_SIZE = 64
+
     CALLOUT_COLORS = {
         'note': 'blue',
         'abstract': 'cyan',
@@ -108,217 +268,210 @@ class LatexRenderer:
         output = []
 
         # --- STATE MANAGEMENT VARIABLES ---
-        in_table = False
-        table_current_col = 0
-        in_header = False
-
-        skip_until_index = -1
+        state = _RenderState(env.get("in_tcolorbox", False), env.get('in_callout', 0))
+        # Bound to locals once: these are used for every token
+        get_handler = self._block_handlers.get
 
         # Main rendering loop
         for i, token in enumerate(tokens):
             # --- Check if we should skip this token ---
-            if i <= skip_until_index:
+            if i <= state.skip_until_index:
                 continue
 
-            if token.type == 'heading_open':
-                level = int(token.tag[1:])
-                # --- 获取标题文本 ---
-                # heading_open 后面紧跟着一个 inline token，它的内容就是标题
-                inline_token = tokens[i + 1]
-                # 我们需要渲染它以处理其中的 markdown，例如 `code`
-                heading_content = self.render_inline_content_only(inline_token.children, env)
-
-                section_map = {1: r'\section', 2: r'\subsection', 3: r'\subsubsection'}
-                output.append(f"{section_map.get(level, r'\paragraph')}{{{heading_content}}}")
-
-                # +++ 新增：放置标题锚点 +++
-                if self.book_mode:
-                    current_note = env.get('current_note_name', '')
-                    # 需要用原始文本来匹配，而不是渲染后的
-                    original_heading_text = inline_token.content.strip()
-                    target_key = f"{current_note}#{original_heading_text}"
-                    if target_key in self.link_registry:
-                        label = self.link_registry[target_key]
-                        output.append(f"\\label{{{label}}}")
-
-                # 4. Add spacing after the heading block
-                output.append("\n\n")
-
-                # 5. --- Crucially, tell the loop to skip the processed tokens ---
-                # We have processed tokens at index i, i+1, and i+2.
-                # The next iteration should start at i+3.
-                skip_until_index = i + 2
-
-            elif token.type == 'heading_close':
-                output.append("\n\n")  # 仅换行，不再需要闭合括号
-
-            elif token.type == 'paragraph_open':
-                # LaTeX handles paragraphs with double newlines.
-                # We only add a newline at the end.
-                pass
-            elif token.type == 'paragraph_close':
-                # +++ 修改：在段落结束时检查并放置块ID锚点 +++
-                # paragraph_open 之前的 token 是 inline token
-                inline_token = tokens[i-1]
-                if self.book_mode and inline_token.meta.get('latex_label'):
-                    output.append(f"\\label{{{inline_token.meta['latex_label']}}}")
-                output.append("\n\n")
-
-            elif token.type == 'inline':
-                itc = env.get("in_tcolorbox", False)
-                if env.get('in_callout', 0) > 0:
-                    itc = True
-                self._render_inline(token, output, env, in_tcolorbox=itc)
-
-            elif token.type == 'fence':
-                lang = token.info.split(' ')[0] if token.info else ""
-                # For now, we use verbatim. Listings package would be better for syntax highlighting.
-                output.append(f"\\begin{{verbatim}}\n{token.content.strip()}\n\\end{{verbatim}}\n\n")
-
-            elif token.type == 'bullet_list_open':
-                output.append("\\begin{itemize}\n")
-            elif token.type == 'bullet_list_close':
-                output.append("\\end{itemize}\n\n")
-            
-            elif token.type == 'ordered_list_open':
-                output.append("\\begin{itemize}\n")
-            elif token.type == 'ordered_list_close':
-                output.append("\\end{itemize}\n\n")
-
-            elif token.type == 'list_item_open':
-                output.append(r"\item ")
-            elif token.type == 'list_item_close':
-                output.append("\n")
-
-            elif token.type == 'table_open':
-                # ALWAYS use tabularx for robust, wrapping tables.
-                # This simplifies logic and prevents page overflow.
-
-                num_cols = 0
-                # Look ahead to count columns.
-                for j in range(i + 1, len(tokens)):
-                    if tokens[j].type == 'tr_open':
-                        for k in range(j + 1, len(tokens)):
-                            if tokens[k].type == 'th_open':
-                                num_cols += 1
-                            elif tokens[k].type == 'tr_close':
-                                break
-                        break
-
-                if num_cols > 0:
-                    # Heuristic: First column 'l' (non-wrapping), rest 'X' (wrapping).
-                    # This works well for identifier/description tables.
-                    if num_cols == 1:
-                        col_specs = ['X']  # A single column MUST be X to wrap
-                    else:
-                        col_specs = ['l'] + ['X'] * (num_cols - 1)
-
-                    col_spec = ' '.join(col_specs)
-
-                    output.append(f"\\begin{{tabularx}}{{\\textwidth}}{{ {col_spec} }}\n\\toprule\n")
-                    in_table = True
-                else:
-                    in_table = False
-
-            elif token.type == 'table_close':
-                if not in_table: continue
-                # ALWAYS close with tabularx, matching the open tag.
-                output.append("\\bottomrule\n\\end{tabularx}\n\n")
-                in_table = False
-
-            elif token.type == 'thead_open':
-                if not in_table: continue
-                in_header = True
-
-            elif token.type == 'thead_close':
-                if not in_table: continue
-                output.append("\\midrule\n")  # Line between header and body
-                in_header = False
-
-            elif token.type == 'tbody_open':
-                if not in_table: continue
-                table_current_col = 0  # Reset for the body
-
-            elif token.type == 'tr_open':
-                if not in_table: continue
-                table_current_col = 0  # Reset for each new row
-
-            elif token.type == 'tr_close':
-                if not in_table: continue
-                output.append(" \\\\\n")  # End of a row
-
-            elif token.type == 'th_open' or token.type == 'td_open':
-                if not in_table: continue
-                table_current_col += 1
-                if table_current_col > 1:
-                    output.append(" & ")
-                if token.type == 'th_open':
-                    output.append("\\textbf{")  # Make headers bold
-
-            elif token.type == 'th_close':
-                if not in_table: continue
-                output.append("}")  # Close \textbf
-
-            # td_close requires no action
-            # --- END: ROBUST TABLE RENDERING LOGIC ---
-
-            # +++ ADDED RULE FOR REGULAR BLOCKQUOTES +++
-            elif token.type == 'blockquote_open':
-                output.append("\\begin{quote}\n")
-            elif token.type == 'blockquote_close':
-                output.append("\\end{quote}\n\n")
-
-            elif token.type == 'callout_open':
-                callout_type = token.info
-                title = token.meta.get('title')
-
-                # Default to the type itself if no specific title is given
-                if not title:
-                    title = callout_type.capitalize()
-
-                color = self.CALLOUT_COLORS.get(callout_type, 'gray')
-
-                env['in_callout'] = env.get('in_callout', 0) + 1
-
-                # Construct the tcolorbox environment
-                # Note the use of f-string and braces to generate LaTeX code
-                output.append(
-                    f"\\begin{{tcolorbox}}["
-                    f"colback={color}!5!white, "
-                    f"colframe={color}!75!black, coltext=black,"
-                    f"fonttitle=\\bfseries, breakable, "
-                    f"title={{{escape_latex(title)}}}"  # Escape the title text
-                    f"]\n"
-                )
-            elif token.type == 'callout_close':
-                env['in_callout'] = max(0, env.get('in_callout', 0) - 1)
-                output.append("\\end{tcolorbox}\n\n")
+            handler = get_handler(token.type)
+            if handler:
+                handler(token, i, tokens, output, env, state)
 
         return "".join(output)
 
+    def _block_heading_open(self, token, i, tokens, output, env, state):
+        level = int(token.tag[1:])
+        # --- 获取标题文本 ---
+        # heading_open 后面紧跟着一个 inline token，它的内容就是标题
+        inline_token = tokens[i + 1]
+        # 我们需要渲染它以处理其中的 markdown，例如 `code`
+        heading_content = self.render_inline_content_only(inline_token.children, env)
+
+        section_cmd = _SECTION_BY_LEVEL[level] if level <= 3 else r'\paragraph'
+        output.append(f"{section_cmd}{{{heading_content}}}")
+
+        # +++ 新增：放置标题锚点 +++
+        if self.book_mode:
+            note_labels = self._note_registry.get(env.get('current_note_name', ''))
+            if note_labels:
+                # 需要用原始文本来匹配，而不是渲染后的
+                label = note_labels.get('#' + inline_token.content.strip())
+                if label is not None:
+                    output.append(f"\\label{{{label}}}")
+
+        # 4. Add spacing after the heading block
+        output.append("\n\n")
+
+        # 5. --- Crucially, tell the loop to skip the processed tokens ---
+        # We have processed tokens at index i, i+1, and i+2.
+        # The next iteration should start at i+3.
+        state.skip_until_index = i + 2
+
+    def _block_heading_close(self, token, i, tokens, output, env, state):
+        output.append("\n\n")  # 仅换行，不再需要闭合括号
+
+    def _block_paragraph_close(self, token, i, tokens, output, env, state):
+        # +++ 修改：在段落结束时检查并放置块ID锚点 +++
+        # paragraph_open 之前的 token 是 inline token
+        if self.book_mode:
+            label = tokens[i-1].meta.get('latex_label')
+            if label:
+                output.append(f"\\label{{{label}}}")
+        output.append("\n\n")
+
+    def _block_inline(self, token, i, tokens, output, env, state):
+        self._render_inline(token, output, env, in_tcolorbox=state.inline_in_tcolorbox)
+
+    def _block_fence(self, token, i, tokens, output, env, state):
+        # For now, we use verbatim. Listings package would be better for syntax highlighting.
+        output.append(f"\\begin{{verbatim}}\n{token.content.strip()}\n\\end{{verbatim}}\n\n")
+
+    def _block_list_open(self, token, i, tokens, output, env, state):
+        output.append("\\begin{itemize}\n")
+
+    def _block_list_close(self, token, i, tokens, output, env, state):
+        output.append("\\end{itemize}\n\n")
+
+    def _block_list_item_open(self, token, i, tokens, output, env, state):
+        output.append(r"\item ")
+
+    def _block_list_item_close(self, token, i, tokens, output, env, state):
+        output.append("\n")
+
+    def _block_table_open(self, token, i, tokens, output, env, state):
+        # ALWAYS use tabularx for robust, wrapping tables.
+        # This simplifies logic and prevents page overflow.
+
+        # Column counts of every table from here on are computed in a single
+        # pass the first time a table is reached.
+        if state.table_cols is None:
+            state.table_cols = _count_table_columns(tokens, i)
+        num_cols = state.table_cols.get(i, 0)
+
+        if num_cols > 0:
+            col_spec = _col_spec(num_cols)
+
+            output.append(f"\\begin{{tabularx}}{{\\textwidth}}{{ {col_spec} }}\n\\toprule\n")
+            state.in_table = True
+        else:
+            # Without a header row the table is not rendered as a table; the
+            # table-internal tokens are not in _block_handlers and are ignored.
+            state.in_table = False
+            return
+
+        # Render the table body here, so the table-internal handlers only ever
+        # run inside an open table and need no in_table guard of their own.
+        handlers = self._table_handlers
+        j = i
+        for j in range(i + 1, len(tokens)):
+            cell_token = tokens[j]
+            handler = handlers.get(cell_token.type)
+            if handler:
+                handler(cell_token, j, tokens, output, env, state)
+            if not state.in_table:
+                break
+        state.skip_until_index = j
+
+    def _table_table_close(self, token, i, tokens, output, env, state):
+        # ALWAYS close with tabularx, matching the open tag.
+        output.append("\\bottomrule\n\\end{tabularx}\n\n")
+        state.in_table = False
+
+    def _table_thead_open(self, token, i, tokens, output, env, state):
+        state.in_header = True
+
+    def _table_thead_close(self, token, i, tokens, output, env, state):
+        output.append("\\midrule\n")  # Line between header and body
+        state.in_header = False
+
+    def _table_tbody_open(self, token, i, tokens, output, env, state):
+        state.table_current_col = 0  # Reset for the body
+
+    def _table_tr_open(self, token, i, tokens, output, env, state):
+        state.table_current_col = 0  # Reset for each new row
+
+    def _table_tr_close(self, token, i, tokens, output, env, state):
+        output.append(" \\\\\n")  # End of a row
+
+    def _table_cell_open(self, token, i, tokens, output, env, state):
+        state.table_current_col += 1
+        if state.table_current_col > 1:
+            output.append(" & ")
+        if token.type == 'th_open':
+            output.append("\\textbf{")  # Make headers bold
+
+    def _table_th_close(self, token, i, tokens, output, env, state):
+        output.append("}")  # Close \textbf
+
+    # td_close requires no action
+    # --- END: ROBUST TABLE RENDERING LOGIC ---
+
+    # +++ ADDED RULE FOR REGULAR BLOCKQUOTES +++
+    def _block_blockquote_open(self, token, i, tokens, output, env, state):
+        output.append("\\begin{quote}\n")
+
+    def _block_blockquote_close(self, token, i, tokens, output, env, state):
+        output.append("\\end{quote}\n\n")
+
+    def _block_callout_open(self, token, i, tokens, output, env, state):
+        callout_type = token.info
+        title = token.meta.get('title')
+
+        # Default to the type itself if no specific title is given
+        if not title:
+            title = callout_type.capitalize()
+
+        color = self.CALLOUT_COLORS.get(callout_type, 'gray')
+
+        state.callout_depth += 1
+        state.inline_in_tcolorbox = True
+
+        # Construct the tcolorbox environment
+        # Note the use of f-string and braces to generate LaTeX code
+        output.append(
+            f"\\begin{{tcolorbox}}["
+            f"colback={color}!5!white, "
+            f"colframe={color}!75!black, coltext=black,"
+            f"fonttitle=\\bfseries, breakable, "
+            f"title={{{escape_latex(title)}}}"  # Escape the title text
+            f"]\n"
+        )
+
+    def _block_callout_close(self, token, i, tokens, output, env, state):
+        state.callout_depth = max(0, state.callout_depth - 1)
+        state.inline_in_tcolorbox = state.in_tcolorbox or state.callout_depth > 0
+        output.append("\\end{tcolorbox}\n\n")
+
     def render_inline_content_only(self, children: list[Token], env: dict) -> str:
         """
         一个简化的 _render_inline，它将一系列 inline token 渲染成一个字符串。
         现在支持文本、代码、粗体、斜体和行内公式。
         """
         temp_output = []
+        append = temp_output.append
         for child in children:
-            if child.type == 'text':
-                temp_output.append(escape_latex(child.content))
-            elif child.type == 'strong_open':
-                temp_output.append(r"\textbf{")
-            elif child.type == 'strong_close':
-                temp_output.append("}")
-            elif child.type == 'em_open':
-                temp_output.append(r"\textit{")
-            elif child.type == 'em_close':
-                temp_output.append("}")
-            elif child.type == 'code_inline':
-                temp_output.append(r"\texttt{" + escape_latex(child.content) + "}")
+            child_type = child.type
+            if child_type == 'text':
+                append(escape_latex(child.content))
+            elif child_type == 'strong_open':
+                append(r"\textbf{")
+            elif child_type == 'strong_close':
+                append("}")
+            elif child_type == 'em_open':
+                append(r"\textit{")
+            elif child_type == 'em_close':
+                append("}")
+            elif child_type == 'code_inline':
+                append(r"\texttt{" + escape_latex(child.content) + "}")
             # --- 新增的公式支持 ---
-            elif child.type == 'math_inline':
+            elif child_type == 'math_inline':
                 # texmath_plugin 已经处理好了内容，我们只需加上 $
-                temp_output.append(f"${child.content}$")
+                append(f"${child.content}$")
             # 你可以根据需要添加更多 token 类型
 
         return "".join(temp_output)
@@ -329,200 +482,292 @@ class LatexRenderer:
             #output.append(token.content)
             return
 
+        # Bound to locals once: these are used for every child token
+        get_handler = self._inline_handlers.get
+        append = output.append
         for child in token.children:
-            if child.type == 'text':
-                output.append(escape_latex(child.content))
-                #output.append(child.content)
-            elif child.type == 'strong_open':
-                output.append(r"\textbf{")
-            elif child.type == 'strong_close':
-                output.append("}")
-            elif child.type == 'em_open':
-                output.append(r"\textit{")
-            elif child.type == 'em_close':
-                output.append("}")
-            # --- MODIFICATION START ---
-            elif child.type == 'mark_open':
-                output.append(r"\hl{")
-            elif child.type == 'mark_close':
-                output.append("}")
-            # --- MODIFICATION END ---
-
-            elif child.type == 'wikilink':
-                escaped_content = escape_latex(child.content)
-
-                if not self.book_mode:
-                    output.append(f"\\textcolor{{blue}}{{{escaped_content}}}")
-                else:
-                    # --- START: FINALIZED LINKING LOGIC ---
-
-                    # original_target can be "Note#^id|alias"
-                    original_target = child.meta.get('target', '')
-
-                    # Step 1: CRITICAL FIX - Strip the alias part.
-                    # The actual link target is everything before the first '|'.
-                    # If no '|' exists, this safely returns the original string.
-                    link_path = original_target.split('|', 1)[0]
-
-                    # Step 2: Initialize lookup_key with the clean path.
-                    lookup_key = link_path
-
-                    # Step 3: Prepend current note if link is local (e.g., [[#A Heading]])
-                    if link_path.startswith(('#', '^')):
-                        current_note = env.get('current_note_name', '')
-                        lookup_key = f"{current_note}{link_path}"
-
-                    # Step 4: Normalize the "note#^id" format to our canonical "note^id".
-                    if '#^' in lookup_key:
-                        lookup_key = lookup_key.replace('#^', '^', 1)
-
-                    # Now, lookup_key is fully canonical and ready for lookup.
-                    if lookup_key in self.link_registry:
-                        label = self.link_registry[lookup_key]
-                        output.append(f"\\hyperref[{label}]{{{escaped_content}}}")
-                        # print(f"{Fore.CYAN} OK [DEBUG] Found key [[{original_target}]] in note '{env.get('current_note_name', '')}' with look up key '{lookup_key}' successfully.{Style.RESET_ALL}")
-                    else:
-                        # The warning remains for genuinely broken links.
-                        #print(
-                        #    f"{Fore.YELLOW}⚠️  [Warning] Broken link found: [[{original_target}]] in note '{env.get('current_note_name', '')}' (Lookup key: '{lookup_key}'){Style.RESET_ALL}")
-                        output.append(f"\\textcolor{{red}}{{{escaped_content}}}")
-                    # --- END: FINALIZED LINKING LOGIC ---
-
-            elif child.type == 'code_inline':
-                output.append(r"\texttt{" + escape_latex(child.content) + "}")
-            elif child.type == 'math_inline':
-                output.append(f"${child.content}$")
-
-            elif child.type == 'image':
-                # --- Step 1: Get original data from token (your code) ---
-                original_src = child.attrs.get('src', '')
-                caption = escape_latex(child.content)
-
-                # --- Step 2: Resolve path and create a unique, safe asset path ---
-                # Decode URL-encoded characters like '%20' for spaces
-                decoded_src = urllib.parse.unquote(original_src)
-
-                # Skip web URLs, as we can't process them locally
-                if decoded_src.startswith(('http://', 'https://')):
-                    output.append(f"\\textcolor{{red}}{{Web image skipped: {escape_latex(decoded_src)}}}")
-                    continue
-
-                # Get necessary paths from the environment dictionary
-                current_file: Path = env['current_file']
-                build_assets_dir: Path = env['build_assets_dir']
-
-                # Resolve the src path to an absolute path
-                if Path(decoded_src).is_absolute():
-                    abs_src_path = Path(decoded_src)
-                else:
-                    # Relative paths are relative to the current note's directory
-                    abs_src_path = (current_file.parent / decoded_src).resolve()
-
-                # Safety check: if the source image doesn't exist, report error and skip
-                if not abs_src_path.exists():
-                    output.append(f"\\textcolor{{red}}{{Image not found: {escape_latex(str(abs_src_path))}}}")
-                    continue
-
-                # Create a unique filename using a hash of its absolute path
-                # This is the key to solving the name collision problem
-                path_hash = hashlib.sha1(str(abs_src_path).encode('utf-8')).hexdigest()
-                unique_filename = f"{path_hash}{abs_src_path.suffix}"
-
-                # Define the destination path in the build's 'assets' directory
-                dest_path = build_assets_dir / unique_filename
-
-                # Copy the file only if it doesn't already exist in the destination
+            child_type = child.type
+            # Plain text is by far the most common child; handle it without a method call
+            if child_type == 'text':
+                append(escape_latex(child.content))
+                continue
+            handler = get_handler(child_type)
+            if handler:
+                handler(child, output, env, in_tcolorbox)
+
+    def _inline_text(self, child, output, env, in_tcolorbox):
+        output.append(escape_latex(child.content))
+        #output.append(child.content)
+
+    def _inline_strong_open(self, child, output, env, in_tcolorbox):
+        output.append(r"\textbf{")
+
+    def _inline_em_open(self, child, output, env, in_tcolorbox):
+        output.append(r"\textit{")
+
+    # --- MODIFICATION START ---
+    def _inline_mark_open(self, child, output, env, in_tcolorbox):
+        output.append(r"\hl{")
+    # --- MODIFICATION END ---
+
+    def _inline_close_brace(self, child, output, env, in_tcolorbox):
+        # strong_close / em_close / mark_close
+        output.append("}")
+
+    def _inline_wikilink(self, child, output, env, in_tcolorbox):
+        escaped_content = escape_latex(child.content)
+
+        if not self.book_mode:
+            output.append(f"\\textcolor{{blue}}{{{escaped_content}}}")
+            return
+
+        # --- START: FINALIZED LINKING LOGIC ---
+
+        # original_target can be "Note#^id|alias"
+        original_target = child.meta.get('target', '')
+
+        # Steps 1-2 only depend on the target text, so their result is cached per target.
+        cached = self._wikilink_keys.get(original_target)
+        if cached is None:
+            # Step 1: CRITICAL FIX - Strip the alias part.
+            # The actual link target is everything before the first '|'.
+            # If no '|' exists, this safely returns the original string.
+            link_path = original_target.split('|', 1)[0]
+
+            # Step 2: Normalize the "note#^id" format to our canonical "note^id".
+            lookup_key = link_path
+            if '#^' in lookup_key:
+                lookup_key = lookup_key.replace('#^', '^', 1)
+
+            cached = (lookup_key, lookup_key.startswith(('#', '^')))
+            self._wikilink_keys[original_target] = cached
+        lookup_key, is_local = cached
+
+        # Step 3: Local links (e.g., [[#A Heading]]) are looked up in the
+        # current note's part of the registry, without building "note#..." keys.
+        if is_local:
+            note_labels = self._note_registry.get(env.get('current_note_name', ''), {})
+            label = note_labels.get(lookup_key)
+        else:
+            label = self.link_registry.get(lookup_key)
+
+        # Step 4: Known targets become hyperrefs, everything else is a broken link.
+        if label is not None:
+            output.append(f"\\hyperref[{label}]{{{escaped_content}}}")
+            # print(f"{Fore.CYAN} OK [DEBUG] Found key [[{original_target}]] in note '{env.get('current_note_name', '')}' with look up key '{lookup_key}' successfully.{Style.RESET_ALL}")
+        else:
+            # The warning remains for genuinely broken links.
+            #print(
+            #    f"{Fore.YELLOW}⚠️  [Warning] Broken link found: [[{original_target}]] in note '{env.get('current_note_name', '')}' (Lookup key: '{lookup_key}'){Style.RESET_ALL}")
+            output.append(f"\\textcolor{{red}}{{{escaped_content}}}")
+        # --- END: FINALIZED LINKING LOGIC ---
+
+    def _inline_code_inline(self, child, output, env, in_tcolorbox):
+        output.append(r"\texttt{" + escape_latex(child.content) + "}")
+
+    def _inline_math_inline(self, child, output, env, in_tcolorbox):
+        output.append(f"${child.content}$")
+
+    def _inline_image(self, child, output, env, in_tcolorbox):
+        # --- Step 1: Get original data from token (your code) ---
+        original_src = child.attrs.get('src', '')
+        caption = escape_latex(child.content)
+
+        # --- Step 2: Resolve path and create a unique, safe asset path ---
+        # Decode URL-encoded characters like '%20' for spaces
+        decoded_src = urllib.parse.unquote(original_src)
+
+        # Skip web URLs, as we can't process them locally
+        if decoded_src.startswith(('http://', 'https://')):
+            output.append(f"\\textcolor{{red}}{{Web image skipped: {escape_latex(decoded_src)}}}")
+            return
+
+        # Get necessary paths from the environment dictionary
+        current_file: Path = env['current_file']
+        build_assets_dir: Path = env['build_assets_dir']
+
+        # Resolve the src path to an absolute path
+        if Path(decoded_src).is_absolute():
+            abs_src_path = Path(decoded_src)
+        else:
+            # Relative paths are relative to the current note's directory
+            abs_src_path = (current_file.parent / decoded_src).resolve()
+
+        cached = self._image_cache.get(abs_src_path)
+        if cached is not None:
+            # Already hashed and copied by an earlier occurrence of this image
+            latex_path, include_cmd = cached
+        else:
+            # Safety check: if the source image doesn't exist, report error and skip
+            if not abs_src_path.exists():
+                output.append(f"\\textcolor{{red}}{{Image not found: {escape_latex(str(abs_src_path))}}}")
+                return
+
+            # Create a unique filename using a hash of its absolute path
+            # This is the key to solving the name collision problem
+            path_hash = hashlib.sha1(str(abs_src_path).encode('utf-8')).hexdigest()
+            unique_filename = f"{path_hash}{abs_src_path.suffix}"
+
+            # Define the destination path in the build's 'assets' directory
+            dest_path = build_assets_dir / unique_filename
+
+            # Copy the file only if it doesn't already exist in the destination.
+            # Destinations copied earlier in this process skip the check.
+            if dest_path not in LatexRenderer._copied_assets:
                 if not dest_path.exists():
                     shutil.copyfile(abs_src_path, dest_path)
+                LatexRenderer._copied_assets.add(dest_path)
+
+            # This is the new, safe path that LaTeX will use (e.g., "assets/a1b2c3d4.svg")
+            latex_path = str(dest_path)
+            # We check the suffix of the ORIGINAL file to decide the command
+            include_cmd = "\\includesvg" if abs_src_path.suffix.lower() == '.svg' else "\\includegraphics"
+
+            self._image_cache[abs_src_path] = (latex_path, include_cmd)
+
+        # --- Step 3: Use your existing logic for width and command generation ---
+        # 1. Start with a default width (your code)
+        width_option = "width=0.4\\textwidth"
+
+        # 2. Check for custom size in metadata (your code)
+        wikilink_meta = child.meta.get('wikilink', {}).get('raw_meta')
+        if wikilink_meta and wikilink_meta.strip().isdigit():
+            try:
+                obsidian_size = int(wikilink_meta.strip())
+                converted_size = (obsidian_size * 190) // 390
+                final_size = min(converted_size, 350)
+                width_option = f"width={final_size}pt"
+            except ValueError:
+                pass  # Fallback to default if conversion fails
+
+        # 3. Build the LaTeX command, but with the NEW, SAFE path
+        image_cmd = f"{include_cmd}[{width_option}]{{{latex_path}}}"
+
+        if in_tcolorbox:
+            output.append(
+                f"\n\\begin{{center}}\n{image_cmd}\n\n"
+                f"\\textit{{{caption}}}\n\\end{{center}}\n"
+            )
+        else:
+            output.append(
+                f"\n\\begin{{figure}}[h!]\n"
+                f"\\centering\n"
+                f"{image_cmd}\n"
+                f"\\caption{{{caption}}}\n"
+                f"\\end{{figure}}\n"
+            )
+
+    def _inline_transclusion(self, child, output, env, in_tcolorbox):
+        meta = child.meta
+        # 外层嵌入的深度统计，本次嵌入渲染完后合并回去
+        outer_reach = self._transclusion_reach
+        outer_clamped = self._transclusion_clamped
+        try:
+            new_depth = env.get('recursion_depth', 0) + 1
+            # 同一文件片段被多次嵌入时直接复用结果；mtime 变化后键随之改变。
+            mtime_ns = os.stat(meta['absolute_path']).st_mtime_ns
+            base_key = (meta['absolute_path'], meta['sub_target'] or '', mtime_ns)
+            child_tex = self._lookup_transclusion(base_key, new_depth)
+
+            if child_tex is None:
+                self._transclusion_reach = new_depth
+                self._transclusion_clamped = new_depth > self.compiler.MAX_RECURSION_DEPTH
+
+                extractor = self._get_extractor(meta['absolute_path'], mtime_ns)
+                sliced_md = extractor.extract(meta['sub_target'])
+
+                if sliced_md is None:
+                    raise ValueError("Target not found in file.")
+
+                # --- RECURSIVE CALL ---
+                child_tex = self.compiler._compile_body(
+                    sliced_md, Path(meta['absolute_path']), new_depth
+                )
 
-                # This is the new, safe path that LaTeX will use (e.g., "assets/a1b2c3d4.svg")
-                new_latex_path = build_assets_dir / unique_filename
-
-                # --- Step 3: Use your existing logic for width and command generation ---
-                # 1. Start with a default width (your code)
-                width_option = "width=0.4\\textwidth"
-
-                # 2. Check for custom size in metadata (your code)
-                wikilink_meta = child.meta.get('wikilink', {}).get('raw_meta')
-                if wikilink_meta and wikilink_meta.strip().isdigit():
-                    try:
-                        obsidian_size = int(wikilink_meta.strip())
-                        converted_size = (obsidian_size * 190) // 390
-                        final_size = min(converted_size, 350)
-                        width_option = f"width={final_size}pt"
-                    except ValueError:
-                        pass  # Fallback to default if conversion fails
-
-                # 3. Build the LaTeX command, but with the NEW, SAFE path
-                # We check the suffix of the ORIGINAL file to decide the command
-                if abs_src_path.suffix.lower() == '.svg':
-                    image_cmd = f"\\includesvg[{width_option}]{{{str(new_latex_path)}}}"
-                else:
-                    image_cmd = f"\\includegraphics[{width_option}]{{{str(new_latex_path)}}}"
-
-                if in_tcolorbox:
-                    output.append(
-                        f"\n\\begin{{center}}\n{image_cmd}\n\n"
-                        f"\\textit{{{caption}}}\n\\end{{center}}\n"
-                    )
-                else:
-                    output.append(
-                        f"\n\\begin{{figure}}[h!]\n"
-                        f"\\centering\n"
-                        f"{image_cmd}\n"
-                        f"\\caption{{{caption}}}\n"
-                        f"\\end{{figure}}\n"
-                    )
-
-            elif child.type == 'transclusion':
-                meta = child.meta
-                try:
-                    with open(meta['absolute_path'], 'r', encoding='utf-8') as f:
-                        content = f.read()
-
-                    extractor = ContentExtractor(content, pre_processor_chain=self.compiler.pre_processor_chain)
-                    sliced_md = extractor.extract(meta['sub_target'])
-
-                    if sliced_md is None:
-                        raise ValueError("Target not found in file.")
-
-                    # --- RECURSIVE CALL ---
-                    new_depth = env.get('recursion_depth', 0) + 1
-                    child_tex = self.compiler._compile_body(
-                        sliced_md, Path(meta['absolute_path']), new_depth
-                    )
-
-                    child_tex = demote_headings(child_tex)
-                    child_tex = replace_tagged_dollars(split_inline_display_math((child_tex)))
-
-                    # Wrap the embedded content in a styled box
-                    output.append(
-                        f"\\begin{{tcolorbox}}["
-                        f"colback=black!5!white, colframe=black!75!white, coltext=black,"
-                        f"title={{{escape_latex(Path(meta['absolute_path']).name)}}}, "
-                        f"breakable, "
-                        f"fonttitle=\\small\\ttfamily]\n"
-                        f"{child_tex}\n"
-                        f"\\end{{tcolorbox}}\n"
-                    )
-
-                except Exception as e:
-                    output.append(f"\\textcolor{{red}}{{\\textbf{{Error embedding "
-                                  f"{escape_latex(Path(meta['absolute_path']).name)}}}: {escape_latex(str(e))}}}")
-
-            # +++ THE FINAL, CRITICAL FIX +++
-            # Add this block right after 'math_inline'
-            elif child.type == 'math_single':
-                # Render single-char math exactly like inline math
-                output.append(f"${escape_latex(child.content)}$")
-            # ++++++++++++++++++++++++++++++++
-
-            elif child.type == 'math_block': # Sometimes parsed as an inline child
-                 output.append(f"\\[\n{child.content}\n\\]")
-            elif child.type == 'softbreak':
-                output.append(" ") # Treat softbreaks as spaces
-            elif child.type == 'hardbreak':
-                output.append("\\\\\n") # Hard line break
+                child_tex = post_process_transclusion(child_tex)
+                self._store_transclusion(base_key, new_depth, child_tex)
+
+            # Wrap the embedded content in a styled box
+            output.append(
+                f"\\begin{{tcolorbox}}["
+                f"colback=black!5!white, colframe=black!75!white, coltext=black,"
+                f"title={{{escape_latex(Path(meta['absolute_path']).name)}}}, "
+                f"breakable, "
+                f"fonttitle=\\small\\ttfamily]\n"
+                f"{child_tex}\n"
+                f"\\end{{tcolorbox}}\n"
+            )
+
+        except Exception as e:
+            output.append(f"\\textcolor{{red}}{{\\textbf{{Error embedding "
+                          f"{escape_latex(Path(meta['absolute_path']).name)}}}: {escape_latex(str(e))}}}")
+        finally:
+            self._transclusion_reach = max(outer_reach, self._transclusion_reach)
+            self._transclusion_clamped = outer_clamped or self._transclusion_clamped
+
+    def _lookup_transclusion(self, base_key: tuple, depth: int) -> str | None:
+        """
+        Returns the cached body of a transclusion rendered at the given depth,
+        or None. Only the recursion limit makes the output depth dependent, so a
+        result whose embed chain never reached the limit is shared by every depth
+        at which the chain still fits; results cut off by the limit are only
+        reused at the depth they were rendered at.
+        """
+        max_depth = self.compiler.MAX_RECURSION_DEPTH
+        entry = self._transclusion_cache.get(base_key)
+        clamped = False
+        if entry is None or depth + entry[1] > max_depth:
+            entry = self._transclusion_cache.get(base_key + (depth,))
+            clamped = True
+        if entry is None:
+            return None
+
+        child_tex, height = entry
+        self._transclusion_reach = depth + height
+        self._transclusion_clamped = clamped
+        return child_tex
+
+    def _store_transclusion(self, base_key: tuple, depth: int, child_tex: str):
+        """Caches a freshly rendered transclusion, see _lookup_transclusion."""
+        height = self._transclusion_reach - depth
+        if self._transclusion_clamped:
+            self._transclusion_cache[base_key + (depth,)] = (child_tex, height)
+        else:
+            self._transclusion_cache[base_key] = (child_tex, height)
+
+    def _get_extractor(self, absolute_path: str, mtime_ns: int) -> ContentExtractor:
+        """
+        Returns the ContentExtractor of a file, reusing it while the file's mtime
+        is unchanged, so embedding several parts of one note parses it only once.
+        """
+        key = (absolute_path, mtime_ns)
+        extractor = self._extractor_cache.get(key)
+        if extractor is None:
+            with open(absolute_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+
+            extractor = ContentExtractor(content, pre_processor_chain=self.compiler.pre_processor_chain)
+            if len(self._extractor_cache) >= self.EXTRACTOR_CACHE_SIZE:
+                # 丢弃最早加入的条目
+                del self._extractor_cache[next(iter(self._extractor_cache))]
+            self._extractor_cache[key] = extractor
+        return extractor
+
+    # +++ THE FINAL, CRITICAL FIX +++
+    def _inline_math_single(self, child, output, env, in_tcolorbox):
+        # Render single-char math exactly like inline math
+        output.append(f"${escape_latex(child.content)}$")
+    # ++++++++++++++++++++++++++++++++
+
+    def _inline_math_block(self, child, output, env, in_tcolorbox):
+        # Sometimes parsed as an inline child
+        output.append(f"\\[\n{child.content}\n\\]")
+
+    def _inline_softbreak(self, child, output, env, in_tcolorbox):
+        output.append(" ") # Treat softbreaks as spaces
+
+    def _inline_hardbreak(self, child, output, env, in_tcolorbox):
+        output.append("\\\\\n") # Hard line break
 
     def render_document(self,
                         body_content: str,
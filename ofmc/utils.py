@@ -28,6 +28,10 @@ def insert_blank_blockquote_lines(text: str) -> str:
     that multi-line blockquotes are treated as separate paragraphs.
     """
     lines = text.splitlines()
+    if '>' not in text:
+        # 没有块引用，只需与下面相同地规整换行
+        return '\n'.join(lines)
+
     new_lines = []
     prev_is_blockquote = False
 
@@ -43,29 +47,35 @@ def insert_blank_blockquote_lines(text: str) -> str:
 
     return '\n'.join(new_lines)
 
+_SECTION_RE = re.compile(r'\\(sub)*section(?!\*)(\s*\{)')  # matches \section{ or \subsection{ etc.
+
 def demote_headings(latex: str) -> str:
     """
     Converts numbered heading commands to unnumbered (starred) ones
     in embedded LaTeX chunks, to avoid TOC/number pollution.
     """
-    return re.sub(
-        r'\\(sub)*section(?!\*)(\s*\{)',  # matches \section{ or \subsection{ etc.
+    if 'section' not in latex:
+        return latex
+    return _SECTION_RE.sub(
         lambda m: f"\\{m.group(1) or ''}section*{m.group(2)}",
         latex
     )
 
+# 所有单字符替换合并成一张表，str.translate 只需扫描一遍文本
+_UNICODE_NORMALIZATION_TABLE = str.maketrans({
+    '\u202F': ' ',     # narrow no-break space → space
+    '\u00A0': ' ',     # no-break space → space
+    '\u200B': None,    # zero width space → remove
+    '\uFFFC': None,    # object replacement → remove (or '[obj]')
+})
+
 def normalize_unicode(text: str) -> str:
-    replacements = {
-        '\u202F': ' ',     # narrow no-break space → space
-        '\u00A0': ' ',     # no-break space → space
-        '\u200B': '',      # zero width space → remove
-        '\uFFFC': '',      # object replacement → remove (or '[obj]')
-    }
-    for bad_char, replacement in replacements.items():
-        text = text.replace(bad_char, replacement)
-    return text
+    return text.translate(_UNICODE_NORMALIZATION_TABLE)
 
 def fix_align_environment(latex_code: str) -> str:
+    # 两个目标都含有 '{align}'：大多数文档没有 align 环境，一次查找即可返回
+    if '{align}' not in latex_code:
+        return latex_code
     return (
         latex_code
         .replace(r'\begin{align}', r'\begin{aligned}')
@@ -95,14 +105,26 @@ def fix_callout_formulas(text: str) -> str:
     # return pattern.sub(r'\1', text)
     return preprocess_markdown_quotes(text)
 
+_DISPLAY_MATH_AFTER_RE = re.compile(r'\$\$\s*([^\s\n].*?)')
+# 匹配只可能从行首或上一个匹配的末尾 (即某个 $$ 之后) 开始：从这样的位置找不到时，
+# 同一行里更靠后的位置也找不到。加上这个锚点后，不含 $$ 的行不再从每个位置
+# 重新向后扫描到行尾 (对长行是平方级的)，结果与不加锚点时相同
+_DISPLAY_MATH_BEFORE_RE = re.compile(r'(?:^|(?<=\$\$))([^\n]+?)\s*\$\$', re.MULTILINE)
+
 def split_inline_display_math(tex: str) -> str:
     tex = unescape_dollars(tex)
+    # 没有 $$ 时两条规则都不会匹配
+    if '$$' not in tex:
+        return tex
     # $$ 后有文字：变成 "$$\n内容"
-    tex = re.sub(r'\$\$\s*([^\s\n].*?)', r'$$\n\1', tex)
+    tex = _DISPLAY_MATH_AFTER_RE.sub(r'$$\n\1', tex)
     # $$ 前有文字：变成 "内容\n$$"
-    tex = re.sub(r'([^\n]+?)\s*\$\$', r'\1\n$$', tex)
+    tex = _DISPLAY_MATH_BEFORE_RE.sub(r'\1\n$$', tex)
     return tex
 
+_DISPLAY_MATH_BLOCK_RE = re.compile(r'\$\$(.*?)\$\$', flags=re.DOTALL)
+_TAG_RE = re.compile(r'\\tag\s*(?:\{(.*?)\}|([^\s{]+))')
+
 def replace_tagged_dollars(tex: str) -> str:
     """
     终极修复版：
@@ -130,8 +152,7 @@ def replace_tagged_dollars(tex: str) -> str:
         #      - \{.*?\} : 匹配花括号内的所有内容
         #      - | : 或
         #      - [^\s{]+ : 匹配一个或多个不是空格也不是左花括号的字符
-        tag_extractor_pattern = r'\\tag\s*(?:\{(.*?)\}|([^\s{]+))'
-        tag_match = re.search(tag_extractor_pattern, content)
+        tag_match = _TAG_RE.search(content)
 
         tag_content = ""
         content_without_tag = content
@@ -144,7 +165,7 @@ def replace_tagged_dollars(tex: str) -> str:
 
             # 从原始内容中移除整个 \tag... 部分
             # 使用 re.sub 比字符串替换更安全
-            content_without_tag = re.sub(tag_extractor_pattern, '', content, count=1).strip()
+            content_without_tag = _TAG_RE.sub('', content, count=1).strip()
         else:
             # 这是一个安全回退，理论上不应该被触发
             # 如果发生了，意味着 \tag 后面跟了一些我们没预料到的奇怪结构
@@ -155,70 +176,101 @@ def replace_tagged_dollars(tex: str) -> str:
         # 3. 替换阶段：构建正确的 equation 环境
         return f"\\begin{{equation}}\n{content_without_tag}\n\\tag{{{tag_content}}}\n\\end{{equation}}"
 
+    # 只有含 \tag 的块才会被改写
+    if r'\tag' not in tex:
+        return tex
+
     # 外层正则表达式保持不变
-    return re.sub(r'\$\$(.*?)\$\$', ultimate_replacer, tex, flags=re.DOTALL)
+    return _DISPLAY_MATH_BLOCK_RE.sub(ultimate_replacer, tex)
+
+def post_process_transclusion(tex: str) -> str:
+    """
+    嵌入内容的后处理：demote_headings、split_inline_display_math、replace_tagged_dollars。
+    三者各自在不可能匹配时直接返回，普通文本几乎不产生额外扫描。
+    """
+    return replace_tagged_dollars(split_inline_display_math(demote_headings(tex)))
 
 def unescape_dollars(tex: str) -> str:
     # 将所有 \$\$ 替换成 $$
     return tex.replace(r'\$\$', '$$')
 
+# str.splitlines 认作换行、但 '\n' 以外的字符
+# (逐个用 in 检查，比用字符类正则扫描整个文本快得多)
+_OTHER_LINE_BREAKS = '\r\v\f\x1c\x1d\x1e\x85\u2028\u2029'
+
+def _join_lines(text: str) -> str:
+    """
+    等价于 '\\n'.join(text.splitlines())：其他换行符统一成 '\\n'，末尾的一个换行符被去掉。
+    其他换行符很少见，通常只需去掉末尾的换行符，不必构造行列表。
+    """
+    if any(line_break in text for line_break in _OTHER_LINE_BREAKS):
+        return '\n'.join(text.splitlines())
+    if text.endswith('\n'):
+        return text[:-1]
+    return text
+
+# 块引用中的 $$ 分隔行，例如 "> $$"
+_QUOTE_MATH_DELIM = r'[^\S\n]*>[^\S\n]*\$\$[^\S\n]*$'
+# 一个块引用中的公式块：起始分隔行，随后若干行 > 开头的内容行
+# (碰到非 > 开头的行说明结构坏了，保守地在此结束)，最后是可选的终止分隔行
+# 1 捕获内容行 (每行连同前面的换行符)，2 捕获终止分隔行
+_QUOTE_MATH_BLOCK_RE = re.compile(
+    r'^' + _QUOTE_MATH_DELIM +
+    r'((?:\n(?!' + _QUOTE_MATH_DELIM + r')[^\S\n]*>[^\n]*)*)'
+    r'(\n' + _QUOTE_MATH_DELIM + r')?',
+    re.MULTILINE
+)
+# 内容行的 > 前缀
+_QUOTE_PREFIX_RE = re.compile(r'\n[^\S\n]*>[^\S\n]?')
+
+def _unquote_latex_block(match: re.Match) -> str:
+    # 去掉 >
+    block = '$$' + _QUOTE_PREFIX_RE.sub('\n', match.group(1))
+    if match.group(2) is not None:
+        block += '\n$$'
+    return block
+
+def _unquote_latex_blocks_text(text: str) -> str:
+    # text 中只以 '\n' 换行；公式块的每一行都以 > 开头
+    if '$$' not in text or '>' not in text:
+        return text
+    return _QUOTE_MATH_BLOCK_RE.sub(_unquote_latex_block, text)
+
 def unquote_latex_blocks(lines: list[str]) -> list[str]:
-    output = []
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-
-        # 匹配 > $$ 起始
-        if re.match(r'^\s*>\s*\$\$\s*$', line):
-            # ✅ 找到起始 quote-math-block
-            block = []
-            block.append('$$')  # 去掉 >
-
-            i += 1
-            while i < len(lines):
-                current = lines[i]
-                if re.match(r'^\s*>\s*\$\$\s*$', current):  # 终止符
-                    block.append('$$')
-                    i += 1
-                    break
-                elif re.match(r'^\s*>\s?(.*)', current):  # 去掉 > 前缀
-                    block.append(re.sub(r'^\s*>\s?', '', current))
-                else:
-                    # 非 > 开头：说明结构坏了，保守退出
-                    break
-                i += 1
-
-            output.extend(block)
-        else:
-            output.append(line)
-            i += 1
-    return output
+    if not lines:
+        return []
+    return _unquote_latex_blocks_text('\n'.join(lines)).split('\n')
 
 def preprocess_markdown_quotes(text: str) -> str:
-    lines = text.splitlines()
-    processed = unquote_latex_blocks(lines)
-    return '\n'.join(processed).replace(r'Alternative Proof', 'Alternative-Proof')
+    text = _unquote_latex_blocks_text(_join_lines(text))
+    return text.replace(r'Alternative Proof', 'Alternative-Proof')
+
+# 匹配 $...$ 或 $$...$$ 中的 \mathbb k
+_MATHBB_K_RE = re.compile(r'\\mathbb\s*k\b')
 
 def fix_mathbb_k(tex: str) -> str:
-    # 匹配 $...$ 或 $$...$$ 中的 \mathbb k
-    return re.sub(r'\\mathbb\s*k\b', r'\\Bbbk', tex)
+    return _MATHBB_K_RE.sub(r'\\Bbbk', tex)
+
+# 转义的 \< 与 \>：只删掉反斜杠，一次扫描处理两种符号
+_ESCAPED_LT_GT_RE = re.compile(r'\\(?=[<>])')
 
 def fix_smaller_than(tex: str) -> str:
-    tex = re.sub(r'\\<', '<',tex)
-    tex = re.sub(r'\\>', '>',tex)
-    return tex
+    return _ESCAPED_LT_GT_RE.sub('', tex)
+
+# 识别 Obsidian YAML 区块
+_YAML_BLOCK_RE = re.compile(r"^---\n(.*?)\n---\n", re.DOTALL)
+_BANNER_RE = re.compile(r"banner:\s*['\"]?\[\[(.*?)\]\]['\"]?")
 
 def extract_banner_path(markdown_text: str) -> tuple[str, str | None]:
-    import re
     # 识别 Obsidian YAML 区块
-    match = re.match(r"^---\n(.*?)\n---\n", markdown_text, re.DOTALL)
+    match = _YAML_BLOCK_RE.match(markdown_text)
     if not match:
         return markdown_text, None
 
     yaml_block = match.group(1)
     rest_text = markdown_text[match.end():]
 
-    banner_match = re.search(r"banner:\s*['\"]?\[\[(.*?)\]\]['\"]?", yaml_block)
+    banner_match = _BANNER_RE.search(yaml_block)
     if banner_match:
         banner_path = banner_match.group(1)
         return rest_text, banner_path
@@ -226,6 +278,18 @@ def extract_banner_path(markdown_text: str) -> tuple[str, str | None]:
         return markdown_text, None
 
 from functools import partial
+def _has_column_spec(column_spec: str | None) -> bool:
+    # --- 这是您建议的核心判断逻辑 ---
+    # 检查列描述符是否存在且非空
+    if column_spec:
+        # 如果存在，剥离花括号和空格，检查里面是否还有内容
+        # 例如 "{ ccc }" -> "ccc"
+        inner_spec = column_spec.strip()[1:-1].strip()
+        if inner_spec:
+            # 描述符非空 (e.g., {c}, {c|c})
+            return True
+    return False
+
 def _array_replacer(match: re.Match, target_env: str) -> str:
     """
     这是一个 re.sub 的 "替换函数". 它接收一个匹配对象并决定如何行动。
@@ -236,29 +300,74 @@ def _array_replacer(match: re.Match, target_env: str) -> str:
     - group(3): 数组内容
     - group(4): 右括号, e.g., r'\\right)'
     """
-    column_spec = match.group(2)
-
-    # --- 这是您建议的核心判断逻辑 ---
-    # 检查列描述符是否存在且非空
-    if column_spec:
-        # 如果存在，剥离花括号和空格，检查里面是否还有内容
-        # 例如 "{ ccc }" -> "ccc"
-        inner_spec = column_spec.strip()[1:-1].strip()
-        if inner_spec:
-            # 描述符非空 (e.g., {c}, {c|c}), 不进行替换，返回原始匹配的完整字符串
-            return match.group(0)
+    if _has_column_spec(match.group(2)):
+        # 不进行替换，返回原始匹配的完整字符串
+        return match.group(0)
 
     # --- 如果通过了判断 (描述符为空或不存在), 则执行替换 ---
-    left_delimiter = match.group(1)
     content = match.group(3)
-    right_delimiter = match.group(4)
-
-    # 如果没有括号 (裸数组), 我们使用 'matrix' 作为默认环境
-    if not left_delimiter and not right_delimiter:
-        target_env = 'matrix'
-
     return f"\\begin{{{target_env}}}{content}\\end{{{target_env}}}"
 
+def _naked_array_replacer(match: re.Match) -> str:
+    """
+    裸数组 (没有 \\left \\right) 的替换函数，目标环境总是 'matrix'。
+
+    匹配组 (match.group) 的结构:
+    - group(1): 完整的列描述符, or None if not present
+    - group(2): 数组内容
+    """
+    if _has_column_spec(match.group(1)):
+        return match.group(0)
+
+    content = match.group(2)
+    return f"\\begin{{matrix}}{content}\\end{{matrix}}"
+
+
+# array 核心模式: \begin{array} 后面跟着一个可选的 {...} 列描述符
+_ARRAY_BEGIN_PATTERN = r"\\begin\{array\}"
+# (\s*\{[^}]*\})?  <-- 捕获组: 可选的列描述符. 这是判断的关键!
+_ARRAY_COLUMN_SPEC_PATTERN = r"(\s*\{[^}]*\})?"
+# 内容和结尾
+_ARRAY_CONTENT_PATTERN = r"(.*?)"  # 捕获组: 内容
+_ARRAY_END_PATTERN = r"\\end\{array\}"
+
+# --- STAGE 1: 带括号的数组 ---
+# 我们将分步处理不同类型的括号，以决定目标环境 (pmatrix, bmatrix, etc.)
+_ARRAY_BRACKET_RULES = [
+    {'name': 'pmatrix', 'left': r"\\left\s*\(", 'right': r"\\right\s*\)"},
+    {'name': 'bmatrix', 'left': r"\\left\s*\[", 'right': r"\\right\s*\]"},
+    # 将 | 和 \vert 合并处理
+    {'name': 'vmatrix', 'left': r"\\left\s*(?:\\vert|\|)", 'right': r"\\right\s*(?:\\vert|\|)"},
+    # 将 || 和 \Vert 合并处理
+    {'name': 'Vmatrix', 'left': r"\\left\s*(?:\\Vert|\\\|)", 'right': r"\\right\s*(?:\\Vert|\\\|)"}
+]
+
+# 为每种括号构建完整的匹配模式，模块导入时编译一次
+_BRACKETED_ARRAY_SUBS = [
+    (
+        re.compile(
+            f"({rule['left']})"  # Group 1: 左括号
+            f"{_ARRAY_BEGIN_PATTERN}"
+            f"{_ARRAY_COLUMN_SPEC_PATTERN}"  # Group 2: 列描述符
+            f"{_ARRAY_CONTENT_PATTERN}"  # Group 3: 内容
+            f"{_ARRAY_END_PATTERN}"
+            f"({rule['right']})",  # Group 4: 右括号
+            flags=re.DOTALL
+        ),
+        # 使用 partial 将目标环境名传递给替换函数
+        partial(_array_replacer, target_env=rule['name'])
+    )
+    for rule in _ARRAY_BRACKET_RULES
+]
+
+# --- STAGE 2: 所有剩下符合条件的 "裸" 数组 (没有 \left \right) ---
+_NAKED_ARRAY_RE = re.compile(
+    f"{_ARRAY_BEGIN_PATTERN}"
+    f"{_ARRAY_COLUMN_SPEC_PATTERN}"  # Group 1: 列描述符
+    f"{_ARRAY_CONTENT_PATTERN}"  # Group 2: 内容
+    f"{_ARRAY_END_PATTERN}",
+    flags=re.DOTALL
+)
 
 def replace_array_with_matrix_environments(latex: str) -> str:
     """
@@ -268,64 +377,27 @@ def replace_array_with_matrix_environments(latex: str) -> str:
     - 只替换那些列描述符为空或不存在的 array 环境。
     """
 
-    # 定义匹配规则：一个左括号，一个 array，一个右括号
-    # 括号部分使用非捕获组 (?:...)
-    left_delim_pattern = r"(\\left\s*(?:\(|\[|\\vert|\\Vert|\||\\\|))"
-    right_delim_pattern = r"(\\right\s*(?:\)|\]|\\vert|\\Vert|\||\\\|))"
-
-    # array 核心模式: \begin{array} 后面跟着一个可选的 {...} 列描述符
-    array_pattern = r"\\begin\{array\}"
-    # (\s*\{[^}]*\})?  <-- 捕获组(2): 可选的列描述符. 这是判断的关键!
-    column_spec_pattern = r"(\s*\{[^}]*\})?"
-
-    # 内容和结尾
-    content_pattern = r"(.*?)"  # 捕获组(3): 内容
-    end_pattern = r"\\end\{array\}"
+    # 所有模式都要求 \begin{array}，带括号的还要求 \left
+    if r'\begin{array}' not in latex:
+        return latex
 
     # --- STAGE 1: 处理带括号的数组 ---
-    # 我们将分步处理不同类型的括号，以决定目标环境 (pmatrix, bmatrix, etc.)
-    rules = [
-        {'name': 'pmatrix', 'left': r"\\left\s*\(", 'right': r"\\right\s*\)"},
-        {'name': 'bmatrix', 'left': r"\\left\s*\[", 'right': r"\\right\s*\]"},
-        # 将 | 和 \vert 合并处理
-        {'name': 'vmatrix', 'left': r"\\left\s*(?:\\vert|\|)", 'right': r"\\right\s*(?:\\vert|\|)"},
-        # 将 || 和 \Vert 合并处理
-        {'name': 'Vmatrix', 'left': r"\\left\s*(?:\\Vert|\\\|)", 'right': r"\\right\s*(?:\\Vert|\\\|)"}
-    ]
-
-    for rule in rules:
-        # 为每种括号构建完整的匹配模式
-        full_pattern = re.compile(
-            f"({rule['left']})"  # Group 1: 左括号
-            f"{array_pattern}"
-            f"{column_spec_pattern}"  # Group 2: 列描述符
-            f"{content_pattern}"  # Group 3: 内容
-            f"{end_pattern}"
-            f"({rule['right']})",  # Group 4: 右括号
-            flags=re.DOTALL
-        )
-
-        # 使用 partial 将目标环境名传递给替换函数
-        replacer_func = partial(_array_replacer, target_env=rule['name'])
-        latex = full_pattern.sub(replacer_func, latex)
+    if r'\left' in latex:
+        for full_pattern, replacer_func in _BRACKETED_ARRAY_SUBS:
+            latex = full_pattern.sub(replacer_func, latex)
 
     # --- STAGE 2: 处理所有剩下符合条件的 "裸" 数组 (没有 \left \right) ---
-    naked_pattern = re.compile(
-        # 用 () 表示空的左右括号，这样可以复用 _array_replacer 函数
-        r"()?"  # Group 1: 左括号 (空)
-        f"{array_pattern}"
-        f"{column_spec_pattern}"  # Group 2: 列描述符
-        f"{content_pattern}"  # Group 3: 内容
-        f"{end_pattern}"
-        r"()?",  # Group 4: 右括号 (空)
-        flags=re.DOTALL
-    )
-    # 对于裸数组，默认目标是 'matrix'，这会在 _array_replacer 内部处理
-    naked_replacer_func = partial(_array_replacer, target_env='matrix')
-    latex = naked_pattern.sub(naked_replacer_func, latex)
+    latex = _NAKED_ARRAY_RE.sub(_naked_array_replacer, latex)
 
     return latex
 
+# 核心逻辑：
+# 1. 行 (去掉行首空白后) 是否以 ">>" 开头？
+# 2. 如果是，它是否 *不是* 一个嵌套的 callout (">>X" 不是 ">>[!")？
+#    即剥离了前缀的 '>' 和空格后，剩余部分不以 '[!' 开头。
+# 1 捕获换行符和行首空白，随后的第一个 '>' 被移除
+_NESTED_BLOCKQUOTE_RE = re.compile(r'(\n[^\S\n]*)>(?=>(?![ >]*\[!))')
+
 def preprocess_nested_blockquotes(markdown_text: str) -> str:
     """
     预处理Markdown文本，以规避texmath插件在特定嵌套块引用中的bug。
@@ -341,142 +413,153 @@ def preprocess_nested_blockquotes(markdown_text: str) -> str:
     Returns:
         经过预处理的Markdown文件内容。
     """
-    lines = markdown_text.split('\n')
-    processed_lines = []
-
-    for line in lines:
-        # 核心逻辑：
-        # 1. 行是否以 ">>" 开头？
-        # 2. 如果是，它是否 *不是* 一个嵌套的 callout (">>X" 不是 ">>[!")？
-        #    我们检查剥离了前缀'>>'和可选空格后的剩余部分是否以 '[!' 开头。
-
-        stripped_line = line.lstrip()  # 处理行首的空格，增加鲁棒性
-
-        if stripped_line.startswith('>>'):
-            # 检查它是否是一个 callout
-            # ">> [!note]" -> lstrip(' >') -> "[!note]"
-            content_after_quotes = stripped_line.lstrip(' >')
-            if not content_after_quotes.startswith('[!'):
-                # 这就是我们要处理的目标行！
-                # 找到第一个非空格字符的位置，然后移除它前面的一个'>'
-                first_char_index = len(line) - len(stripped_line)
-                quote_index = line.find('>', first_char_index)
-                if quote_index != -1:
-                    processed_lines.append(line[:quote_index] + line[quote_index + 1:])
-                else:  # 理论上不会发生，但作为安全措施
-                    processed_lines.append(line)
-            else:
-                # 这是一个嵌套的callout，我们不动它
-                processed_lines.append(line)
-        else:
-            # 这不是一个嵌套的块引用，我们不动它
-            processed_lines.append(line)
-
-    return '\n'.join(processed_lines)
-
-
-def fix_kern_syntax(latex: str) -> str:
-    # 列出常见的需要修复的尺寸命令
-    # 注意：这些命令在原生 TeX 中期望后面直接跟数值，不带花括号。
-    dimension_commands = [
-        "kern",
-        "raise",
-        "moveleft",
-        "moveright"
-    ]
-
-    pattern_core = "|".join(dimension_commands)
-    # The pattern looks for cmd followed by braces, e.g., \\raise{.4pt}
-    # 1 will capture the command name (e.g., "raise")
-    # 2 will capture the content inside the braces (e.g., ".4pt")
-    pattern = r'\\(' + pattern_core + r')\s*\{([^}]+)\}'
-
-    # The replacement uses the captured groups to form the correct syntax: cmd content
-    replacement = r'\\\1 \2'
-
-    return fix_dimension_spacing_syntax(re.sub(pattern, replacement, latex))
+    if '>>' not in markdown_text:
+        return markdown_text
+
+    # 在开头补一个换行，使第一行也能被以 '\n' 开头的正则匹配到
+    return _NESTED_BLOCKQUOTE_RE.sub(r'\1', '\n' + markdown_text)[1:]
+
+
+# 列出常见的需要修复的尺寸命令
+# 注意：这些命令在原生 TeX 中期望后面直接跟数值，不带花括号。
+_DIMENSION_COMMANDS = [
+    "kern",
+    "raise",
+    "moveleft",
+    "moveright"
+]
+
+# TeX 中常见的长度单位
+_TEX_UNITS = [
+    "pt", "pc", "in", "bp", "cm", "mm",
+    "dd", "cc", "sp", "em", "ex", "mu"
+    # "rem", "vh", "vw" 等是 CSS 单位，在 LaTeX 中不常用，
+    # 但如果你的笔记中有，也可以加上
+]
+# (\d*\.?\d+)  : 匹配数字 (整数或小数)
+# \s+          : 匹配一个或多个空格
+# (em|pt|...)  : 匹配我们定义的单位之一
+# 我们用 re.IGNORECASE 来忽略大小写，尽管 TeX 单位通常是小写的
+_DIMENSION_SPACING_RE = re.compile(r'(\d*\.?\d+)\s+(' + "|".join(_TEX_UNITS) + r')', re.IGNORECASE)
 
 def fix_dimension_spacing_syntax(latex: str) -> str:
     """
     修复 TeX 尺寸单位前出现多余空格的问题。
     将 "1 em" 这样的写法修正为 "1em"。
     """
-    # TeX 中常见的长度单位
-    units = [
-        "pt", "pc", "in", "bp", "cm", "mm",
-        "dd", "cc", "sp", "em", "ex", "mu"
-        # "rem", "vh", "vw" 等是 CSS 单位，在 LaTeX 中不常用，
-        # 但如果你的笔记中有，也可以加上
-    ]
-
-    # 构建正则表达式
-    # (\d*\.?\d+)  : 匹配数字 (整数或小数)
-    # \s+          : 匹配一个或多个空格
-    # (em|pt|...)  : 匹配我们定义的单位之一
-    # 我们用 (?i) 来忽略大小写，尽管 TeX 单位通常是小写的
-    pattern_core = "|".join(units)
-    pattern = re.compile(r'(\d*\.?\d+)\s+(' + pattern_core + r')', re.IGNORECASE)
-
     # 替换模式：将 "数字 空格 单位" 替换为 "数字单位"
     # \1 代表数字部分，\2 代表单位部分
     replacement = r'\1\2'
 
-    return pattern.sub(replacement, latex)
+    return _DIMENSION_SPACING_RE.sub(replacement, latex)
+
+# fix_kern_syntax 的两步 (去掉尺寸命令的花括号，再修复单位前的空格) 合并为一次扫描：
+# 第一个分支匹配 cmd 加花括号，例如 \\raise{.4pt}
+#   1 捕获命令名 (例如 "raise")，2 捕获花括号内的内容 (例如 ".4pt")，
+#   3 捕获紧跟其后的空白，它和花括号内末尾的空白在去掉花括号后会连成一段
+# 第二个分支直接匹配 "数字 空格 单位" 中要删掉的那段空格
+_UNIT_AT_RE = re.compile("|".join(_TEX_UNITS), re.IGNORECASE)
+_KERN_OR_SPACING_RE = re.compile(
+    r'\\(' + "|".join(_DIMENSION_COMMANDS) + r')\s*\{([^}]+)\}(\s*)'
+    r'|(?<=\d)\s+(?=(?i:' + "|".join(_TEX_UNITS) + r'))'
+)
 
+def _replace_kern_or_spacing(match: re.Match) -> str:
+    cmd = match.group(1)
+    if cmd is None:
+        return ''
+
+    # The replacement uses the captured groups to form the correct syntax: cmd content
+    content = match.group(2) + match.group(3)
+    # 后面紧跟单位时，带上它一起修复空格，再去掉
+    unit = _UNIT_AT_RE.match(match.string, match.end())
+    if unit:
+        unit = unit.group()
+        content = fix_dimension_spacing_syntax(content + unit)[:-len(unit)]
+    else:
+        content = fix_dimension_spacing_syntax(content)
+    return f"\\{cmd} {content}"
+
+def fix_kern_syntax(latex: str) -> str:
+    return _KERN_OR_SPACING_RE.sub(_replace_kern_or_spacing, latex)
+
+
+# 定义一个 (查找, 替换) 的规则字典，方便未来扩展
+# 注意：使用 raw string (r"...") 来避免反斜杠的转义问题
+_ARROW_TRICKS_MAP = {
+    r"\longleftarrow{\raise{.4pt}{\hspace{-5pt}\shortmid}}": r"\longmapsfrom ",
+    # 未来可以添加更多规则，比如右箭头的 trick
+    # r"\longrightarrow{...trick...}": r"\longmapsto",
+}
 
 def replace_custom_arrow_tricks(latex: str) -> str:
     """
     查找并替换已知的、用于生成特殊符号的 "hack" 或 "trick" 写法。
     这比尝试修复其内部的复杂语法要健壮得多。
     """
-    # 定义一个 (查找, 替换) 的规则字典，方便未来扩展
-    # 注意：使用 raw string (r"...") 来避免反斜杠的转义问题
-    tricks_map = {
-        r"\longleftarrow{\raise{.4pt}{\hspace{-5pt}\shortmid}}": r"\longmapsfrom ",
-        # 未来可以添加更多规则，比如右箭头的 trick
-        # r"\longrightarrow{...trick...}": r"\longmapsto",
-    }
-
-    for find_str, replace_str in tricks_map.items():
+    # 规则很少时逐条 str.replace 最快；规则多于两三条时，
+    # 改用一个 re.escape 拼成的交替正则一次扫描更合适
+    for find_str, replace_str in _ARROW_TRICKS_MAP.items():
         latex = latex.replace(find_str, replace_str)
 
     return latex
 
+_BBOX_RE = re.compile(r'\\bbox(?:\[[^\]]*\])?{([^}]*)}')
+
 def replace_bbox(latex: str) -> str:
-    pattern = re.compile(r'\\bbox(?:\[[^\]]*\])?{([^}]*)}')
-    return pattern.sub(r'\\boxed{\1}', latex)
+    return _BBOX_RE.sub(r'\\boxed{\1}', latex)
+
+_CHOOSE_RE = re.compile(r'(\w+)\s*\\choose\s*(\w+)')
 
 def fix_choose(latex: str) -> str:
-    return re.sub(r'(\w+)\s*\\choose\s*(\w+)', r'\\binom{\1}{\2}', latex)
+    # 正则以 \w+ 开头，会从每个单词的每个位置尝试匹配，先用子串检查排除
+    if r'\choose' not in latex:
+        return latex
+    return _CHOOSE_RE.sub(r'\\binom{\1}{\2}', latex)
+
+_LABEL_BETWEEN_TCOLORBOX_ENDS_RE = re.compile(
+    r"(\\end\{tcolorbox\})\s*(\\label\{[^\}]+\})\s*(\\end\{tcolorbox\})",
+    re.MULTILINE
+)
 
-def fix_tcolorbox_label_tcolorbox(content: str) -> str:
-    """
-    Iteratively corrects misplaced \\label commands between nested, breakable tcolorboxes.
-    A single misplaced label in an N-level nested structure requires N-1 passes to "bubble out".
-    The loop continues until no more substitutions can be made.
-    """
+# 一段会被上面的规则反复处理的片段：从紧跟着 \label 的 \end{tcolorbox} 开始，
+# 之后只由空白分隔的 \end{tcolorbox} 和 \label{...}。
+# 规则的每次匹配都落在这样一段之内，替换后它仍是同一段，不会和别处相连
+_LABEL_TCOLORBOX_RUN_RE = re.compile(
+    r"\\end\{tcolorbox\}\s*\\label\{[^\}]+\}"
+    r"(?:\s*(?:\\end\{tcolorbox\}|\\label\{[^\}]+\}))*"
+)
+
+def _fix_label_tcolorbox_run(match: re.Match) -> str:
     # The pattern remains the same
-    pattern = re.compile(
-        r"(\\end\{tcolorbox\})\s*(\\label\{[^\}]+\})\s*(\\end\{tcolorbox\})",
-        re.MULTILINE
-    )
+    pattern = _LABEL_BETWEEN_TCOLORBOX_ENDS_RE
     # The replacement logic also remains the same
     replacement = r"\1\n\3\n\2"
+    run = match.group()
 
     # --- Iterative Application ---
     # We use a while True loop that breaks when a pass makes no changes.
     while True:
         # re.subn is perfect here: it returns the new string and the number of substitutions made.
-        new_content, num_subs = pattern.subn(replacement, content)
+        new_run, num_subs = pattern.subn(replacement, run)
 
         # If no substitutions were made in this pass, the work is done.
         if num_subs == 0:
-            break
+            return run
 
-        # Otherwise, update the content and loop again for the next level.
-        content = new_content
+        # Otherwise, update the run and loop again for the next level.
+        run = new_run
 
-    return content
+def fix_tcolorbox_label_tcolorbox(content: str) -> str:
+    """
+    Iteratively corrects misplaced \\label commands between nested, breakable tcolorboxes.
+    A single misplaced label in an N-level nested structure requires N-1 passes to "bubble out".
+    The passes are only repeated over each run of \\end{tcolorbox} / \\label{...} tokens,
+    so the document itself is scanned once.
+    """
+    if '\\label{' not in content:
+        return content
+    return _LABEL_TCOLORBOX_RUN_RE.sub(_fix_label_tcolorbox_run, content)
 
 _BAD_PTR_LINE = re.compile(
     r'^[ \t]*\\\^\{\}.*?(?:\r?\n|\r|\Z)',
@@ -484,17 +567,14 @@ _BAD_PTR_LINE = re.compile(
 )
 
 def remove_bad_tex_block_pointers(text: str) -> str:
+    # 多行模式的 ^ 会在每个位置尝试，先用子串检查排除没有 \^{} 的文档
+    if r'\^{}' not in text:
+        return text
     return _BAD_PTR_LINE.sub('', text)
 
 
-def get_shared_latex_preamble() -> str:
-    """
-    Returns the shared LaTeX preamble content for all document types.
-    This ensures visual and functional consistency.
-    It does NOT include \\documentclass or geometry settings, as those are
-    class-specific.
-    """
-    return r"""
+# 所有文档类型共用的导言区，内容固定，模块加载时构造一次
+_SHARED_LATEX_PREAMBLE = r"""
 \usepackage{fontspec}       % Unicode 字体支持
 \usepackage{xeCJK}          % 中文支持
 
@@ -559,36 +639,67 @@ def get_shared_latex_preamble() -> str:
 \setcounter{MaxMatrixCols}{30}
 """
 
+
+def get_shared_latex_preamble() -> str:
+    """
+    Returns the shared LaTeX preamble content for all document types.
+    This ensures visual and functional consistency.
+    It does NOT include \\documentclass or geometry settings, as those are
+    class-specific.
+    """
+    return _SHARED_LATEX_PREAMBLE
+
+# 以 '!' 开头 (允许前导空白) 的错误行；第二个用于第一行之后的行
+_LATEX_ERROR_LINE_RE = re.compile(r'[^\S\n]*!')
+_LATEX_ERROR_NEXT_LINE_RE = re.compile(r'\n[^\S\n]*!')
+
 def extract_relevant_latex_error(log: str) -> str:
     """
     从完整的 XeLaTeX 日志中提取出核心的错误信息。
     它会找到第一个以 '!' 开头的行，并返回那一部分的上下文。
+    日志可能很大，这里直接在字符串上查找行边界，而不把整个日志拆成行列表。
     """
-    lines = log.splitlines()
-    error_start_index = -1
+    # 行的划分与 log.splitlines() 一致
+    log = _join_lines(log)
 
     # 找到第一个错误标志 '!' 所在的行
-    for i, line in enumerate(lines):
-        if line.strip().startswith('!'):
-            error_start_index = i
-            break
+    if _LATEX_ERROR_LINE_RE.match(log):
+        error_start = 0
+    else:
+        match = _LATEX_ERROR_NEXT_LINE_RE.search(log)
+        error_start = match.start() + 1 if match else -1
 
-    if error_start_index != -1:
+    if error_start != -1:
         # 我们找到了错误！
         # 为了提供上下文，我们从错误行往前取几行，往后取几行
         context_before = 2
         context_after = 8
 
-        start = max(0, error_start_index - context_before)
-        end = min(len(lines), error_start_index + context_after)
-
-        relevant_lines = lines[start:end]
-        return "\n".join(relevant_lines)
+        start = error_start
+        for _ in range(context_before):
+            if start == 0:
+                break
+            start = log.rfind('\n', 0, start - 1) + 1
+
+        end = error_start
+        for _ in range(context_after):
+            end = log.find('\n', end) + 1
+            if end == 0:
+                end = len(log) + 1
+                break
+
+        # end 指向最后一行之后的换行符再后一位
+        return log[start:end - 1]
     else:
         # 如果没有找到 '!'，说明可能是其他类型的错误（比如文件没找到）
         # 在这种情况下，返回日志的最后一部分通常比较有用
-        last_lines = lines[-15:]
-        return "Could not find a standard LaTeX error ('!'). Showing last 15 lines of log:\n" + "\n".join(last_lines)
+        start = len(log)
+        for _ in range(15):
+            start = log.rfind('\n', 0, start)
+            if start == -1:
+                break
+        last_lines = log[start + 1:]
+        return "Could not find a standard LaTeX error ('!'). Showing last 15 lines of log:\n" + last_lines
 
 # Registry of processors. To avoid clumsy recursive call chains in renderer.py
 BUILTIN_POST_PROCESSORS = {